@@ -9,6 +9,7 @@ from pyvcloud.vcd.client import _WellKnownEndpoint
 from container_service_extension.utils import connect_vcd_user_via_token
 from container_service_extension.utils import get_server_runtime_config
 from container_service_extension.utils import get_vcd_sys_admin_client
+from container_service_extension.utils import release_vcd_sys_admin_client
 
 
 class AbstractBroker(abc.ABC):
@@ -47,6 +48,24 @@ class AbstractBroker(abc.ABC):
 
         """
 
+    @abc.abstractmethod
+    def get_cluster_version_tag(self, cluster_name, cluster_info=None):
+        """Get the entity tag of the current state of the cluster.
+
+        The tag is cheaper to compute than the cluster information, and
+        changes whenever the cluster is created, deleted, resized or changes
+        its status.
+
+        :param str cluster_name: Name of the cluster.
+        :param dict cluster_info: information of the cluster, as returned by
+            get_cluster_info(). If given, the tag is computed from it without
+            further calls to the cloud provider.
+
+        :return: quoted entity tag
+
+        :rtype: str
+        """
+
     @abc.abstractmethod
     def get_cluster_config(self, cluster_name):
         """Get the configuration for the cluster.
@@ -113,5 +132,5 @@ class AbstractBroker(abc.ABC):
 
     def _disconnect_sys_admin(self):
         if self.sys_admin_client is not None:
-            self.sys_admin_client.logout()
+            release_vcd_sys_admin_client(self.sys_admin_client)
             self.sys_admin_client = None
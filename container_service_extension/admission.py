@@ -0,0 +1,89 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import collections
+import threading
+
+from container_service_extension.exceptions import TooManyOperationsError
+
+
+class OperationAdmission(object):
+    """Cap the number of long-running operations in flight.
+
+    Long-running operations, e.g. cluster creation, run in threads of their
+    own long after the request starting them has been replied to. Each
+    operation must be admitted with acquire() before it is started, and
+    released with release() once it is done. Operations beyond the caps are
+    refused rather than overcommitting vCD and vCenter.
+    """
+
+    def __init__(self, max_operations=0, max_operations_per_org=0,
+                 retry_after=60):
+        """Initialize the admission control.
+
+        :param int max_operations: maximum number of operations in flight,
+            0 means no limit.
+        :param int max_operations_per_org: maximum number of operations in
+            flight per org, 0 means no limit.
+        :param int retry_after: number of seconds after which clients of
+            refused operations are told to retry.
+        """
+        self.max_operations = max_operations
+        self.max_operations_per_org = max_operations_per_org
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._operation_count = 0
+        # mapping of org name -> number of operations in flight
+        self._org_operation_counts = collections.Counter()
+        self._refused_count = 0
+
+    def acquire(self, org_name):
+        """Admit an operation on behalf of an org.
+
+        :param str org_name: name of the org the operation belongs to.
+
+        :raises TooManyOperationsError: if admitting the operation would
+            exceed one of the caps.
+        """
+        with self._lock:
+            if 0 < self.max_operations <= self._operation_count:
+                self._refused_count += 1
+                raise TooManyOperationsError(
+                    f"CSE server is busy with {self._operation_count} "
+                    f"operations. Retry in {self.retry_after} seconds.",
+                    self.retry_after)
+            org_operation_count = self._org_operation_counts[org_name]
+            if 0 < self.max_operations_per_org <= org_operation_count:
+                self._refused_count += 1
+                raise TooManyOperationsError(
+                    f"Org '{org_name}' has {org_operation_count} operations "
+                    f"in progress. Retry in {self.retry_after} seconds.",
+                    self.retry_after)
+            self._operation_count += 1
+            self._org_operation_counts[org_name] += 1
+
+    def release(self, org_name):
+        """Release an operation admitted with acquire().
+
+        :param str org_name: name of the org the operation belongs to.
+        """
+        with self._lock:
+            self._operation_count -= 1
+            self._org_operation_counts[org_name] -= 1
+            if self._org_operation_counts[org_name] <= 0:
+                del self._org_operation_counts[org_name]
+
+    def get_metrics(self):
+        """Get counters of operations.
+
+        :return: dict with keys 'in_progress' (operations in flight) and
+            'refused' (operations refused so far).
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'in_progress': self._operation_count,
+                'refused': self._refused_count
+            }
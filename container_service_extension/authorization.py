@@ -14,6 +14,7 @@ from container_service_extension.logger import SERVER_LOGGER as LOGGER
 from container_service_extension.server_constants import CSE_SERVICE_NAMESPACE
 from container_service_extension.utils import get_server_runtime_config
 from container_service_extension.utils import get_vcd_sys_admin_client
+from container_service_extension.utils import release_vcd_sys_admin_client
 
 
 def _get_user_rights(sys_admin_client, user_session):
@@ -93,24 +94,24 @@ def secure(required_rights=[]):
     def decorator_secure(func):
         @functools.wraps(func)
         def decorator_wrapper(*args, **kwargs):
-            sys_admin_client = None
-            try:
-                is_authorized = True
-                server_config = get_server_runtime_config()
-                if server_config['service']['enforce_authorization']:
-                    sys_admin_client = get_vcd_sys_admin_client()
+            is_authorized = True
+            server_config = get_server_runtime_config()
+            if server_config['service']['enforce_authorization']:
+                # the session goes back to the pool before the decorated
+                # method runs, which may take long
+                sys_admin_client = get_vcd_sys_admin_client()
+                try:
                     broker_instance = args[0]  # self
                     user_session = broker_instance.get_tenant_client_session()
                     is_authorized = _is_authorized(sys_admin_client,
                                                    user_session,
                                                    required_rights)
-                if is_authorized:
-                    return func(*args, **kwargs)
-                else:
-                    raise Exception(
-                        'Access Forbidden. Missing required rights.')
-            finally:
-                if sys_admin_client is not None:
-                    sys_admin_client.logout()
+                finally:
+                    release_vcd_sys_admin_client(sys_admin_client)
+            if is_authorized:
+                return func(*args, **kwargs)
+            else:
+                raise Exception(
+                    'Access Forbidden. Missing required rights.')
         return decorator_wrapper
     return decorator_secure
@@ -3,27 +3,43 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 from collections import namedtuple
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
 from enum import Enum
 from enum import unique
 from http import HTTPStatus
+import time
 
 from pyvcloud.vcd.org import Org
 
+from container_service_extension.cluster_index import CLUSTER_INDEX
+from container_service_extension.cluster_index import ClusterLocation
+from container_service_extension.codec import json_dumps
 from container_service_extension.exceptions import ClusterNotFoundError
 from container_service_extension.exceptions import CseServerError
 from container_service_extension.exceptions import PksServerError
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import add_request_backend_time
 from container_service_extension.ovdc_cache import CONTAINER_PROVIDER_KEY
 from container_service_extension.ovdc_cache import CtrProvType
 from container_service_extension.ovdc_cache import OvdcCache
 from container_service_extension.pksbroker import PKSBroker
+from container_service_extension.single_flight import SingleFlight
 from container_service_extension.utils import ACCEPTED
+from container_service_extension.utils import BACKEND_STATUS_HEADER
+from container_service_extension.utils import compute_etag
 from container_service_extension.utils import connect_vcd_user_via_token
 from container_service_extension.utils import exception_handler
+from container_service_extension.utils import get_header
 from container_service_extension.utils import get_pks_cache
 from container_service_extension.utils import get_server_runtime_config
 from container_service_extension.utils import get_vcd_sys_admin_client
+from container_service_extension.utils import is_etag_matched
+from container_service_extension.utils import NOT_MODIFIED
 from container_service_extension.utils import OK
+from container_service_extension.utils import release_vcd_sys_admin_client
+from container_service_extension.utils import SerializedBody
 from container_service_extension.vcdbroker import VcdBroker
 
 
@@ -51,6 +67,150 @@ class Operation(Enum):
     GET_CLUSTER_CONFIG = 'get cluster config'
 
 
+# Coalesces identical concurrent list requests, which vCD UI pages tend to
+# fire in bursts, into one backend computation.
+READ_SINGLE_FLIGHT = SingleFlight()
+
+# Threads, shared by all requests, calling vCD and the PKS accounts of an org
+# at once. Time spent waiting for a free thread counts towards the backend
+# timeout.
+BACKEND_FAN_OUT_WORKERS = 32
+BACKEND_FAN_OUT_EXECUTOR = ThreadPoolExecutor(
+    max_workers=BACKEND_FAN_OUT_WORKERS, thread_name_prefix='BackendFanOut')
+
+# Properties of clusters listed across vCD and PKS.
+COMMON_CLUSTER_PROPERTIES = ('name', 'vdc', 'status')
+
+
+class BackendCall(namedtuple('BackendCall', 'backend, future, start_time')):
+    """A call to a backend submitted to BACKEND_FAN_OUT_EXECUTOR."""
+
+
+def submit_backend_call(backend, func, *args, **kwargs):
+    """Start calling func(*args, **kwargs) on BACKEND_FAN_OUT_EXECUTOR.
+
+    :param str backend: name of the backend called, e.g. 'vcd'.
+    :param callable func: function calling the backend.
+
+    :return: the call, to be passed to gather_backend_calls().
+
+    :rtype: BackendCall
+    """
+    return BackendCall(
+        backend,
+        BACKEND_FAN_OUT_EXECUTOR.submit(_time_backend_call, backend, func,
+                                        *args, **kwargs),
+        time.monotonic())
+
+
+def gather_backend_calls(calls, timeout):
+    """Wait for the outcome of backend calls, each within its deadline.
+
+    Calls still running once their deadline is past are given up on. They
+    are left to finish in the background, their result is discarded.
+
+    The time waited for the calls is accounted to the backend time of the
+    request processed on this thread.
+
+    :param list calls: BackendCall objects of submit_backend_call().
+    :param float timeout: seconds after its submission a call is given up
+        on, 0 means no limit.
+
+    :return: list of (result, error, status) tuples, in the order of @calls.
+        result is None and error is the exception raised if the call failed
+        or timed out. status is a dict with keys 'backend', 'seconds' and
+        'error', the message of the error or None.
+
+    :rtype: list
+    """
+    outcomes = []
+    try:
+        for call in calls:
+            remaining = None
+            if timeout > 0:
+                remaining = max(call.start_time + timeout - time.monotonic(),
+                                0)
+            try:
+                result, error, seconds = call.future.result(timeout=remaining)
+            except TimeoutError:
+                call.future.cancel()
+                result = None
+                error = CseServerError(f"{call.backend} did not reply within "
+                                       f"{timeout} seconds")
+                seconds = time.monotonic() - call.start_time
+            outcomes.append((result, error, {
+                'backend': call.backend,
+                'seconds': round(seconds, 3),
+                'error': None if error is None else str(error)
+            }))
+    finally:
+        _account_backend_wait(calls)
+    return outcomes
+
+
+def race_backend_calls(calls, timeout):
+    """Wait for the first backend call to succeed.
+
+    The calls not started yet are cancelled once one succeeds, those running
+    are left to finish in the background, their result is discarded.
+
+    The time waited for the calls is accounted to the backend time of the
+    request processed on this thread.
+
+    :param list calls: BackendCall objects of submit_backend_call().
+    :param float timeout: seconds after the last submission the calls are
+        given up on, 0 means no limit.
+
+    :return: the result of the first call to succeed, or None if all failed.
+
+    :raises CseServerError: if no call succeeded and some did not complete
+        in time, so that a failure can't be told apart from a slow backend.
+    """
+    remaining = None
+    if timeout > 0:
+        deadline = max(call.start_time for call in calls) + timeout
+        remaining = max(deadline - time.monotonic(), 0)
+    backends = {call.future: call.backend for call in calls}
+    try:
+        for future in as_completed(backends, timeout=remaining):
+            result, error, _ = future.result()
+            if error is None:
+                return result
+    except TimeoutError:
+        pending = [backend for future, backend in backends.items()
+                   if not future.done()]
+        raise CseServerError(f"{', '.join(pending)} did not reply within "
+                             f"{timeout} seconds")
+    finally:
+        for call in calls:
+            call.future.cancel()
+        _account_backend_wait(calls)
+    return None
+
+
+def _account_backend_wait(calls):
+    """Add the time waited for backend calls to the request of this thread.
+
+    The calls run at once, so the time from the first submission until now
+    is accounted, rather than the sum of the times of the calls, which would
+    exceed the time of the request.
+
+    :param list calls: BackendCall objects of submit_backend_call().
+    """
+    if calls:
+        add_request_backend_time(
+            time.monotonic() - min(call.start_time for call in calls))
+
+
+def _time_backend_call(backend, func, *args, **kwargs):
+    start = time.monotonic()
+    try:
+        return func(*args, **kwargs), None, time.monotonic() - start
+    except Exception as err:
+        LOGGER.debug(f"Call to {backend} failed with error: {err}")
+        return None, err, time.monotonic() - start
+
+
 class BrokerManager(object):
     """Manage calls to vCD and PKS brokers.
 
@@ -64,13 +224,24 @@ class BrokerManager(object):
         self.req_qparams = request_query_params
         self.req_spec = request_spec
         self.pks_cache = get_pks_cache()
-        self.ovdc_cache = OvdcCache(get_vcd_sys_admin_client())
         self.is_ovdc_present_in_request = False
         config = get_server_runtime_config()
         self.vcd_client, self.session = connect_vcd_user_via_token(
             vcd_uri=config['vcd']['host'],
             headers=self.req_headers,
             verify_ssl_certs=config['vcd']['verify'])
+        # checked out last, so that it's released by close() whatever fails
+        self.ovdc_cache = OvdcCache(get_vcd_sys_admin_client())
+
+    def close(self):
+        """Release the system administrator session of the manager.
+
+        The manager must not be used afterwards. invoke() closes the manager
+        itself.
+        """
+        if self.ovdc_cache.client is not None:
+            release_vcd_sys_admin_client(self.ovdc_cache.client)
+            self.ovdc_cache.client = None
 
     @exception_handler
     def invoke(self, op):
@@ -90,6 +261,32 @@ class BrokerManager(object):
 
         :return result: HTTP response
 
+        :rtype: dict
+        """
+        try:
+            return self._invoke(op)
+        finally:
+            self.close()
+
+    def _invoke(self, op):
+        """Perform the operation, see invoke().
+
+        GET_CLUSTER and LIST_CLUSTERS replies carry an ETag, and requests
+        with a matching If-None-Match header are replied 304 Not Modified.
+
+        A conditional GET_CLUSTER looks the cluster up once, and lists the
+        nodes of vCD clusters only if the tag doesn't match.
+
+        The tag of LIST_CLUSTERS is computed over the serialized list, so a
+        conditional request costs as many backend calls as a plain one, and
+        a 304 reply only spares sending the list. This is cheap only because
+        vCD clusters are listed with a single query, without the metadata of
+        their vApps.
+
+        :param Operation op: Operation to be performed by one of the brokers.
+
+        :return result: HTTP response
+
         :rtype: dict
         """
         result = {}
@@ -119,9 +316,32 @@ class BrokerManager(object):
         elif op == Operation.GET_CLUSTER:
             cluster_spec = \
                 {'cluster_name': self.req_spec.get('cluster_name', None)}
-            result['body'] = self._get_cluster_info(**cluster_spec)[0]
+            if_none_match = get_header(self.req_headers, 'If-None-Match')
+            # the nodes of vCD clusters, which the tag doesn't depend on, are
+            # listed once the tag is known not to match
+            cluster, broker = self._get_cluster_info(
+                is_node_info_required=not if_none_match, **cluster_spec)
+            etag = broker.get_cluster_version_tag(
+                cluster_spec['cluster_name'], cluster_info=cluster)
+            if if_none_match:
+                if is_etag_matched(if_none_match, etag):
+                    return self._not_modified(etag)
+                if isinstance(broker, VcdBroker):
+                    broker.load_cluster_nodes(cluster)
+            result['body'] = cluster
+            result['headers'] = {'ETag': etag}
         elif op == Operation.LIST_CLUSTERS:
-            result['body'] = self._list_clusters()
+            # The list is serialized once, both to tag it and to send it.
+            body, backend_status = READ_SINGLE_FLIGHT.do(
+                self._get_single_flight_key(op), self._serialize_clusters)
+            etag = compute_etag(body)
+            if is_etag_matched(
+                    get_header(self.req_headers, 'If-None-Match'), etag):
+                return self._not_modified(etag)
+            result['body'] = body
+            result['headers'] = {'ETag': etag}
+            if backend_status is not None:
+                result['headers'][BACKEND_STATUS_HEADER] = backend_status
         elif op == Operation.DELETE_CLUSTER:
             cluster_spec = \
                 {'cluster_name': self.req_spec.get('cluster_name', None)}
@@ -164,42 +384,96 @@ class BrokerManager(object):
             result['body'] = self._create_cluster(**cluster_spec)
             result['status_code'] = ACCEPTED
         elif op == Operation.LIST_OVDCS:
-            result['body'] = self._list_ovdcs()
+            result['body'] = READ_SINGLE_FLIGHT.do(
+                self._get_single_flight_key(op),
+                lambda: SerializedBody(json_dumps(self._list_ovdcs())))
 
         return result
 
+    def _get_single_flight_key(self, op):
+        """Get the key identifying requests that yield the same result.
+
+        System administrators all see the same clusters and ovdcs. What other
+        users see depends on their rights and on cluster ownership, hence
+        their requests are only coalesced with requests of the same user.
+
+        :param Operation op: Operation to be performed.
+
+        :return: hashable key
+
+        :rtype: tuple
+        """
+        if self.vcd_client.is_sysadmin():
+            scope = (self.session.get('org'), None)
+        else:
+            scope = (self.session.get('org'), self.session.get('userId'))
+        return (op, scope,
+                tuple(sorted(self.req_qparams.items())),
+                tuple(sorted((k, str(v)) for k, v in self.req_spec.items())))
+
+    def _serialize_clusters(self):
+        """List clusters and serialize them, along with backend status.
+
+        :return: a tuple of the SerializedBody of the list of clusters and
+            the status of the brokers serialized as JSON, or None if all
+            brokers replied.
+
+        :rtype: tuple
+        """
+        clusters, backend_status = self._list_clusters()
+        if backend_status is not None:
+            backend_status = json_dumps(backend_status)
+        return SerializedBody(json_dumps(clusters)), backend_status
+
+    def _not_modified(self, etag):
+        """Construct the reply to a conditional request of a current copy.
+
+        :param str etag: entity tag of the current representation.
+
+        :return: HTTP response
+
+        :rtype: dict
+        """
+        return {
+            'status_code': NOT_MODIFIED,
+            'body': SerializedBody(),
+            'headers': {'ETag': etag}
+        }
+
     def _list_ovdcs(self):
         """Get list of ovdcs.
 
         If client is sysadmin,
             Gets all ovdcs of all organizations.
         Else
-            Gets all ovdcs of the organization in context.
+            Gets the ovdcs of the organization in context that the user can
+            see.
         """
+        visible_ovdc_names = None
         if self.vcd_client.is_sysadmin():
-            org_resource_list = self.vcd_client.get_org_list()
+            org_name = None
         else:
-            org_resource_list = list(self.vcd_client.get_org())
+            org_name = self.session.get('org')
+            # the ovdcs are listed as system administrator, which sees more
+            # of them than the user
+            org = Org(self.vcd_client, resource=self.vcd_client.get_org())
+            visible_ovdc_names = {vdc['name'] for vdc in org.list_vdcs()}
 
         ovdc_list = []
-        for org_resource in org_resource_list:
-            org = Org(self.vcd_client, resource=org_resource)
-            vdc_list = org.list_vdcs()
-            for vdc in vdc_list:
-                ctr_prov_ctx = \
-                    self.ovdc_cache.get_ovdc_container_provider_metadata(
-                        ovdc_name=vdc['name'], org_name=org.get_name(),
-                        credentials_required=False)
-                vdc_dict = {
-                    'org': org.get_name(),
-                    'name': vdc['name'],
-                    CONTAINER_PROVIDER_KEY:
-                        ctr_prov_ctx[CONTAINER_PROVIDER_KEY]
-                }
-                ovdc_list.append(vdc_dict)
+        for ovdc_org_name, ovdc_name, container_provider in \
+                self.ovdc_cache.list_ovdc_container_providers(org_name):
+            if visible_ovdc_names is not None and \
+                    ovdc_name not in visible_ovdc_names:
+                continue
+            vdc_dict = {
+                'org': ovdc_org_name,
+                'name': ovdc_name,
+                CONTAINER_PROVIDER_KEY: container_provider
+            }
+            ovdc_list.append(vdc_dict)
         return ovdc_list
 
-    def _get_cluster_info(self, **cluster_spec):
+    def _get_cluster_info(self, is_node_info_required=True, **cluster_spec):
         """Get cluster details directly from cloud provider.
 
         Logic of the method is as follows.
@@ -210,6 +484,9 @@ class BrokerManager(object):
         else
             Invoke set of all (vCD/PKS) brokers in the org to find the cluster
 
+        :param bool is_node_info_required: if False, vCD clusters lack their
+            nodes, see VcdBroker.load_cluster_nodes().
+
         :return: a tuple of cluster information as dictionary and the broker
             instance used to find the cluster information.
 
@@ -218,9 +495,13 @@ class BrokerManager(object):
         cluster_name = cluster_spec['cluster_name']
         if self.is_ovdc_present_in_request:
             broker = self.get_broker_based_on_vdc()
+            if isinstance(broker, VcdBroker):
+                return broker.get_cluster_info(
+                    cluster_name, include_nodes=is_node_info_required), broker
             return broker.get_cluster_info(cluster_name=cluster_name), broker
         else:
-            cluster, broker = self._find_cluster_in_org(cluster_name)
+            cluster, broker = self._find_cluster_in_org(
+                cluster_name, is_node_info_required=is_node_info_required)
             if cluster:
                 return cluster, broker
 
@@ -241,7 +522,8 @@ class BrokerManager(object):
             broker = self.get_broker_based_on_vdc()
             return broker.get_cluster_config(cluster_name=cluster_name)
         else:
-            cluster, broker = self._find_cluster_in_org(cluster_name)
+            cluster, broker = self._find_cluster_in_org(
+                cluster_name, is_node_info_required=False)
             if cluster:
                 return broker.get_cluster_config(cluster_name=cluster['name'])
 
@@ -255,34 +537,70 @@ class BrokerManager(object):
             choose the right broker (by identifying the container_provider
             (vcd|pks) defined for that ovdc) to do list_clusters operation.
         Else
-            Invoke set of all (vCD/PKS)brokers in the org to do list_clusters.
+            Invoke set of all (vCD/PKS)brokers in the org at once to do
+            list_clusters, each within 'backend_timeout' seconds.
             Post-process the result returned by each broker.
-            Aggregate all the results into one.
+            Aggregate the results of the brokers that replied into one.
+
+        :return: a tuple of the list of clusters and, if some brokers failed
+            or timed out, the list of the status of all brokers as returned
+            by gather_backend_calls(), or None.
+
+        :rtype: tuple
+
+        :raises Exception: the error of the vCD broker if all brokers failed.
         """
         if self.is_ovdc_present_in_request:
             broker = self.get_broker_based_on_vdc()
-            return broker.list_clusters()
-        else:
-            common_cluster_properties = ('name', 'vdc', 'status')
-            vcd_broker = VcdBroker(self.req_headers, self.req_spec)
-            vcd_clusters = []
-            for cluster in vcd_broker.list_clusters():
-                vcd_cluster = {k: cluster.get(k, None) for k in
-                               common_cluster_properties}
-                vcd_cluster[CONTAINER_PROVIDER_KEY] = CtrProvType.VCD.value
-                vcd_clusters.append(vcd_cluster)
-
-            pks_clusters = []
-            pks_ctx_list = self._create_pks_context_for_all_accounts_in_org()
-            for pks_ctx in pks_ctx_list:
-                pks_broker = PKSBroker(self.req_headers, self.req_spec,
-                                       pks_ctx)
-                for cluster in pks_broker.list_clusters():
-                    pks_cluster = self._get_truncated_cluster_info(
-                        cluster, pks_broker, common_cluster_properties)
-                    pks_cluster[CONTAINER_PROVIDER_KEY] = CtrProvType.PKS.value
-                    pks_clusters.append(pks_cluster)
-            return vcd_clusters + pks_clusters
+            return broker.list_clusters(), None
+
+        # vCD is listed while the PKS accounts of the org are looked up
+        calls = [submit_backend_call(CtrProvType.VCD.value,
+                                     self._list_vcd_clusters)]
+        for pks_ctx in self._create_pks_context_for_all_accounts_in_org():
+            calls.append(submit_backend_call(
+                f"{CtrProvType.PKS.value}:{pks_ctx['account_name']}",
+                self._list_pks_clusters, pks_ctx))
+        config = get_server_runtime_config()
+        outcomes = gather_backend_calls(
+            calls, config['service']['backend_timeout'])
+
+        clusters = []
+        for result, error, status in outcomes:
+            if error is None:
+                clusters.extend(result)
+            else:
+                LOGGER.error(f"List clusters failed on {status['backend']} "
+                             f"with error: {error}")
+        if all(error is not None for _, error, _ in outcomes):
+            raise outcomes[0][1]
+        if any(error is not None for _, error, _ in outcomes):
+            return clusters, [status for _, _, status in outcomes]
+        return clusters, None
+
+    def _list_vcd_clusters(self):
+        vcd_broker = VcdBroker(self.req_headers, self.req_spec)
+        vcd_clusters = []
+        # only COMMON_CLUSTER_PROPERTIES are listed, none of which is kept in
+        # the metadata of the vApps
+        for cluster in vcd_broker.list_clusters(include_metadata=False):
+            self._index_cluster(cluster['name'], vcd_broker)
+            vcd_cluster = {k: cluster.get(k, None) for k in
+                           COMMON_CLUSTER_PROPERTIES}
+            vcd_cluster[CONTAINER_PROVIDER_KEY] = CtrProvType.VCD.value
+            vcd_clusters.append(vcd_cluster)
+        return vcd_clusters
+
+    def _list_pks_clusters(self, pks_ctx):
+        pks_broker = PKSBroker(self.req_headers, self.req_spec, pks_ctx)
+        pks_clusters = []
+        for cluster in pks_broker.list_clusters():
+            pks_cluster = self._get_truncated_cluster_info(
+                cluster, pks_broker, COMMON_CLUSTER_PROPERTIES)
+            self._index_cluster(pks_cluster['name'], pks_broker)
+            pks_cluster[CONTAINER_PROVIDER_KEY] = CtrProvType.PKS.value
+            pks_clusters.append(pks_cluster)
+        return pks_clusters
 
     def _resize_cluster(self, **cluster_spec):
         cluster, broker = self._get_cluster_info(**cluster_spec)
@@ -290,46 +608,124 @@ class BrokerManager(object):
 
     def _delete_cluster(self, **cluster_spec):
         cluster_name = cluster_spec['cluster_name']
-        _, broker = self._get_cluster_info(**cluster_spec)
-        return broker.delete_cluster(cluster_name=cluster_name)
+        _, broker = self._get_cluster_info(is_node_info_required=False,
+                                           **cluster_spec)
+        result = broker.delete_cluster(cluster_name=cluster_name)
+        CLUSTER_INDEX.remove(self.session.get('org'), cluster_name)
+        return result
 
     def _create_cluster(self, **cluster_spec):
         cluster_name = cluster_spec['cluster_name']
-        cluster = self._find_cluster_in_org(cluster_name)[0]
+        cluster = self._find_cluster_in_org(
+            cluster_name, is_node_info_required=False)[0]
         if not cluster:
             broker = self.get_broker_based_on_vdc()
-            return broker.create_cluster(**cluster_spec)
+            result = broker.create_cluster(**cluster_spec)
+            self._index_cluster(cluster_name, broker)
+            return result
         else:
             raise CseServerError(f'Cluster with name: {cluster_name} '
                                  f'already found')
 
-    def _find_cluster_in_org(self, cluster_name):
+    def _find_cluster_in_org(self, cluster_name, is_node_info_required=True):
         """Invoke set of all (vCD/PKS)brokers in the org to find the cluster.
 
+        The brokers are asked at once, the first one to find the cluster
+        wins.
+
         If cluster found:
             Return a tuple of (cluster and the broker instance used to find
             the cluster)
         Else:
             (None, None) if cluster not found.
+
+        :param str cluster_name: name of the cluster.
+        :param bool is_node_info_required: if False, vCD clusters are found
+            without their nodes, which is enough to pick the broker.
+
+        :raises CseServerError: if the cluster isn't found but some broker
+            did not reply within 'backend_timeout' seconds.
         """
-        vcd_broker = VcdBroker(self.req_headers, self.req_spec)
-        try:
-            return vcd_broker.get_cluster_info(cluster_name), vcd_broker
-        except Exception as err:
-            LOGGER.debug(f"Get cluster info on {cluster_name} failed "
-                         f"on vCD with error: {err}")
-
-        pks_ctx_list = self._create_pks_context_for_all_accounts_in_org()
-        for pks_ctx in pks_ctx_list:
-            pksbroker = PKSBroker(self.req_headers, self.req_spec, pks_ctx)
+        org_name = self.session.get('org')
+        location = CLUSTER_INDEX.get(org_name, cluster_name)
+        if location is not None:
+            # the broker of the indexed location still looks the cluster up,
+            # the other brokers are searched only if it's no longer there
             try:
-                return pksbroker.get_cluster_info(cluster_name=cluster_name),\
-                    pksbroker
+                broker = self._get_broker_at(location)
+                if isinstance(broker, VcdBroker):
+                    return broker.get_cluster_info(
+                        cluster_name,
+                        include_nodes=is_node_info_required), broker
+                return broker.get_cluster_info(cluster_name=cluster_name), \
+                    broker
             except Exception as err:
-                LOGGER.debug(f"Get cluster info on {cluster_name} failed "
-                             f"on {pks_ctx['host']} with error: {err}")
+                LOGGER.debug(f"Cluster {cluster_name} not found at its "
+                             f"indexed location {location}: {err}")
+                CLUSTER_INDEX.remove(org_name, cluster_name)
+
+        # vCD is searched while the PKS accounts of the org are looked up
+        calls = [submit_backend_call(
+            CtrProvType.VCD.value, self._find_vcd_cluster, cluster_name,
+            is_node_info_required)]
+        for pks_ctx in self._create_pks_context_for_all_accounts_in_org():
+            calls.append(submit_backend_call(
+                f"{CtrProvType.PKS.value}:{pks_ctx['account_name']}",
+                self._find_pks_cluster, cluster_name, pks_ctx))
+        config = get_server_runtime_config()
+        cluster, broker = race_backend_calls(
+            calls, config['service']['backend_timeout']) or (None, None)
+        if cluster:
+            self._index_cluster(cluster_name, broker)
+        return cluster, broker
+
+    def _find_vcd_cluster(self, cluster_name, is_node_info_required):
+        vcd_broker = VcdBroker(self.req_headers, self.req_spec)
+        return vcd_broker.get_cluster_info(
+            cluster_name, include_nodes=is_node_info_required), vcd_broker
+
+    def _find_pks_cluster(self, cluster_name, pks_ctx):
+        pks_broker = PKSBroker(self.req_headers, self.req_spec, pks_ctx)
+        return pks_broker.get_cluster_info(cluster_name=cluster_name), \
+            pks_broker
 
-        return None, None
+    def _index_cluster(self, cluster_name, broker):
+        """Record in CLUSTER_INDEX where the user found a cluster.
+
+        :param str cluster_name: name of the cluster.
+        :param broker: the broker that found or created the cluster.
+        """
+        if isinstance(broker, PKSBroker):
+            location = ClusterLocation(CtrProvType.PKS.value,
+                                       broker.pks_ctx['account_name'])
+        else:
+            location = ClusterLocation(CtrProvType.VCD.value, None)
+        CLUSTER_INDEX.put(self.session.get('org'), cluster_name, location)
+
+    def _get_broker_at(self, location):
+        """Get the broker of a cluster location of CLUSTER_INDEX.
+
+        :param ClusterLocation location: the location.
+
+        :return: broker
+
+        :rtype: container_service_extension.abstract_broker.AbstractBroker
+
+        :raises CseServerError: if the PKS account of the location is no
+            longer configured.
+        """
+        if location.provider == CtrProvType.VCD.value:
+            return VcdBroker(self.req_headers, self.req_spec)
+        pks_account_info = None
+        if self.pks_cache:
+            pks_account_info = self.pks_cache.get_pks_account_info_by_name(
+                location.pks_account_name)
+        if pks_account_info is None:
+            raise CseServerError(f"PKS account {location.pks_account_name} "
+                                 f"is not configured")
+        pks_ctx = OvdcCache.construct_pks_context(pks_account_info,
+                                                  credentials_required=True)
+        return PKSBroker(self.req_headers, self.req_spec, pks_ctx)
 
     def _create_pks_context_for_all_accounts_in_org(self):
         """Create PKS context for accounts in a given Org.
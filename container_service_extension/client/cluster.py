@@ -2,11 +2,14 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import json
+
 import requests
 
 from container_service_extension.cluster import TYPE_NODE
 from container_service_extension.exceptions import CseClientError
 from container_service_extension.exceptions import VcdResponseError
+from container_service_extension.utils import BACKEND_STATUS_HEADER
 from container_service_extension.utils import ERROR_UNKNOWN
 from container_service_extension.utils import process_response
 from container_service_extension.utils import response_to_exception
@@ -31,6 +34,18 @@ class Cluster(object):
         return process_response(response)
 
     def get_clusters(self, vdc=None, org=None):
+        return self.get_clusters_with_backend_status(vdc=vdc, org=org)[0]
+
+    def get_clusters_with_backend_status(self, vdc=None, org=None):
+        """Get the list of clusters, along with the status of the backends.
+
+        :return: a tuple of the list of clusters and, if the clusters of
+            some backends are missing because they failed or timed out, the
+            list of the status of all backends, else None. A status is a
+            dict with keys 'backend', 'seconds' and 'error'.
+
+        :rtype: tuple
+        """
         method = 'GET'
         uri = self._uri
         params = {}
@@ -47,7 +62,11 @@ class Cluster(object):
             accept_type='application/*+json',
             auth=None,
             params=params)
-        return process_response(response)
+        clusters = process_response(response)
+        backend_status = response.headers.get(BACKEND_STATUS_HEADER)
+        if backend_status is not None:
+            backend_status = json.loads(backend_status)
+        return clusters, backend_status
 
     def get_cluster_info(self, name, vdc=None):
         method = 'GET'
@@ -224,8 +224,14 @@ def list_clusters(ctx, vdc, org):
             org = ctx.obj['profiles'].get('org_in_use')
         client = ctx.obj['client']
         cluster = Cluster(client)
-        result = cluster.get_clusters(vdc=vdc, org=org)
+        result, backend_status = cluster.get_clusters_with_backend_status(
+            vdc=vdc, org=org)
         stdout(result, ctx, show_id=True)
+        for status in backend_status or []:
+            if status['error'] is not None:
+                click.secho(f"Clusters on {status['backend']} are missing "
+                            f"from the list: {status['error']}",
+                            fg='yellow', err=True)
     except Exception as e:
         stderr(e, ctx)
 
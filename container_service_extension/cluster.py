@@ -18,6 +18,8 @@ from container_service_extension.exceptions import DeleteNodeError
 from container_service_extension.exceptions import NodeCreationError
 from container_service_extension.exceptions import ScriptExecutionError
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import backend_call
+from container_service_extension.metrics import BACKEND_VSPHERE
 from container_service_extension.utils import get_data_file
 from container_service_extension.utils import get_vsphere
 
@@ -40,7 +42,17 @@ def wait_until_tools_ready(vm):
             time.sleep(1)
 
 
-def load_from_metadata(client, name=None, cluster_id=None):
+def load_from_metadata(client, name=None, cluster_id=None,
+                       include_metadata=True):
+    """Query the vApps of clusters.
+
+    :param bool include_metadata: if False, the query doesn't fetch the CSE
+        metadata of the vApps, which is its costly part. 'leader_endpoint',
+        'template', 'cse_version' and 'cluster_id' of the clusters are then
+        left empty.
+
+    :return: (list): dicts describing the clusters.
+    """
     if cluster_id is None:
         query_filter = 'metadata:cse.cluster.id==STRING:*'
     else:
@@ -50,12 +62,15 @@ def load_from_metadata(client, name=None, cluster_id=None):
     resource_type = 'vApp'
     if client.is_sysadmin():
         resource_type = 'adminVApp'
+    fields = None
+    if include_metadata:
+        fields = 'metadata:cse.cluster.id,metadata:cse.master.ip,' \
+                 'metadata:cse.version,metadata:cse.template'
     q = client.get_typed_query(
         resource_type,
         query_result_format=QueryResultFormat.ID_RECORDS,
         qfilter=query_filter,
-        fields='metadata:cse.cluster.id,metadata:cse.master.ip,'
-               'metadata:cse.version,metadata:cse.template')
+        fields=fields)
     records = list(q.execute())
 
     clusters = []
@@ -66,9 +81,9 @@ def load_from_metadata(client, name=None, cluster_id=None):
         cluster = {
             'name': record.get('name'),
             'vapp_id': vapp_id,
-            'vapp_href': f'{client._uri}/vApp/vapp-{vapp_id}',
+            'vapp_href': f'{client.get_api_uri()}/vApp/vapp-{vapp_id}',
             'vdc_name': record.get('vdcName'),
-            'vdc_href': f'{client._uri}/vdc/{vdc_id}',
+            'vdc_href': f'{client.get_api_uri()}/vdc/{vdc_id}',
             'leader_endpoint': '',
             'master_nodes': [],
             'nodes': [],
@@ -310,17 +325,18 @@ uname -a
 """ # NOQA
     for n in range(tries):
         try:
-            result = vs.execute_script_in_guest(
-                vm,
-                'root',
-                password,
-                script,
-                target_file=None,
-                wait_for_completion=True,
-                wait_time=5,
-                get_output=True,
-                delete_script=True,
-                callback=wait_for_guest_execution_callback)
+            with backend_call(BACKEND_VSPHERE):
+                result = vs.execute_script_in_guest(
+                    vm,
+                    'root',
+                    password,
+                    script,
+                    target_file=None,
+                    wait_for_completion=True,
+                    wait_time=5,
+                    get_output=True,
+                    delete_script=True,
+                    callback=wait_for_guest_execution_callback)
             if result[0] == 0:
                 ready = True
                 break
@@ -349,7 +365,8 @@ def execute_script_in_nodes(config,
         LOGGER.debug(f"will try to execute script on {node.get('name')}:\n"
                      f"{debug_script}")
         vs = get_vsphere(config, vapp, node.get('name'))
-        vs.connect()
+        with backend_call(BACKEND_VSPHERE):
+            vs.connect()
         moid = vapp.get_vm_moid(node.get('name'))
         vm = vs.get_vm_by_moid(moid)
         if check_tools:
@@ -360,29 +377,31 @@ def execute_script_in_nodes(config,
         LOGGER.debug(f"about to execute script on {node.get('name')} (vm={vm})"
                      f", wait={wait}")
         if wait:
-            result = vs.execute_script_in_guest(
-                vm,
-                'root',
-                password,
-                script,
-                target_file=None,
-                wait_for_completion=True,
-                wait_time=10,
-                get_output=True,
-                delete_script=True,
-                callback=wait_for_guest_execution_callback)
-            result_stdout = result[1].content.decode()
-            result_stderr = result[2].content.decode()
-        else:
-            result = [
-                vs.execute_program_in_guest(
+            with backend_call(BACKEND_VSPHERE):
+                result = vs.execute_script_in_guest(
                     vm,
                     'root',
                     password,
                     script,
-                    wait_for_completion=False,
-                    get_output=False)
-            ]
+                    target_file=None,
+                    wait_for_completion=True,
+                    wait_time=10,
+                    get_output=True,
+                    delete_script=True,
+                    callback=wait_for_guest_execution_callback)
+            result_stdout = result[1].content.decode()
+            result_stderr = result[2].content.decode()
+        else:
+            with backend_call(BACKEND_VSPHERE):
+                result = [
+                    vs.execute_program_in_guest(
+                        vm,
+                        'root',
+                        password,
+                        script,
+                        wait_for_completion=False,
+                        get_output=False)
+                ]
             result_stdout = ''
             result_stderr = ''
         LOGGER.debug(result[0])
@@ -402,14 +421,17 @@ def get_file_from_nodes(config,
     for node in nodes:
         LOGGER.debug(f"getting file from node {node.get('name')}")
         vs = get_vsphere(config, vapp, node.get('name'))
-        vs.connect()
+        with backend_call(BACKEND_VSPHERE):
+            vs.connect()
         moid = vapp.get_vm_moid(node.get('name'))
         vm = vs.get_vm_by_moid(moid)
         if check_tools:
             vs.wait_until_tools_ready(
                 vm, sleep=5, callback=wait_for_tools_ready_callback)
             wait_until_ready_to_exec(vs, vm, password)
-        result = vs.download_file_from_guest(vm, 'root', password, file_name)
+        with backend_call(BACKEND_VSPHERE):
+            result = vs.download_file_from_guest(vm, 'root', password,
+                                                 file_name)
         all_results.append(result)
     return all_results
 
@@ -0,0 +1,82 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+from collections import namedtuple
+import threading
+
+from cachetools import LRUCache
+
+from container_service_extension.metrics import METRICS
+
+CLUSTER_INDEX_SIZE = 4096
+
+
+class ClusterLocation(namedtuple('ClusterLocation',
+                                 'provider, pks_account_name')):
+    """Where a cluster was last found.
+
+    provider: container provider of the cluster, 'vcd' or 'pks'.
+    pks_account_name: name of the PKS account of PKS clusters.
+    """
+
+
+class ClusterIndex(object):
+    """Index of the location of clusters, shared by all requests.
+
+    Entries are keyed by (org name, cluster name), the org being the one of
+    the users looking for the cluster. They are hints: the broker of a
+    location still looks the cluster up, and callers drop entries that turn
+    out to be wrong. The least recently used entries are evicted once the
+    index is full.
+    """
+
+    def __init__(self, maxsize=CLUSTER_INDEX_SIZE):
+        self._lock = threading.Lock()
+        # mapping of (org name, cluster name) -> ClusterLocation
+        self._index = LRUCache(maxsize=maxsize)
+        self.stats = METRICS.get_cache_stats('cluster_location')
+
+    def get(self, org_name, cluster_name):
+        """Get the location of a cluster.
+
+        :param str org_name: name of the org of the user.
+        :param str cluster_name: name of the cluster.
+
+        :return: the location, None if not indexed.
+
+        :rtype: ClusterLocation
+        """
+        with self._lock:
+            location = self._index.get((org_name, cluster_name))
+        if location is None:
+            self.stats.miss()
+        else:
+            self.stats.hit()
+        return location
+
+    def put(self, org_name, cluster_name, location):
+        """Index the location of a cluster.
+
+        :param str org_name: name of the org of the user.
+        :param str cluster_name: name of the cluster.
+        :param ClusterLocation location: the location.
+        """
+        with self._lock:
+            self._index[(org_name, cluster_name)] = location
+
+    def remove(self, org_name, cluster_name):
+        """Drop the location of a cluster, if indexed.
+
+        :param str org_name: name of the org of the user.
+        :param str cluster_name: name of the cluster.
+        """
+        with self._lock:
+            self._index.pop((org_name, cluster_name), None)
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+
+
+CLUSTER_INDEX = ClusterIndex()
@@ -0,0 +1,235 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""Encoding and decoding of the AMQP messages exchanged with vCD.
+
+A request message carries a JSON envelope, whose body is in turn base64
+encoded JSON. Replies are encoded the same way.
+
+JSON is handled by the fastest available backend: orjson if it is installed,
+else the json module of the standard library.
+"""
+
+import base64
+from collections import namedtuple
+import gzip
+import json
+from urllib.parse import parse_qsl
+
+from container_service_extension.utils import get_header
+from container_service_extension.utils import is_encoding_accepted
+from container_service_extension.utils import SerializedBody
+
+# gzip compression level of reply bodies, favoring speed over ratio
+REPLY_COMPRESSION_LEVEL = 6
+
+
+class JsonBackend(namedtuple('JsonBackend', 'name, loads, dumps')):
+    """A JSON library.
+
+    name: name of the library.
+    loads: callable that deserializes a str or bytes object.
+    dumps: callable that serializes an object to a str.
+    """
+
+
+def _get_json_backends():
+    """Get the JSON backends available, fastest first.
+
+    :return: mapping of backend name -> JsonBackend
+
+    :rtype: dict
+    """
+    backends = {}
+    try:
+        import orjson
+
+        def orjson_dumps(obj):
+            return orjson.dumps(obj,
+                                option=orjson.OPT_NON_STR_KEYS).decode()
+
+        backends['orjson'] = JsonBackend('orjson', orjson.loads, orjson_dumps)
+    except ImportError:
+        pass
+    backends['json'] = JsonBackend('json', json.loads, json.dumps)
+    return backends
+
+
+JSON_BACKENDS = _get_json_backends()
+
+_json_backend = next(iter(JSON_BACKENDS.values()))
+
+
+def get_json_backend():
+    """Get the JSON backend in use.
+
+    :rtype: JsonBackend
+    """
+    return _json_backend
+
+
+def set_json_backend(name):
+    """Select the JSON backend to use.
+
+    :param str name: name of one of the JSON_BACKENDS.
+
+    :raises KeyError: if the backend is not available.
+    """
+    global _json_backend
+    _json_backend = JSON_BACKENDS[name]
+
+
+def json_loads(data):
+    """Deserialize JSON with the backend in use.
+
+    :param data: str or bytes object holding a JSON document.
+    """
+    return _json_backend.loads(data)
+
+
+def json_dumps(obj):
+    """Serialize an object to JSON with the backend in use.
+
+    :rtype: str
+    """
+    return _json_backend.dumps(obj)
+
+
+class Request(object):
+    """A request received from vCD.
+
+    The envelope is decoded once, on construction. The query string and the
+    body are decoded when first asked for.
+    """
+
+    __slots__ = ['envelope', 'received_at', '_query_params', '_spec']
+
+    def __init__(self, envelope, received_at=None):
+        """Wrap a request envelope.
+
+        :param dict envelope: request envelope, as decoded from the AMQP
+            message.
+        :param float received_at: time.perf_counter() value at the receipt
+            of the request, if known.
+        """
+        self.envelope = envelope
+        self.received_at = received_at
+        self._query_params = None
+        self._spec = None
+
+    @property
+    def id(self):
+        return self.envelope['id']
+
+    @property
+    def method(self):
+        return self.envelope['method']
+
+    @property
+    def request_uri(self):
+        return self.envelope['requestUri']
+
+    @property
+    def headers(self):
+        return self.envelope['headers']
+
+    @property
+    def query_params(self):
+        """Get the parsed query string of the request.
+
+        :rtype: dict
+        """
+        if self._query_params is None:
+            query_string = self.envelope['queryString']
+            self._query_params = \
+                dict(parse_qsl(query_string)) if query_string else {}
+        return self._query_params
+
+    @property
+    def raw_body(self):
+        """Get the decoded, but not parsed, body of the request.
+
+        :return: body of the request, empty if the request has none.
+
+        :rtype: bytes
+        """
+        body = self.envelope['body']
+        return base64.b64decode(body) if body else b''
+
+    @property
+    def spec(self):
+        """Get the parsed body of the request.
+
+        :return: body of the request, empty if the request has none. It is
+            owned by the request handler, which may modify it.
+
+        :rtype: dict
+
+        :raises ValueError: if the body is not valid JSON.
+        """
+        if self._spec is None:
+            raw_body = self.raw_body
+            self._spec = json_loads(raw_body) if raw_body else {}
+        return self._spec
+
+
+def decode_request(message_body, received_at=None):
+    """Decode the body of an AMQP message carrying a request.
+
+    :param bytes message_body: body of the AMQP message.
+    :param float received_at: time.perf_counter() value at the receipt of
+        the message, if known.
+
+    :rtype: Request
+    """
+    return Request(json_loads(message_body)[0], received_at)
+
+
+def encode_reply_body(body):
+    """Serialize a reply body, unless it is serialized already.
+
+    :param body: a SerializedBody, or an object serializable to JSON.
+
+    :rtype: str
+    """
+    if isinstance(body, SerializedBody):
+        return body
+    return json_dumps(body)
+
+
+def encode_reply(request, status_code, reply_headers, reply_body,
+                 compression_threshold=0):
+    """Encode the reply to a request as the body of an AMQP message.
+
+    :param Request request: the request being replied to.
+    :param int status_code: HTTP status code of the reply.
+    :param dict reply_headers: HTTP headers of the reply, besides
+        Content-Type, Content-Length and Content-Encoding.
+    :param str reply_body: serialized body of the reply.
+    :param int compression_threshold: if greater than 0, reply bodies of at
+        least this many bytes are gzip compressed, provided the request
+        accepts gzip encoding.
+
+    :return: the reply message
+
+    :rtype: str
+    """
+    reply_bytes = reply_body.encode()
+    headers = {**reply_headers, 'Content-Type': request.headers['Accept']}
+    if compression_threshold > 0:
+        headers['Vary'] = 'Accept-Encoding'
+        if len(reply_bytes) >= compression_threshold and \
+                is_encoding_accepted(
+                    get_header(request.headers, 'Accept-Encoding'), 'gzip'):
+            reply_bytes = gzip.compress(reply_bytes,
+                                        compresslevel=REPLY_COMPRESSION_LEVEL)
+            headers['Content-Encoding'] = 'gzip'
+    headers['Content-Length'] = len(reply_bytes)
+    return json_dumps({
+        'id': request.id,
+        'headers': headers,
+        'statusCode': status_code,
+        'body': base64.b64encode(reply_bytes).decode(),
+        'request': False
+    })
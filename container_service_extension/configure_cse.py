@@ -144,10 +144,36 @@ SAMPLE_VCS_CONFIG = {
 SAMPLE_SERVICE_CONFIG = {
     'service': {
         'listeners': 5,
+        'channels_per_connection': 8,
+        'read_processors': 10,
+        'mutate_processors': 5,
+        'admin_processors': 2,
+        'prefetch_count': 0,
+        'ack_after_reply': False,
+        'reply_compression_threshold': 0,
+        'max_operations': 0,
+        'max_operations_per_org': 0,
+        'operation_retry_after': 60,
+        'max_request_age': 0,
+        'backend_timeout': 60,
+        'metrics_port': 0,
+        'metrics_address': '127.0.0.1',
         'enforce_authorization': False
     }
 }
 
+# Keys of the 'service' section that can be left out of the config file.
+# Missing keys are filled in with their value from SAMPLE_SERVICE_CONFIG.
+OPTIONAL_SERVICE_CONFIG_KEYS = ['channels_per_connection',
+                                'read_processors', 'mutate_processors',
+                                'admin_processors', 'prefetch_count',
+                                'ack_after_reply',
+                                'reply_compression_threshold',
+                                'max_operations', 'max_operations_per_org',
+                                'operation_retry_after', 'max_request_age',
+                                'backend_timeout', 'metrics_port',
+                                'metrics_address']
+
 SAMPLE_TEMPLATE_PHOTON_V2 = {
     'name': 'photon-v2',
     'catalog_item': 'photon-custom-hw11-2.0-304b817-k8s',
@@ -416,9 +442,7 @@ def get_validated_config(config_file_name):
     validate_amqp_config(config['amqp'])
     validate_vcd_and_vcs_config(config['vcd'], config['vcs'])
     validate_broker_config(config['broker'])
-    check_keys_and_value_types(config['service'],
-                               SAMPLE_SERVICE_CONFIG['service'],
-                               location="config file 'service' section")
+    validate_service_config(config['service'])
     click.secho(f"Config file '{config_file_name}' is valid", fg='green')
     if isinstance(pks_config_location, str):
         check_file_permissions(pks_config_location)
@@ -584,6 +608,48 @@ def validate_broker_config(broker_dict):
                          f"should be either 'dhcp' or 'pool'")
 
 
+def validate_service_config(service_dict):
+    """Ensure that 'service' section of config is correct.
+
+    Checks that 'service' section of config has correct keys and value
+    types, and fills in default values of optional properties that are
+    missing.
+
+    :param dict service_dict: 'service' section of config file as a dict.
+
+    :raises KeyError: if @service_dict has missing properties.
+    :raises TypeError: if the value type for a @service_dict property is
+        incorrect.
+    :raises ValueError: if 'listeners', 'channels_per_connection' or any of
+        the '*_processors' is less than 1, or if
+        'reply_compression_threshold', 'max_operations',
+        'max_operations_per_org', 'operation_retry_after',
+        'max_request_age' or 'backend_timeout' is negative, or if
+        'metrics_port' is not a valid port number.
+    """
+    check_keys_and_value_types(service_dict,
+                               SAMPLE_SERVICE_CONFIG['service'],
+                               location="config file 'service' section",
+                               excluded_keys=OPTIONAL_SERVICE_CONFIG_KEYS)
+    for key in OPTIONAL_SERVICE_CONFIG_KEYS:
+        service_dict.setdefault(key, SAMPLE_SERVICE_CONFIG['service'][key])
+
+    for key in ['listeners', 'channels_per_connection', 'read_processors',
+                'mutate_processors', 'admin_processors']:
+        if service_dict[key] < 1:
+            raise ValueError(f"'{key}' in config file 'service' section "
+                             f"should be at least 1")
+    for key in ['reply_compression_threshold', 'max_operations',
+                'max_operations_per_org', 'operation_retry_after',
+                'max_request_age', 'backend_timeout']:
+        if service_dict[key] < 0:
+            raise ValueError(f"'{key}' in config file 'service' section "
+                             f"should not be negative")
+    if not 0 <= service_dict['metrics_port'] <= 65535:
+        raise ValueError("'metrics_port' in config file 'service' section "
+                         "should be between 0 and 65535")
+
+
 def validate_pks_config_structure(pks_config):
     sample_config = {
         **SAMPLE_PKS_SERVERS_SECTION, **SAMPLE_PKS_ACCOUNTS_SECTION,
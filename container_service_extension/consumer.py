@@ -2,15 +2,20 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
-import base64
-import json
+import functools
+import logging
 import sys
 import threading
+import time
 import traceback
 
 import pika
 
+from container_service_extension.codec import decode_request
+from container_service_extension.codec import encode_reply
+from container_service_extension.codec import encode_reply_body
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.processor import get_request_lane
 from container_service_extension.processor import ServiceProcessor
 from container_service_extension.utils import EXCHANGE_TYPE
 
@@ -24,11 +29,41 @@ class MessageConsumer(object):
                  username,
                  password,
                  exchange,
-                 routing_key):
+                 routing_key,
+                 processor_pools=None,
+                 prefetch_count=0,
+                 ack_after_reply=False,
+                 num_channels=1,
+                 compression_threshold=0,
+                 max_request_age=0):
+        """Initialize the consumer.
+
+        :param dict processor_pools: mapping of router.Lane ->
+            concurrent.futures.Executor, the pool of worker threads to which
+            received requests of that lane are handed off for processing. If
+            None, messages are processed synchronously on the thread running
+            the ioloop of this consumer.
+        :param int prefetch_count: maximum number of unacknowledged messages
+            the broker will deliver to this consumer. 0 means no limit.
+        :param bool ack_after_reply: if True, a message is acknowledged only
+            after its reply has been published, so that requests in flight
+            are redelivered by the broker if the server goes down. If False,
+            a message is acknowledged as soon as it is received.
+        :param int num_channels: number of channels, each with its own
+            consumer, multiplexed over the single connection of this
+            consumer.
+        :param int compression_threshold: if greater than 0, replies of at
+            least this many bytes are gzip compressed for requests that
+            accept gzip encoding.
+        :param int max_request_age: if greater than 0, requests published
+            more than this many seconds ago, according to their AMQP
+            timestamp, are dropped without being processed. vCD has given up
+            waiting on their replies by then.
+        """
         self._connection = None
-        self._channel = None
+        # mapping of open channel -> consumer tag (None until consuming)
+        self._channels = {}
         self._closing = False
-        self._consumer_tag = None
         self.host = host
         self.port = port
         self.ssl = ssl
@@ -38,6 +73,14 @@ class MessageConsumer(object):
         self.exchange = exchange
         self.routing_key = routing_key
         self.queue = routing_key
+        self.processor_pools = processor_pools
+        self.prefetch_count = prefetch_count
+        self.ack_after_reply = ack_after_reply
+        self.num_channels = num_channels
+        self.compression_threshold = compression_threshold
+        self.max_request_age = max_request_age
+        self.stale_request_count = 0
+        self._stale_request_lock = threading.Lock()
         self.service_processor = ServiceProcessor()
         self.fsencoding = sys.getfilesystemencoding()
 
@@ -59,14 +102,15 @@ class MessageConsumer(object):
     def on_connection_open(self, unused_connection):
         LOGGER.debug("Connection opened")
         self.add_on_connection_close_callback()
-        self.open_channel()
+        for n in range(self.num_channels):
+            self.open_channel()
 
     def add_on_connection_close_callback(self):
         LOGGER.debug("Adding connection close callback")
         self._connection.add_on_close_callback(self.on_connection_closed)
 
     def on_connection_closed(self, connection, reply_code, reply_text):
-        self._channel = None
+        self._channels.clear()
         if self._closing:
             self._connection.ioloop.stop()
         else:
@@ -86,125 +130,276 @@ class MessageConsumer(object):
         self._connection.channel(on_open_callback=self.on_channel_open)
 
     def on_channel_open(self, channel):
-        LOGGER.debug("Channel opened")
-        self._channel = channel
-        self.add_on_channel_close_callback()
-        self.setup_exchange(self.exchange)
+        LOGGER.debug(f"Channel {channel} opened")
+        self._channels[channel] = None
+        self.add_on_channel_close_callback(channel)
+        self.setup_exchange(channel, self.exchange)
 
-    def add_on_channel_close_callback(self):
+    def add_on_channel_close_callback(self, channel):
         LOGGER.debug("Adding channel close callback")
-        self._channel.add_on_close_callback(self.on_channel_closed)
+        channel.add_on_close_callback(self.on_channel_closed)
 
     def on_channel_closed(self, channel, reply_code, reply_text):
         LOGGER.warning(f"Channel {channel} was closed: ({reply_code}) "
                        f"{reply_text}")
+        self._channels.pop(channel, None)
         self._connection.close()
 
-    def setup_exchange(self, exchange_name):
+    def setup_exchange(self, channel, exchange_name):
         LOGGER.debug(f"Declaring exchange {exchange_name}")
-        self._channel.exchange_declare(
-            self.on_exchange_declareok,
+        channel.exchange_declare(
+            functools.partial(self.on_exchange_declareok, channel),
             exchange=exchange_name,
             exchange_type=EXCHANGE_TYPE,
             passive=True,
             durable=True,
             auto_delete=False)
 
-    def on_exchange_declareok(self, unused_frame):
+    def on_exchange_declareok(self, channel, unused_frame):
         LOGGER.debug(f"Exchange declared: {unused_frame}")
-        self.setup_queue(self.queue)
+        self.setup_queue(channel, self.queue)
 
-    def setup_queue(self, queue_name):
+    def setup_queue(self, channel, queue_name):
         LOGGER.debug(f"Declaring queue {queue_name}")
-        self._channel.queue_declare(self.on_queue_declareok, queue_name)
+        channel.queue_declare(
+            functools.partial(self.on_queue_declareok, channel), queue_name)
 
-    def on_queue_declareok(self, method_frame):
+    def on_queue_declareok(self, channel, method_frame):
         LOGGER.debug(f"Binding {self.exchange} to {self.queue} with "
                      f"{self.routing_key}")
-        self._channel.queue_bind(self.on_bindok, self.queue, self.exchange,
-                                 self.routing_key)
+        channel.queue_bind(functools.partial(self.on_bindok, channel),
+                           self.queue, self.exchange, self.routing_key)
 
-    def on_bindok(self, unused_frame):
+    def on_bindok(self, channel, unused_frame):
         LOGGER.debug("Queue bound")
-        self.start_consuming()
+        if self.prefetch_count > 0:
+            self.set_qos(channel)
+        else:
+            self.start_consuming(channel)
+
+    def set_qos(self, channel):
+        LOGGER.debug(f"Setting prefetch count to {self.prefetch_count}")
+        channel.basic_qos(functools.partial(self.on_basic_qos_ok, channel),
+                          prefetch_count=self.prefetch_count)
+
+    def on_basic_qos_ok(self, channel, unused_frame):
+        LOGGER.debug("QOS set")
+        self.start_consuming(channel)
 
-    def start_consuming(self):
+    def start_consuming(self, channel):
         LOGGER.debug("Issuing consumer related RPC commands")
-        self.add_on_cancel_callback()
-        self._consumer_tag = self._channel.basic_consume(
+        self.add_on_cancel_callback(channel)
+        self._channels[channel] = channel.basic_consume(
             self.on_message, self.queue)
 
-    def add_on_cancel_callback(self):
+    def add_on_cancel_callback(self, channel):
         LOGGER.debug("Adding consumer cancellation callback")
-        self._channel.add_on_cancel_callback(self.on_consumer_cancelled)
+        channel.add_on_cancel_callback(
+            functools.partial(self.on_consumer_cancelled, channel))
 
-    def on_consumer_cancelled(self, method_frame):
+    def on_consumer_cancelled(self, channel, method_frame):
         LOGGER.debug(f"Consumer was cancelled remotely, shutting down: "
                      f"{method_frame}")
-        if self._channel:
-            self._channel.close()
-
-    def on_message(self, unused_channel, basic_deliver, properties, body):
-        self.acknowledge_message(basic_deliver.delivery_tag)
+        if channel.is_open:
+            channel.close()
+
+    def on_message(self, channel, basic_deliver, properties, body):
+        received_at = time.perf_counter()
+        if not self.ack_after_reply:
+            self.acknowledge_message(channel, basic_deliver.delivery_tag)
+        elif basic_deliver.redelivered:
+            LOGGER.info(f"Message # {basic_deliver.delivery_tag} is a "
+                        f"redelivery of an unacknowledged request")
+        if self.is_stale(basic_deliver, properties):
+            self.complete_message(channel, basic_deliver, properties, None)
+            return
+        try:
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug(f"Received message # "
+                             f"{basic_deliver.delivery_tag} from "
+                             f"{properties.app_id}: "
+                             f"{body.decode(self.fsencoding)}, "
+                             f"props: {properties}")
+            request = decode_request(body, received_at)
+        except Exception:
+            LOGGER.error(f"Unable to decode message # "
+                         f"{basic_deliver.delivery_tag}, dropping it:\n"
+                         f"{traceback.format_exc()}")
+            self.complete_message(channel, basic_deliver, properties, None)
+            return
+        if self.processor_pools is None:
+            self.process_message(channel, basic_deliver, properties, request)
+            return
+        lane = get_request_lane(request)
+        try:
+            self.processor_pools[lane].submit(self.process_message, channel,
+                                              basic_deliver, properties,
+                                              request)
+        except RuntimeError:
+            # pool has been shut down, server is stopping
+            LOGGER.warning(f"Dropping message # {basic_deliver.delivery_tag}"
+                           f", {lane.value} request processor pool is shut "
+                           f"down.")
+
+    def process_message(self, channel, basic_deliver, properties, request):
+        """Process a received request and send back the reply.
+
+        When processor pools are in use, this method runs on a worker thread
+        of the pool of the request's lane. Publishing the reply and
+        acknowledging the message are then handed back to the ioloop thread,
+        since pika channels are not thread safe.
+
+        :param codec.Request request: the request decoded from the message.
+        """
+        # the request may have aged while waiting for a processor thread
+        if self.is_stale(basic_deliver, properties):
+            self._hand_over_completion(channel, basic_deliver, properties,
+                                       None)
+            return
         try:
-            body_json = json.loads(body.decode(self.fsencoding))[0]
-            LOGGER.debug(f"Received message # {basic_deliver.delivery_tag} "
-                         f"from {properties.app_id} "
-                         f"({threading.currentThread().ident}): "
-                         f"{json.dumps(body_json)}, props: {properties}")
-            result = self.service_processor.process_request(body_json)
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug(f"Processing message # "
+                             f"{basic_deliver.delivery_tag} "
+                             f"({threading.currentThread().ident})")
+            result = self.service_processor.process_request(request)
             status_code = result['status_code']
-            reply_body = json.dumps(result['body'])
+            reply_headers = result.get('headers', {})
+            reply_body = encode_reply_body(result['body'])
             if status_code == 500 and \
                reply_body == '[]' and \
                'message' in result:
                 reply_body = '{"message": "%s"}' % result['message']
+            reply_msg = self.encode_reply_message(
+                request, properties, status_code, reply_headers, reply_body)
         except Exception as e:
-            reply_body = '{"message": "%s"}' % str(e)
-            status_code = 500
             tb = traceback.format_exc()
             LOGGER.error(tb)
-
-        if properties.reply_to is not None:
-            reply_msg = {
-                'id':
-                body_json['id'],
-                'headers': {
-                    'Content-Type': body_json['headers']['Accept'],
-                    'Content-Length': len(reply_body)
-                },
-                'statusCode':
-                status_code,
-                'body':
-                base64.b64encode(reply_body.encode()).decode(self.fsencoding),
-                'request':
-                False
-            }
-            LOGGER.debug(f"reply: {json.dumps(reply_body)}")
+            try:
+                reply_msg = self.encode_reply_message(
+                    request, properties, 500, {},
+                    '{"message": "%s"}' % str(e))
+            except Exception:
+                # still complete the message, so that it doesn't hold its
+                # prefetch slot until the connection drops
+                LOGGER.error(f"Unable to encode reply to message # "
+                             f"{basic_deliver.delivery_tag}, dropping it:\n"
+                             f"{traceback.format_exc()}")
+                reply_msg = None
+
+        self._hand_over_completion(channel, basic_deliver, properties,
+                                   reply_msg)
+
+    def encode_reply_message(self, request, properties, status_code,
+                             reply_headers, reply_body):
+        """Encode the reply to a request, if the request expects one.
+
+        :param codec.Request request: the request being replied to.
+        :param pika.spec.BasicProperties properties: properties of the
+            request message.
+        :param int status_code: HTTP status code of the reply.
+        :param dict reply_headers: HTTP headers of the reply.
+        :param str reply_body: serialized body of the reply.
+
+        :return: the reply message, or None if the request doesn't expect a
+            reply.
+
+        :rtype: str
+        """
+        if properties.reply_to is None:
+            return None
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(f"reply: {reply_body}")
+        return encode_reply(request, status_code, reply_headers, reply_body,
+                            self.compression_threshold)
+
+    def is_stale(self, basic_deliver, properties):
+        """Check whether a request is too old to be worth processing.
+
+        Requests without an AMQP timestamp are never considered stale.
+
+        :param pika.spec.Basic.Deliver basic_deliver: delivery details of
+            the request message.
+        :param pika.spec.BasicProperties properties: properties of the
+            request message.
+
+        :return: True if the request is older than max_request_age. It is
+            then counted in stale_request_count.
+
+        :rtype: bool
+        """
+        if self.max_request_age <= 0 or not properties.timestamp:
+            return False
+        age = time.time() - properties.timestamp
+        if age <= self.max_request_age:
+            return False
+        with self._stale_request_lock:
+            self.stale_request_count += 1
+        LOGGER.warning(f"Dropping message # {basic_deliver.delivery_tag}, "
+                       f"request is {age:.0f} seconds old.")
+        return True
+
+    def _hand_over_completion(self, channel, basic_deliver, properties,
+                              reply_msg):
+        """Run complete_message() on the ioloop thread."""
+        complete_message = functools.partial(
+            self.complete_message, channel, basic_deliver, properties,
+            reply_msg)
+        if self.processor_pools is None:
+            complete_message()
+        else:
+            self._connection.ioloop.add_callback_threadsafe(complete_message)
+
+    def complete_message(self, channel, basic_deliver, properties,
+                         reply_msg):
+        """Publish the reply to a request and acknowledge it if needed.
+
+        Must run on the ioloop thread.
+
+        :param pika.channel.Channel channel: channel the request was
+            received on.
+        :param pika.spec.Basic.Deliver basic_deliver: delivery details of
+            the request message.
+        :param pika.spec.BasicProperties properties: properties of the
+            request message.
+        :param str reply_msg: serialized reply envelope, or None if the
+            request doesn't expect a reply.
+        """
+        if not channel.is_open:
+            LOGGER.warning(f"Unable to complete message # "
+                           f"{basic_deliver.delivery_tag}, channel it was "
+                           f"received on is closed.")
+            return
+        if reply_msg is not None:
             reply_properties = pika.BasicProperties(
                 correlation_id=properties.correlation_id)
-            result = self._channel.basic_publish(
+            channel.basic_publish(
                 exchange=properties.headers['replyToExchange'],
                 routing_key=properties.reply_to,
-                body=json.dumps(reply_msg),
+                body=reply_msg,
                 properties=reply_properties)
+        if self.ack_after_reply:
+            self.acknowledge_message(channel, basic_deliver.delivery_tag)
 
-    def acknowledge_message(self, delivery_tag):
+    def acknowledge_message(self, channel, delivery_tag):
         LOGGER.debug(f"Acknowledging message {delivery_tag}")
-        self._channel.basic_ack(delivery_tag)
+        channel.basic_ack(delivery_tag)
 
     def stop_consuming(self):
-        if self._channel:
+        for channel, consumer_tag in list(self._channels.items()):
+            if consumer_tag is None:
+                self.close_channel(channel)
+                continue
             LOGGER.info("Sending a Basic.Cancel RPC command to RabbitMQ")
-            self._channel.basic_cancel(self.on_cancelok, self._consumer_tag)
+            channel.basic_cancel(functools.partial(self.on_cancelok, channel),
+                                 consumer_tag)
 
-    def on_cancelok(self, unused_frame):
+    def on_cancelok(self, channel, unused_frame):
         LOGGER.debug("RabbitMQ acknowledged the cancellation of the consumer")
-        self.close_channel()
+        self.close_channel(channel)
 
-    def close_channel(self):
+    def close_channel(self, channel):
         LOGGER.debug("Closing the channel")
-        self._channel.close()
+        channel.close()
 
     def run(self):
         self._connection = self.connect()
@@ -217,6 +412,21 @@ class MessageConsumer(object):
         self._connection.ioloop.start()
         LOGGER.info("Stopped")
 
+    def get_state(self):
+        """Get the state of the AMQP connection of the consumer.
+
+        :return: dict with keys 'connected' (True if the connection is open)
+            and 'consuming_channels' (number of channels consuming requests).
+
+        :rtype: dict
+        """
+        connection = self._connection
+        return {
+            'connected': connection is not None and connection.is_open,
+            'consuming_channels': sum(
+                1 for tag in list(self._channels.values()) if tag is not None)
+        }
+
     def close_connection(self):
         LOGGER.info("Closing connection")
         self._connection.close()
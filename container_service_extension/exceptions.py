@@ -12,6 +12,26 @@ class CseClientError(Exception):
     """Raised for any client side error."""
 
 
+class RouteNotFoundError(CseServerError):
+    """Raised when no route matches the path of a request."""
+
+
+class MethodNotAllowedError(CseServerError):
+    """Raised when a route matches a request path but not its method."""
+
+
+class TooManyOperationsError(CseServerError):
+    """Raised when a long-running operation is refused for lack of capacity.
+
+    :ivar int retry_after: number of seconds after which the operation can
+        be retried.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 class ClusterOperationError(CseServerError):
     """Base class for all cluster operation related exceptions."""
 
@@ -0,0 +1,260 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""In-process latency metrics of CSE server.
+
+Latencies are recorded in LatencyRecorders, grouped by what they measure:
+
+- 'queue_wait': per route, time from receipt of a request until a processor
+    thread picks it up.
+- 'processing': per route, time spent processing a request.
+- 'backend_time': per route, time spent in calls to vCD, PKS and vSphere
+    while processing a request.
+- 'operation': per broker_manager.Operation, time spent by BrokerManager.
+- 'backend': per backend, i.e. 'vcd', 'pks' or 'vsphere', time of each
+    call.
+
+Caches count their hits and misses in CacheStats of the same registry.
+"""
+
+import contextlib
+import threading
+import time
+
+# number of latest observations kept by each LatencyRecorder
+RING_BUFFER_SIZE = 1024
+
+# quantiles reported by LatencyRecorder.snapshot()
+QUANTILES = (0.5, 0.9, 0.99)
+
+GROUP_QUEUE_WAIT = 'queue_wait'
+GROUP_PROCESSING = 'processing'
+GROUP_BACKEND_TIME = 'backend_time'
+GROUP_OPERATION = 'operation'
+GROUP_BACKEND = 'backend'
+
+BACKEND_VCD = 'vcd'
+BACKEND_PKS = 'pks'
+BACKEND_VSPHERE = 'vsphere'
+
+
+class LatencyRecorder(object):
+    """Record latencies in a ring buffer of the latest observations.
+
+    Recording an observation only stores it in a preallocated slot and bumps
+    counters. Quantiles are computed out of the ring buffer when a snapshot
+    is taken.
+    """
+
+    __slots__ = ['_samples', '_index', '_lock', 'count', 'error_count',
+                 'total']
+
+    def __init__(self, size=RING_BUFFER_SIZE):
+        self._samples = [0.0] * size
+        self._index = 0
+        self._lock = threading.Lock()
+        self.count = 0
+        self.error_count = 0
+        self.total = 0.0
+
+    def observe(self, seconds, error=False):
+        """Record an observation.
+
+        :param float seconds: observed latency.
+        :param bool error: True if the observed call failed.
+        """
+        with self._lock:
+            self._samples[self._index] = seconds
+            self._index = (self._index + 1) % len(self._samples)
+            self.count += 1
+            self.total += seconds
+            if error:
+                self.error_count += 1
+
+    def snapshot(self):
+        """Get the totals and the quantiles of the latest observations.
+
+        :return: dict with keys 'count', 'errors', 'sum' (total seconds),
+            'max' and the QUANTILES, e.g. 'p50', in seconds, of the latest
+            observations.
+
+        :rtype: dict
+        """
+        with self._lock:
+            count = self.count
+            result = {
+                'count': count,
+                'errors': self.error_count,
+                'sum': self.total
+            }
+            samples = self._samples[:min(count, len(self._samples))]
+        samples.sort()
+        for quantile in QUANTILES:
+            key = f"p{quantile * 100:g}"
+            result[key] = \
+                samples[int(quantile * (len(samples) - 1))] if samples else 0.0
+        result['max'] = samples[-1] if samples else 0.0
+        return result
+
+
+class CacheStats(object):
+    """Count the hits and misses of a cache."""
+
+    __slots__ = ['_lock', 'hits', 'misses']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def snapshot(self):
+        """Get the counters.
+
+        :return: dict with keys 'hits' and 'misses'.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class MetricsRegistry(object):
+    """Latency recorders, by group and name, and cache statistics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # mapping of (group, name) -> LatencyRecorder
+        self._recorders = {}
+        # mapping of cache name -> CacheStats
+        self._cache_stats = {}
+
+    def get_recorder(self, group, name):
+        """Get the recorder of a group and name, creating it if needed.
+
+        :rtype: LatencyRecorder
+        """
+        key = (group, name)
+        recorder = self._recorders.get(key)
+        if recorder is None:
+            with self._lock:
+                recorder = self._recorders.setdefault(key, LatencyRecorder())
+        return recorder
+
+    def observe(self, group, name, seconds, error=False):
+        """Record an observation in the recorder of a group and name.
+
+        :param str group: group of the recorder, e.g. 'processing'.
+        :param str name: name of the recorder within its group.
+        :param float seconds: observed latency.
+        :param bool error: True if the observed call failed.
+        """
+        self.get_recorder(group, name).observe(seconds, error)
+
+    def snapshot(self):
+        """Get snapshots of all recorders.
+
+        :return: mapping of group -> name -> LatencyRecorder snapshot.
+
+        :rtype: dict
+        """
+        with self._lock:
+            recorders = list(self._recorders.items())
+        result = {}
+        for (group, name), recorder in sorted(recorders):
+            result.setdefault(group, {})[name] = recorder.snapshot()
+        return result
+
+    def get_cache_stats(self, name):
+        """Get the statistics of a cache, creating them if needed.
+
+        :param str name: name of the cache, e.g. 'vsphere'.
+
+        :rtype: CacheStats
+        """
+        with self._lock:
+            return self._cache_stats.setdefault(name, CacheStats())
+
+    def cache_snapshot(self):
+        """Get snapshots of all cache statistics.
+
+        :return: mapping of cache name -> CacheStats snapshot.
+
+        :rtype: dict
+        """
+        with self._lock:
+            cache_stats = list(self._cache_stats.items())
+        return {name: stats.snapshot() for name, stats in sorted(cache_stats)}
+
+
+METRICS = MetricsRegistry()
+
+# time spent in backend calls by the request processed on this thread
+_request_context = threading.local()
+
+
+def start_request():
+    """Start accounting backend time of a request processed on this thread.
+
+    :return: perf_counter() value at the start of the request.
+
+    :rtype: float
+    """
+    _request_context.backend_time = 0.0
+    return time.perf_counter()
+
+
+def get_request_backend_time():
+    """Get backend time spent so far by the request of this thread.
+
+    :rtype: float
+    """
+    return getattr(_request_context, 'backend_time', 0.0)
+
+
+def observe_backend_call(backend, seconds, error=False):
+    """Record a call to a backend.
+
+    The call is accounted to the request processed on this thread, if any.
+
+    :param str backend: name of the backend, e.g. 'vcd'.
+    :param float seconds: duration of the call.
+    :param bool error: True if the call failed.
+    """
+    METRICS.observe(GROUP_BACKEND, backend, seconds, error)
+    add_request_backend_time(seconds)
+
+
+def add_request_backend_time(seconds):
+    """Account backend time to the request processed on this thread, if any.
+
+    Backend calls made on other threads on behalf of the request are
+    accounted this way.
+
+    :param float seconds: time spent in backend calls.
+    """
+    if hasattr(_request_context, 'backend_time'):
+        _request_context.backend_time += seconds
+
+
+@contextlib.contextmanager
+def backend_call(backend):
+    """Time the enclosed call to a backend.
+
+    :param str backend: name of the backend, e.g. 'pks'.
+    """
+    start = time.perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        observe_backend_call(backend, time.perf_counter() - start, error)
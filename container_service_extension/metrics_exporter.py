@@ -0,0 +1,236 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""Export of CSE server metrics in the Prometheus text exposition format.
+
+The metrics are served over plain HTTP at /metrics by a MetricsServer, which
+runs in a daemon thread of CSE server. It is meant to be scraped by a local
+Prometheus server or agent, hence it listens on the loopback interface
+unless configured otherwise.
+"""
+
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import logging
+from socketserver import ThreadingMixIn
+import threading
+import traceback
+
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import GROUP_BACKEND
+from container_service_extension.metrics import GROUP_BACKEND_TIME
+from container_service_extension.metrics import GROUP_OPERATION
+from container_service_extension.metrics import GROUP_PROCESSING
+from container_service_extension.metrics import GROUP_QUEUE_WAIT
+from container_service_extension.metrics import QUANTILES
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRICS_PATH = '/metrics'
+
+
+class LatencyMetric(namedtuple('LatencyMetric',
+                               'name, label, help, error_name, error_help')):
+    """Prometheus names of a latency group.
+
+    name: name of the summary of the latencies.
+    label: name of the label holding the recorder name, e.g. 'route'.
+    help: description of the summary.
+    error_name: name of the counter of errors, None if not exported.
+    error_help: description of the counter of errors.
+    """
+
+
+# mapping of latency group -> LatencyMetric
+LATENCY_METRICS = {
+    GROUP_PROCESSING: LatencyMetric(
+        'cse_request_duration_seconds', 'route',
+        'Time spent processing requests.',
+        'cse_request_errors_total', 'Requests failed with a server error.'),
+    GROUP_QUEUE_WAIT: LatencyMetric(
+        'cse_request_queue_wait_seconds', 'route',
+        'Time requests waited for a processor thread.', None, None),
+    GROUP_BACKEND_TIME: LatencyMetric(
+        'cse_request_backend_seconds', 'route',
+        'Time requests spent waiting for vCD, PKS and vSphere.', None, None),
+    GROUP_OPERATION: LatencyMetric(
+        'cse_operation_duration_seconds', 'operation',
+        'Time spent by the broker layer per operation.',
+        'cse_operation_errors_total',
+        'Operations failed with a server error.'),
+    GROUP_BACKEND: LatencyMetric(
+        'cse_backend_call_duration_seconds', 'backend',
+        'Time of calls to vCD, PKS and vSphere.',
+        'cse_backend_call_errors_total',
+        'Calls to vCD, PKS and vSphere failed with a server error or '
+        'without a reply.')
+}
+
+
+class MetricFamily(namedtuple('MetricFamily', 'name, type, help, samples')):
+    """A metric and its samples.
+
+    name: name of the metric, e.g. 'cse_requests_total'.
+    type: Prometheus type of the metric, e.g. 'counter' or 'summary'.
+    help: description of the metric.
+    samples: list of (name suffix, labels dict, value) tuples.
+    """
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_metric_families(families):
+    """Format metrics in the Prometheus text exposition format.
+
+    :param list families: MetricFamily objects.
+
+    :rtype: str
+    """
+    lines = []
+    for family in families:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.type}")
+        for suffix, labels, value in family.samples:
+            if labels:
+                label_pairs = ','.join(
+                    f'{key}="{_escape_label_value(label_value)}"'
+                    for key, label_value in labels.items())
+                lines.append(f"{family.name}{suffix}{{{label_pairs}}} "
+                             f"{_format_value(value)}")
+            else:
+                lines.append(f"{family.name}{suffix} {_format_value(value)}")
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def get_latency_metric_families(metrics_snapshot):
+    """Convert latency recorder snapshots to Prometheus summaries.
+
+    Every latency group yields a summary of the latest observations, and
+    possibly a counter of the errors.
+
+    :param dict metrics_snapshot: snapshot of a
+        container_service_extension.metrics.MetricsRegistry.
+
+    :rtype: list
+    """
+    families = []
+    for group, metric in LATENCY_METRICS.items():
+        summary_samples = []
+        error_samples = []
+        for name, snapshot in metrics_snapshot.get(group, {}).items():
+            labels = {metric.label: name}
+            for quantile in QUANTILES:
+                summary_samples.append(
+                    ('', {**labels, 'quantile': f"{quantile:g}"},
+                     snapshot[f"p{quantile * 100:g}"]))
+            summary_samples.append(('_sum', labels, snapshot['sum']))
+            summary_samples.append(('_count', labels, snapshot['count']))
+            error_samples.append(('', labels, snapshot['errors']))
+        families.append(MetricFamily(metric.name, 'summary', metric.help,
+                                     summary_samples))
+        if metric.error_name is not None:
+            families.append(MetricFamily(metric.error_name, 'counter',
+                                         metric.error_help, error_samples))
+    return families
+
+
+def get_cache_metric_families(cache_snapshot):
+    """Convert cache statistics to Prometheus counters.
+
+    :param dict cache_snapshot: cache snapshot of a
+        container_service_extension.metrics.MetricsRegistry.
+
+    :rtype: list
+    """
+    return [
+        MetricFamily('cse_cache_hits_total', 'counter', 'Cache hits.', [
+            ('', {'cache': name}, stats['hits'])
+            for name, stats in cache_snapshot.items()
+        ]),
+        MetricFamily('cse_cache_misses_total', 'counter', 'Cache misses.', [
+            ('', {'cache': name}, stats['misses'])
+            for name, stats in cache_snapshot.items()
+        ])
+    ]
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+        try:
+            body = self.server.collect().encode()
+        except Exception:
+            LOGGER.error(f"Failed to collect metrics: "
+                         f"{traceback.format_exc()}")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(f"Metrics request from {self.address_string()}: "
+                         f"{format % args}")
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """HTTP server of the metrics, in the Prometheus text format."""
+
+    def __init__(self, address, port, collect):
+        """Bind the server.
+
+        :param str address: address to listen on, e.g. '127.0.0.1'.
+        :param int port: port to listen on, 0 to pick any free port.
+        :param callable collect: returns the metrics to serve, formatted by
+            format_metric_families().
+
+        :raises OSError: if the address can't be bound.
+        """
+        self._server = _ThreadingHTTPServer((address, port),
+                                            _MetricsRequestHandler)
+        self._server.collect = collect
+        self._thread = None
+
+    @property
+    def server_address(self):
+        """Get the (address, port) the server listens on.
+
+        :rtype: tuple
+        """
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(name='MetricsServer',
+                                        target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        LOGGER.info(f"Serving metrics at http://{self.server_address[0]}:"
+                    f"{self.server_address[1]}{METRICS_PATH}")
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
@@ -2,22 +2,34 @@
 # Copyright (c) 2019 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+from collections import Counter
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from enum import unique
+import threading
+import time
 
+from cachetools import TTLCache
 from pyvcloud.vcd import utils
 from pyvcloud.vcd.client import ApiVersion
 from pyvcloud.vcd.client import MetadataDomain
 from pyvcloud.vcd.client import MetadataVisibility
+from pyvcloud.vcd.client import QueryResultFormat
+from pyvcloud.vcd.client import ResourceType
+from pyvcloud.vcd.client import TaskStatus
 from pyvcloud.vcd.vdc import VDC
 
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import METRICS
 from container_service_extension.pks_cache import PKS_COMPUTE_PROFILE
 from container_service_extension.pks_cache import PKS_PLANS
 from container_service_extension.pks_cache import PksCache
 from container_service_extension.utils import get_org
 from container_service_extension.utils import get_pks_cache
+from container_service_extension.utils import get_vcd_sys_admin_client
 from container_service_extension.utils import get_vdc
+from container_service_extension.utils import release_vcd_sys_admin_client
 
 
 # TODO(Constants) Refer the TODO(Constants) in broker_manager.py
@@ -30,6 +42,190 @@ class CtrProvType(Enum):
 
 CONTAINER_PROVIDER_KEY = 'container_provider'
 
+# largest page size vCD serves by default
+OVDC_QUERY_PAGE_SIZE = 128
+
+OVDC_METADATA_CACHE_SIZE = 1024
+# seconds after which metadata changed by other CSE servers is picked up
+OVDC_METADATA_CACHE_TTL = 300
+# seconds between polls of the vCD task setting the metadata of an ovdc
+OVDC_METADATA_TASK_POLL_FREQUENCY = 1
+# seconds after which the metadata of an ovdc is cached again, even if the
+# vCD task setting it is still running
+OVDC_METADATA_TASK_TIMEOUT = 600
+OVDC_METADATA_TASK_FINAL_STATUSES = (
+    TaskStatus.SUCCESS.value, TaskStatus.ERROR.value,
+    TaskStatus.CANCELED.value, TaskStatus.ABORTED.value)
+
+# Threads waiting for the vCD tasks setting the metadata of ovdcs, so that
+# requests setting it are replied to as soon as the task is created.
+OVDC_METADATA_TASK_EXECUTOR = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix='OvdcMetadataTask')
+
+
+class OvdcMetadata(namedtuple('OvdcMetadata', 'ovdc_id, pvdc_id, metadata')):
+    """Metadata of an ovdc, as read from vCD.
+
+    ovdc_id: UUID of the ovdc.
+    pvdc_id: UUID of the provider vdc backing the ovdc.
+    metadata: mapping of metadata key -> value of the ovdc.
+    """
+
+
+class OvdcMetadataCache(object):
+    """Cache of the metadata of ovdcs, shared by all requests.
+
+    Entries are found both by ovdc id and by (org name, ovdc name), expire
+    after a TTL, and are evicted least recently used first once the cache is
+    full.
+
+    Metadata read from vCD while an ovdc was being invalidated may be stale,
+    hence it is only cached if no invalidation happened since the read
+    started, see get_generation(). Metadata of ovdcs being updated, see
+    begin_update(), isn't cached either.
+    """
+
+    def __init__(self, maxsize=OVDC_METADATA_CACHE_SIZE,
+                 ttl=OVDC_METADATA_CACHE_TTL):
+        self._lock = threading.Lock()
+        # mapping of ovdc id or (org name, ovdc name) -> OvdcMetadata
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # number of invalidations so far
+        self._generation = 0
+        # mapping of ovdc id -> number of updates of its metadata in flight
+        self._updates = Counter()
+        self.stats = METRICS.get_cache_stats('ovdc_metadata')
+
+    def get_generation(self):
+        """Get the generation of the cache, to be passed to put().
+
+        :rtype: int
+        """
+        with self._lock:
+            return self._generation
+
+    def get(self, key):
+        """Get the metadata of an ovdc.
+
+        :param key: ovdc id, or (org name, ovdc name) tuple.
+
+        :return: the metadata, None if not cached.
+
+        :rtype: OvdcMetadata
+        """
+        with self._lock:
+            ovdc_metadata = self._cache.get(key)
+        if ovdc_metadata is None:
+            self.stats.miss()
+        else:
+            self.stats.hit()
+        return ovdc_metadata
+
+    def put(self, ovdc_metadata, org_name=None, ovdc_name=None,
+            generation=None):
+        """Cache the metadata of an ovdc.
+
+        :param OvdcMetadata ovdc_metadata: the metadata.
+        :param str org_name: name of the org of the ovdc, if known.
+        :param str ovdc_name: name of the ovdc, if known.
+        :param int generation: generation of the cache when the metadata
+            started to be read from vCD. If an invalidation happened since,
+            the metadata is not cached.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if ovdc_metadata.ovdc_id in self._updates:
+                return
+            self._cache[ovdc_metadata.ovdc_id] = ovdc_metadata
+            if ovdc_name is not None:
+                self._cache[(org_name, ovdc_name)] = ovdc_metadata
+
+    def invalidate(self, ovdc_id):
+        """Drop the metadata of an ovdc, under all its keys.
+
+        :param str ovdc_id: UUID of the ovdc.
+        """
+        with self._lock:
+            self._invalidate(ovdc_id)
+
+    def begin_update(self, ovdc_id):
+        """Drop the metadata of an ovdc, and don't cache it until updated.
+
+        :param str ovdc_id: UUID of the ovdc.
+        """
+        with self._lock:
+            self._updates[ovdc_id] += 1
+            self._invalidate(ovdc_id)
+
+    def end_update(self, ovdc_id):
+        """Drop the metadata of an ovdc, once begin_update() took effect.
+
+        :param str ovdc_id: UUID of the ovdc.
+        """
+        with self._lock:
+            self._updates[ovdc_id] -= 1
+            if self._updates[ovdc_id] <= 0:
+                del self._updates[ovdc_id]
+            self._invalidate(ovdc_id)
+
+    def is_updating(self, ovdc_id=None):
+        """Tell whether the metadata of an ovdc is being updated.
+
+        :param str ovdc_id: UUID of the ovdc, any ovdc if None.
+
+        :rtype: bool
+        """
+        with self._lock:
+            if ovdc_id is None:
+                return len(self._updates) > 0
+            return ovdc_id in self._updates
+
+    def _invalidate(self, ovdc_id):
+        self._generation += 1
+        keys = [key for key, ovdc_metadata in self._cache.items()
+                if ovdc_metadata.ovdc_id == ovdc_id]
+        for key in keys:
+            del self._cache[key]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._updates.clear()
+
+
+OVDC_METADATA_CACHE = OvdcMetadataCache()
+
+
+def _wait_for_metadata_task(task_href, ovdc_id):
+    """Wait for the vCD task setting the metadata of an ovdc to complete.
+
+    The metadata of the ovdc is cached again once the task completed,
+    whatever its status, or timed out.
+
+    :param str task_href: href of the vCD task.
+    :param str ovdc_id: UUID of the ovdc.
+    """
+    try:
+        client = get_vcd_sys_admin_client()
+        try:
+            deadline = time.monotonic() + OVDC_METADATA_TASK_TIMEOUT
+            while time.monotonic() < deadline:
+                status = client.get_resource(task_href).get('status')
+                if status in OVDC_METADATA_TASK_FINAL_STATUSES:
+                    return
+                time.sleep(OVDC_METADATA_TASK_POLL_FREQUENCY)
+            LOGGER.warning(f"Task {task_href} setting the metadata of ovdc "
+                           f"{ovdc_id} did not complete within "
+                           f"{OVDC_METADATA_TASK_TIMEOUT} seconds")
+        finally:
+            release_vcd_sys_admin_client(client)
+    except Exception as err:
+        LOGGER.error(f"Failed to wait for task {task_href} setting the "
+                     f"metadata of ovdc {ovdc_id}: {err}")
+    finally:
+        OVDC_METADATA_CACHE.end_update(ovdc_id)
+
 
 class OvdcCache(object):
 
@@ -93,9 +289,8 @@ class OvdcCache(object):
         :raises EntityNotFoundException: if the ovdc could not be found.
         """
         # Get pvdc and pks information from oVdc metadata
-        ovdc = self.get_ovdc(ovdc_name, ovdc_id, org_name)
-
-        all_metadata = utils.metadata_to_dict(ovdc.get_all_metadata())
+        ovdc_metadata = self.get_ovdc_metadata(ovdc_name, ovdc_id, org_name)
+        all_metadata = ovdc_metadata.metadata
 
         if CONTAINER_PROVIDER_KEY not in all_metadata:
             container_provider = CtrProvType.NONE.value
@@ -113,8 +308,7 @@ class OvdcCache(object):
             }
 
             # Get the credentials from PksCache
-            pvdc_id = self.get_pvdc_id(ovdc)
-            pvdc_info = self.pks_cache.get_pvdc_info(pvdc_id)
+            pvdc_info = self.pks_cache.get_pvdc_info(ovdc_metadata.pvdc_id)
             ctr_prov_details[PKS_PLANS] = \
                 ctr_prov_details[PKS_PLANS].split(',')
             if credentials_required:
@@ -129,6 +323,62 @@ class OvdcCache(object):
 
         return ctr_prov_details
 
+    def get_ovdc_metadata(self, ovdc_name=None, ovdc_id=None, org_name=None):
+        """Get the metadata of given ovdc, from OVDC_METADATA_CACHE if cached.
+
+        :param str ovdc_name: name of the ovdc
+        :param str ovdc_id: UUID of ovdc
+        :param str org_name: specific org to use if @org is not given.
+            If None, uses currently logged-in org from @client.
+
+        :rtype: OvdcMetadata
+
+        :raises EntityNotFoundException: if the ovdc could not be found.
+        """
+        key = ovdc_id if ovdc_id is not None else (org_name, ovdc_name)
+        ovdc_metadata = OVDC_METADATA_CACHE.get(key)
+        if ovdc_metadata is None:
+            generation = OVDC_METADATA_CACHE.get_generation()
+            ovdc = self.get_ovdc(ovdc_name, ovdc_id, org_name)
+            ovdc_metadata = OvdcMetadata(
+                ovdc_id=utils.extract_id(ovdc.resource.get('id')),
+                pvdc_id=self.get_pvdc_id(ovdc),
+                metadata=utils.metadata_to_dict(ovdc.get_all_metadata()))
+            if ovdc_id is None:
+                OVDC_METADATA_CACHE.put(ovdc_metadata, org_name=org_name,
+                                        ovdc_name=ovdc_name,
+                                        generation=generation)
+            else:
+                OVDC_METADATA_CACHE.put(ovdc_metadata, generation=generation)
+        return ovdc_metadata
+
+    def list_ovdc_container_providers(self, org_name=None):
+        """List ovdcs and their container provider, with one paged query.
+
+        :param str org_name: name of the org of the ovdcs, all orgs if None.
+
+        :return: (org name, ovdc name, container provider) tuples.
+
+        :rtype: list
+        """
+        query = self.client.get_typed_query(
+            ResourceType.ADMIN_ORG_VDC.value,
+            query_result_format=QueryResultFormat.RECORDS,
+            page_size=OVDC_QUERY_PAGE_SIZE,
+            equality_filter=None if org_name is None
+            else ('orgName', org_name),
+            fields=f"name,orgName,metadata@SYSTEM:{CONTAINER_PROVIDER_KEY}")
+        ovdcs = []
+        for record in query.execute():
+            container_provider = CtrProvType.NONE.value
+            if hasattr(record, 'Metadata'):
+                for entry in record.Metadata.MetadataEntry:
+                    if entry.Key == CONTAINER_PROVIDER_KEY:
+                        container_provider = str(entry.TypedValue.Value)
+            ovdcs.append((record.get('orgName'), record.get('name'),
+                          container_provider))
+        return ovdcs
+
     def set_ovdc_container_provider_metadata(self,
                                              ovdc,
                                              container_prov_data=None,
@@ -139,6 +389,10 @@ class OvdcCache(object):
         :param dict container_prov_data: container provider context details
         :param str container_provider: name of container provider for which
             the ovdc is being enabled to deploy k8 clusters on.
+
+        :return: the vCD task setting the metadata, which may still be
+            running. The metadata of the ovdc isn't cached until it
+            completes.
         """
         ovdc_name = ovdc.resource.get('name')
         metadata = {}
@@ -158,8 +412,19 @@ class OvdcCache(object):
 
         # set ovdc metadata into Vcd
         LOGGER.debug(f"On ovdc:{ovdc_name}, setting metadata:{metadata}")
-        return ovdc.set_multiple_metadata(metadata, MetadataDomain.SYSTEM,
-                                          MetadataVisibility.PRIVATE)
+        ovdc_id = utils.extract_id(ovdc.resource.get('id'))
+        OVDC_METADATA_CACHE.begin_update(ovdc_id)
+        try:
+            task = ovdc.set_multiple_metadata(metadata,
+                                              MetadataDomain.SYSTEM,
+                                              MetadataVisibility.PRIVATE)
+        except Exception:
+            OVDC_METADATA_CACHE.end_update(ovdc_id)
+            raise
+        # the metadata read until the task completes may be the old one
+        OVDC_METADATA_TASK_EXECUTOR.submit(_wait_for_metadata_task,
+                                           task.get('href'), ovdc_id)
+        return task
 
     def _remove_metadata(self, ovdc, keys=[]):
         metadata = utils.metadata_to_dict(ovdc.get_all_metadata())
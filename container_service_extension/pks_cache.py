@@ -159,6 +159,15 @@ class PksCache(object):
         else:
             return self.vc_to_pks_info_mapper.get(vc_name)
 
+    def get_pks_account_info_by_name(self, account_name):
+        """Return an immutable PksAccountInfo object.
+
+        :param str account_name: name of the PKS account.
+
+        :return: PksAccountInfo object, None if there is no such account.
+        """
+        return self.pks_account_info_table.get(account_name)
+
     def get_exclusive_pks_accounts_info_for_org(self, org_name):
         """Return all pks accounts associated with an org.
 
@@ -4,6 +4,7 @@
 
 from http import HTTPStatus
 import json
+import time
 
 from pyvcloud.vcd.utils import extract_id
 import yaml
@@ -14,6 +15,9 @@ from container_service_extension.exceptions import CseServerError
 from container_service_extension.exceptions import PksConnectionError
 from container_service_extension.exceptions import PksServerError
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import backend_call
+from container_service_extension.metrics import BACKEND_PKS
+from container_service_extension.metrics import observe_backend_call
 from container_service_extension.pks_cache import PKS_COMPUTE_PROFILE
 from container_service_extension.pksclient.api.cluster_api import ClusterApi
 from container_service_extension.pksclient.api.profile_api import ProfileApi
@@ -31,17 +35,47 @@ from container_service_extension.pksclient.rest import ApiException
 from container_service_extension.server_constants import \
     CSE_PKS_DEPLOY_RIGHT_NAME
 from container_service_extension.uaaclient.uaaclient import UaaClient
+from container_service_extension.utils import compute_etag
 from container_service_extension.utils import exception_handler
 from container_service_extension.utils import OK
 
 
 # Delimiter to append with user id context
 USER_ID_SEPARATOR = "---"
+
 # Properties that need to be excluded from cluster info before sending
 # to the client for reasons: security, too big that runs thru lines
 EXCLUDE_KEYS = ['compute_profile']
 
 
+def _instrument_pks_client(pks_client):
+    """Record the calls of a PKS client in the backend metrics.
+
+    Calls failing with a server error, or without a reply, count as errors.
+
+    :param container_service_extension.pksclient.api_client.ApiClient
+        pks_client: the PKS client.
+    """
+    rest_request = pks_client.rest_client.request
+
+    def timed_request(*args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        try:
+            response = rest_request(*args, **kwargs)
+            error = False
+            return response
+        except ApiException as err:
+            error = not err.status or \
+                err.status >= HTTPStatus.INTERNAL_SERVER_ERROR
+            raise
+        finally:
+            observe_backend_call(BACKEND_PKS, time.perf_counter() - start,
+                                 error)
+
+    pks_client.rest_client.request = timed_request
+
+
 class PKSBroker(AbstractBroker):
     """PKSBroker makes API calls to PKS server.
 
@@ -63,6 +97,7 @@ class PKSBroker(AbstractBroker):
                 "PKS context is required to establish connection to PKS")
         self.req_headers = request_headers
         self.req_spec = request_spec
+        self.pks_ctx = pks_ctx
         self.username = pks_ctx['username']
         self.secret = pks_ctx['secret']
         self.pks_host_uri = \
@@ -99,7 +134,8 @@ class PKSBroker(AbstractBroker):
         try:
             uaaClient = UaaClient(self.uaac_uri, self.username, self.secret,
                                   proxy_uri=self.proxy_uri)
-            token = uaaClient.getToken()
+            with backend_call(BACKEND_PKS):
+                token = uaaClient.getToken()
         except Exception as err:
             raise PksConnectionError(f"Connection establishment to PKS host"
                                      f" {self.uaac_uri} failed: {err}")
@@ -121,6 +157,7 @@ class PKSBroker(AbstractBroker):
         """
         pks_config = self._get_pks_config()
         self.pks_client = ApiClient(configuration=pks_config)
+        _instrument_pks_client(self.pks_client)
         return self.pks_client
 
     def list_clusters(self):
@@ -279,6 +316,25 @@ class PKSBroker(AbstractBroker):
             self._restore_original_name(cluster_info)
             return cluster_info
 
+    def get_cluster_version_tag(self, cluster_name, cluster_info=None):
+        """Get the entity tag of the current state of the cluster.
+
+        PKS reports the cluster details in a single call, hence the tag is
+        computed out of the whole cluster information.
+
+        :param str cluster_name: Name of the cluster.
+        :param dict cluster_info: information of the cluster, as returned by
+            get_cluster_info().
+
+        :return: quoted entity tag
+
+        :rtype: str
+        """
+        if cluster_info is None:
+            cluster_info = self.get_cluster_info(cluster_name=cluster_name)
+        return compute_etag(json.dumps(cluster_info, sort_keys=True,
+                                       default=str))
+
     def _get_cluster_info(self, cluster_name):
         """Get the details of a cluster with a given name in PKS environment.
 
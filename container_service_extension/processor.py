@@ -2,188 +2,382 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
-import base64
-from copy import deepcopy
 import json
-import sys
+import logging
+import threading
+import time
 import traceback
-from urllib.parse import parse_qsl
+from types import MappingProxyType
 
 from pkg_resources import resource_string
 import yaml
 
+from container_service_extension.broker_manager import BrokerManager
+from container_service_extension.broker_manager import Operation
 from container_service_extension.exceptions import CseServerError
+from container_service_extension.exceptions import MethodNotAllowedError
+from container_service_extension.exceptions import RouteNotFoundError
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import get_request_backend_time
+from container_service_extension.metrics import GROUP_BACKEND_TIME
+from container_service_extension.metrics import GROUP_OPERATION
+from container_service_extension.metrics import GROUP_PROCESSING
+from container_service_extension.metrics import GROUP_QUEUE_WAIT
+from container_service_extension.metrics import METRICS
+from container_service_extension.metrics import start_request
+from container_service_extension.router import Lane
+from container_service_extension.router import Route
+from container_service_extension.router import Router
+from container_service_extension.router import split_path
+from container_service_extension.utils import compute_etag
+from container_service_extension.utils import get_header
 from container_service_extension.utils import get_server_runtime_config
+from container_service_extension.utils import is_etag_matched
+from container_service_extension.utils import SerializedBody
 
 OK = 200
 CREATED = 201
 ACCEPTED = 202
+NOT_MODIFIED = 304
 UNAUTHORIZED = 401
+NOT_FOUND = 404
+METHOD_NOT_ALLOWED = 405
 INTERNAL_SERVER_ERROR = 500
 
+# requestUri of requests is of the form /api/cse/<path>, number of segments
+# to skip to get to <path>
+REQUEST_URI_PREFIX_LENGTH = 3
+
 
 class ServiceProcessor(object):
-    def process_request(self, body):
-        LOGGER.debug(f"body: {json.dumps(body)}")
-        reply = {}
-        tokens = body['requestUri'].split('/')
-        cluster_name = None
-        node_name = None
-        spec_request = False
-        config_request = False
-        template_request = False
-        node_request = False
-        cluster_info_request = False
-        node_info_request = False
-        system_request = False
-        ovdc_request = False
-        ovdc_id = None
-        ovdc_info_request = False
-
-        if len(tokens) > 3:
-            if tokens[3] in ['swagger', 'swagger.json', 'swagger.yaml']:
-                spec_request = True
-            elif tokens[3] == 'template':
-                template_request = True
-            elif tokens[3] == 'system':
-                system_request = True
-            elif tokens[3] == 'ovdc':
-                ovdc_request = True
-            elif tokens[3] != '':
-                cluster_name = tokens[3]
-        if len(tokens) > 4:
-            if cluster_name is not None:
-                if tokens[4] == 'config':
-                    config_request = True
-                elif tokens[4] == 'info':
-                    cluster_info_request = True
-                elif tokens[4] == 'node':
-                    node_request = True
-                elif tokens[4] != '':
-                    node_name = tokens[4]
-            elif ovdc_request:
-                ovdc_id = tokens[4]
-
-        if len(tokens) > 5:
-            if node_name is not None:
-                if tokens[5] == 'info':
-                    node_info_request = True
-            elif ovdc_request:
-                if tokens[5] == 'info':
-                    ovdc_info_request = True
-        if len(body['body']) > 0:
-            try:
-                request_body = json.loads(
-                    base64.b64decode(body['body']).decode(
-                        sys.getfilesystemencoding()))
-            except Exception:
-                LOGGER.error(traceback.format_exc())
-                request_body = {}
-        else:
-            request_body = {}
-        LOGGER.debug(f"request body: {json.dumps(request_body)}")
+    def process_request(self, request):
+        """Process a request received from vCD.
 
-        query_params = {}
-        if body['queryString']:
-            query_params = dict(parse_qsl(body['queryString']))
+        :param codec.Request request: the request. It is owned by this call:
+            its body, if the route reads it, is handed to the handler as a
+            mutable dict, while its headers and query parameters are handed
+            out as read-only views.
+
+        :return: reply with 'status_code' and 'body' keys.
+
+        :rtype: dict
+        """
+        try:
+            route, path_params = resolve_route(request.method,
+                                               request.request_uri)
+        except RouteNotFoundError as err:
+            return {'status_code': NOT_FOUND, 'body': {'message': str(err)}}
+        except MethodNotAllowedError as err:
+            return {
+                'status_code': METHOD_NOT_ALLOWED,
+                'body': {'message': str(err)}
+            }
+
+        route_name = f"{route.method} /{route.path}"
+        start = start_request()
+        if request.received_at is not None:
+            METRICS.observe(GROUP_QUEUE_WAIT, route_name,
+                            start - request.received_at)
 
         from container_service_extension.service import Service
         service = Service()
-        if not system_request and not service.is_enabled:
+        if route.requires_enabled_service and not service.is_enabled:
             raise CseServerError('CSE service is disabled. '
                                  'Contact the System Administrator.')
 
-        req_headers = deepcopy(body['headers'])
-        req_query_params = deepcopy(query_params)
-        req_spec = deepcopy(request_body)
+        # The request body and query string are decoded only now that the
+        # request is known to be dispatched to a handler, and the body only
+        # if the handler reads it.
+        if route.reads_body:
+            try:
+                req_spec = request.spec
+                if LOGGER.isEnabledFor(logging.DEBUG) and req_spec:
+                    LOGGER.debug(f"request body: {req_spec}")
+            except Exception:
+                LOGGER.error(traceback.format_exc())
+                req_spec = {}
+            req_spec.update(path_params)
+        else:
+            req_spec = path_params
 
-        from container_service_extension.broker_manager import BrokerManager
+        # headers and query params are only ever read by handlers, while
+        # req_spec is modified by some of them. Since the envelope is decoded
+        # afresh for every message, no copies are needed.
+        req_headers = MappingProxyType(request.headers)
+        req_query_params = MappingProxyType(request.query_params)
+
+        error = True
+        try:
+            result = route.handler(self, req_headers, req_query_params,
+                                   req_spec)
+            error = result['status_code'] >= INTERNAL_SERVER_ERROR
+            return result
+        finally:
+            METRICS.observe(GROUP_PROCESSING, route_name,
+                            time.perf_counter() - start, error)
+            METRICS.observe(GROUP_BACKEND_TIME, route_name,
+                            get_request_backend_time(), error)
+
+    def _invoke_broker_manager(self, op, req_headers, req_query_params,
+                               req_spec):
+        start = time.perf_counter()
+        error = True
+        try:
+            broker_manager = BrokerManager(req_headers, req_query_params,
+                                           req_spec)
+            result = broker_manager.invoke(op)
+            error = result['status_code'] >= INTERNAL_SERVER_ERROR
+            return result
+        finally:
+            METRICS.observe(GROUP_OPERATION, op.value,
+                            time.perf_counter() - start, error)
+
+    def _get_broker(self, req_headers, req_query_params, req_spec):
         broker_manager = BrokerManager(req_headers, req_query_params, req_spec)
-        from container_service_extension.broker_manager import Operation
-
-        if body['method'] == 'GET':
-            if ovdc_info_request:
-                req_spec.update({'ovdc_id': ovdc_id})
-                reply = broker_manager.invoke(Operation.INFO_OVDC)
-            elif ovdc_request:
-                reply = broker_manager.invoke(op=Operation.LIST_OVDCS)
-            elif spec_request:
-                reply = self.get_spec(tokens[3])
-            elif config_request:
-                req_spec.update({'cluster_name': cluster_name})
-                reply = broker_manager.invoke(Operation.GET_CLUSTER_CONFIG)
-            elif template_request:
-                result = {}
-                templates = []
-                server_config = get_server_runtime_config()
-                default_template_name = \
-                    server_config['broker']['default_template']
-                for t in server_config['broker']['templates']:
-                    is_default = t['name'] == default_template_name
-                    templates.append({
-                        'name': t['name'],
-                        'is_default': is_default,
-                        'catalog': server_config['broker']['catalog'],
-                        'catalog_item': t['catalog_item'],
-                        'description': t['description']
-                    })
-                result['body'] = templates
-                result['status_code'] = 200
-                reply = result
-            elif cluster_info_request:
-                req_spec.update({'cluster_name': cluster_name})
-                reply = broker_manager.invoke(Operation.GET_CLUSTER)
-            elif node_info_request:
-                broker = broker_manager.get_broker_based_on_vdc()
-                reply = broker.get_node_info(cluster_name, node_name)
-            elif system_request:
-                result = {}
-                result['body'] = service.info(req_headers)
-                result['status_code'] = OK
-                reply = result
-            elif cluster_name is None:
-                reply = broker_manager.invoke(Operation.LIST_CLUSTERS)
-        elif body['method'] == 'POST':
-            if cluster_name is None:
-                reply = broker_manager.invoke(Operation.CREATE_CLUSTER)
-            else:
-                if node_request:
-                    broker = broker_manager.get_broker_based_on_vdc()
-                    reply = broker.create_nodes()
-        elif body['method'] == 'PUT':
-            if ovdc_info_request:
-                reply = broker_manager.invoke(Operation.ENABLE_OVDC)
-            elif system_request:
-                reply = service.update_status(req_headers, req_spec)
-            else:
-                req_spec.update({'cluster_name': cluster_name})
-                reply = broker_manager.invoke(Operation.RESIZE_CLUSTER)
-        elif body['method'] == 'DELETE':
-            if node_request:
-                broker = broker_manager.get_broker_based_on_vdc()
-                reply = broker.delete_nodes()
-            else:
-                req_spec.update({'cluster_name': cluster_name})
-                reply = broker_manager.invoke(Operation.DELETE_CLUSTER)
-
-        LOGGER.debug(f"reply: {str(reply)}")
-        return reply
-
-    def get_spec(self, format):
+        try:
+            return broker_manager.get_broker_based_on_vdc()
+        finally:
+            broker_manager.close()
+
+    def list_clusters(self, req_headers, req_query_params, req_spec):
+        return self._invoke_broker_manager(Operation.LIST_CLUSTERS,
+                                           req_headers, req_query_params,
+                                           req_spec)
+
+    def create_cluster(self, req_headers, req_query_params, req_spec):
+        return self._invoke_broker_manager(Operation.CREATE_CLUSTER,
+                                           req_headers, req_query_params,
+                                           req_spec)
+
+    def get_cluster_info(self, req_headers, req_query_params, req_spec):
+        return self._invoke_broker_manager(Operation.GET_CLUSTER,
+                                           req_headers, req_query_params,
+                                           req_spec)
+
+    def get_cluster_config(self, req_headers, req_query_params, req_spec):
+        return self._invoke_broker_manager(Operation.GET_CLUSTER_CONFIG,
+                                           req_headers, req_query_params,
+                                           req_spec)
+
+    def resize_cluster(self, req_headers, req_query_params, req_spec):
+        return self._invoke_broker_manager(Operation.RESIZE_CLUSTER,
+                                           req_headers, req_query_params,
+                                           req_spec)
+
+    def delete_cluster(self, req_headers, req_query_params, req_spec):
+        return self._invoke_broker_manager(Operation.DELETE_CLUSTER,
+                                           req_headers, req_query_params,
+                                           req_spec)
+
+    def create_nodes(self, req_headers, req_query_params, req_spec):
+        broker = self._get_broker(req_headers, req_query_params, req_spec)
+        return broker.create_nodes()
+
+    def delete_nodes(self, req_headers, req_query_params, req_spec):
+        broker = self._get_broker(req_headers, req_query_params, req_spec)
+        return broker.delete_nodes()
+
+    def get_node_info(self, req_headers, req_query_params, req_spec):
+        broker = self._get_broker(req_headers, req_query_params, req_spec)
+        return broker.get_node_info(req_spec['cluster_name'],
+                                    req_spec['node_name'])
+
+    def list_ovdcs(self, req_headers, req_query_params, req_spec):
+        return self._invoke_broker_manager(Operation.LIST_OVDCS,
+                                           req_headers, req_query_params,
+                                           req_spec)
+
+    def get_ovdc_info(self, req_headers, req_query_params, req_spec):
+        return self._invoke_broker_manager(Operation.INFO_OVDC,
+                                           req_headers, req_query_params,
+                                           req_spec)
+
+    def enable_ovdc(self, req_headers, req_query_params, req_spec):
+        return self._invoke_broker_manager(Operation.ENABLE_OVDC,
+                                           req_headers, req_query_params,
+                                           req_spec)
+
+    def list_templates(self, req_headers, req_query_params, req_spec):
+        result = {}
+        templates = []
+        server_config = get_server_runtime_config()
+        default_template_name = server_config['broker']['default_template']
+        for t in server_config['broker']['templates']:
+            is_default = t['name'] == default_template_name
+            templates.append({
+                'name': t['name'],
+                'is_default': is_default,
+                'catalog': server_config['broker']['catalog'],
+                'catalog_item': t['catalog_item'],
+                'description': t['description']
+            })
+        result['body'] = templates
+        result['status_code'] = OK
+        return result
+
+    def get_system_info(self, req_headers, req_query_params, req_spec):
+        from container_service_extension.service import Service
+        result = {}
+        result['body'] = Service().info(req_headers)
+        result['status_code'] = OK
+        return result
+
+    def update_system_status(self, req_headers, req_query_params, req_spec):
+        from container_service_extension.service import Service
+        return Service().update_status(req_headers, req_spec)
+
+    def get_json_spec(self, req_headers, req_query_params, req_spec):
+        return self.get_spec(SPEC_FORMAT_JSON, req_headers)
+
+    def get_yaml_spec(self, req_headers, req_query_params, req_spec):
+        return self.get_spec(SPEC_FORMAT_YAML, req_headers)
+
+    def get_spec(self, format, req_headers=None):
+        """Get the swagger spec of CSE api.
+
+        :param str format: SPEC_FORMAT_JSON or SPEC_FORMAT_YAML.
+        :param dict req_headers: request headers. If the If-None-Match header
+            matches the ETag of the spec, a 304 reply without body is
+            returned.
+
+        :return: reply with 'status_code', 'body' and 'headers' keys.
+
+        :rtype: dict
+        """
         result = {}
         try:
-            file_name = resource_string('container_service_extension',
-                                        'swagger/swagger.yaml')
-            if format == 'swagger.yaml':
-                result['body'] = file_name
-            else:
-                spec = yaml.safe_load(file_name)
-                result['body'] = json.loads(json.dumps(spec))
-            result['status_code'] = OK
+            spec_replies = load_spec()
         except Exception:
             LOGGER.error(traceback.format_exc())
             result['body'] = []
             result['status_code'] = INTERNAL_SERVER_ERROR
             result['message'] = 'spec file not found: check installation.'
+            return result
+
+        body, etag = spec_replies[format]
+        result['headers'] = {'ETag': etag}
+        if req_headers is not None and is_etag_matched(
+                get_header(req_headers, 'If-None-Match'), etag):
+            result['body'] = SerializedBody()
+            result['status_code'] = NOT_MODIFIED
+        else:
+            result['body'] = body
+            result['status_code'] = OK
         return result
+
+
+SPEC_FORMAT_JSON = 'swagger.json'
+SPEC_FORMAT_YAML = 'swagger.yaml'
+
+# mapping of spec format -> (serialized reply body, ETag), see load_spec()
+_spec_replies = {}
+_spec_replies_lock = threading.Lock()
+
+
+def load_spec():
+    """Load the swagger spec of CSE api and build the replies serving it.
+
+    The spec file is read and converted only once, by the first call. CSE
+    server calls this at startup.
+
+    :return: mapping of spec format -> (serialized reply body, ETag)
+
+    :rtype: dict
+
+    :raises Exception: if the spec file can't be read or parsed.
+    """
+    if _spec_replies:
+        return _spec_replies
+    with _spec_replies_lock:
+        if not _spec_replies:
+            spec_yaml = resource_string('container_service_extension',
+                                        'swagger/swagger.yaml')
+            spec = yaml.safe_load(spec_yaml)
+            yaml_body = SerializedBody(json.dumps(spec_yaml.decode()))
+            json_body = SerializedBody(json.dumps(spec))
+            _spec_replies[SPEC_FORMAT_YAML] = \
+                (yaml_body, compute_etag(SPEC_FORMAT_YAML, spec_yaml))
+            _spec_replies[SPEC_FORMAT_JSON] = \
+                (json_body, compute_etag(SPEC_FORMAT_JSON, spec_yaml))
+    return _spec_replies
+
+
+# Routes served by ServiceProcessor, paths are relative to /api/cse
+ROUTES = [
+    Route('GET', '', ServiceProcessor.list_clusters, True, Lane.READ, False),
+    Route('POST', '', ServiceProcessor.create_cluster, True, Lane.MUTATE,
+          True),
+    Route('GET', 'swagger', ServiceProcessor.get_json_spec, True, Lane.READ,
+          False),
+    Route('GET', 'swagger.json', ServiceProcessor.get_json_spec, True,
+          Lane.READ, False),
+    Route('GET', 'swagger.yaml', ServiceProcessor.get_yaml_spec, True,
+          Lane.READ, False),
+    Route('GET', 'template', ServiceProcessor.list_templates, True,
+          Lane.READ, False),
+    Route('GET', 'system', ServiceProcessor.get_system_info, False,
+          Lane.ADMIN, False),
+    Route('PUT', 'system', ServiceProcessor.update_system_status, False,
+          Lane.ADMIN, True),
+    Route('GET', 'ovdc', ServiceProcessor.list_ovdcs, True, Lane.READ,
+          False),
+    Route('GET', 'ovdc/{ovdc_id}/info', ServiceProcessor.get_ovdc_info, True,
+          Lane.READ, False),
+    Route('PUT', 'ovdc/{ovdc_id}/info', ServiceProcessor.enable_ovdc, True,
+          Lane.ADMIN, True),
+    Route('PUT', '{cluster_name}', ServiceProcessor.resize_cluster, True,
+          Lane.MUTATE, True),
+    Route('DELETE', '{cluster_name}', ServiceProcessor.delete_cluster, True,
+          Lane.MUTATE, False),
+    Route('GET', '{cluster_name}/info', ServiceProcessor.get_cluster_info,
+          True, Lane.READ, False),
+    Route('GET', '{cluster_name}/config',
+          ServiceProcessor.get_cluster_config, True, Lane.READ, False),
+    Route('POST', '{cluster_name}/node', ServiceProcessor.create_nodes, True,
+          Lane.MUTATE, True),
+    Route('DELETE', '{cluster_name}/node', ServiceProcessor.delete_nodes,
+          True, Lane.MUTATE, True),
+    Route('GET', '{cluster_name}/{node_name}/info',
+          ServiceProcessor.get_node_info, True, Lane.READ, False),
+]
+
+ROUTER = Router(ROUTES)
+
+
+def resolve_route(method, request_uri):
+    """Find the route serving a request.
+
+    :param str method: HTTP method of the request.
+    :param str request_uri: requestUri of the request, e.g.
+        /api/cse/mycluster/info
+
+    :return: a tuple of the matching route and a dict of the captured path
+        parameters.
+
+    :rtype: tuple
+
+    :raises RouteNotFoundError: if no route matches the request path.
+    :raises MethodNotAllowedError: if the request method is not allowed on
+        the request path.
+    """
+    uri_tokens = request_uri.split('/', REQUEST_URI_PREFIX_LENGTH)
+    path_segments = split_path(uri_tokens[REQUEST_URI_PREFIX_LENGTH]) \
+        if len(uri_tokens) > REQUEST_URI_PREFIX_LENGTH else []
+    return ROUTER.resolve(method, path_segments)
+
+
+def get_request_lane(request):
+    """Get the lane of a request.
+
+    Requests that match no route get a cheap error reply, and belong to the
+    read lane.
+
+    :param codec.Request request: the request.
+
+    :rtype: Lane
+    """
+    try:
+        route, _ = resolve_route(request.method, request.request_uri)
+    except (RouteNotFoundError, MethodNotAllowedError):
+        return Lane.READ
+    return route.lane
@@ -0,0 +1,157 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+from collections import namedtuple
+from enum import Enum
+from enum import unique
+
+from container_service_extension.exceptions import MethodNotAllowedError
+from container_service_extension.exceptions import RouteNotFoundError
+
+
+@unique
+class Lane(Enum):
+    """Class of requests processed by a dedicated pool of threads."""
+
+    # requests that only read state, e.g. list or info of clusters
+    READ = 'read'
+    # requests that create, modify or delete clusters
+    MUTATE = 'mutate'
+    # system administration requests, e.g. CSE server info or shutdown
+    ADMIN = 'admin'
+
+
+class Route(namedtuple('Route', 'method, path, handler, '
+                                'requires_enabled_service, lane, '
+                                'reads_body')):
+    """A request route served by CSE server.
+
+    method: HTTP method of the request, e.g. 'GET'.
+    path: path of the request relative to the CSE api extension endpoint,
+        with segments separated by '/'. A segment enclosed in braces, e.g.
+        '{cluster_name}', matches any value, which is captured as a named
+        path parameter.
+    handler: callable that serves requests matching this route.
+    requires_enabled_service: if True, requests can be served only while CSE
+        service is enabled.
+    lane: Lane of the requests.
+    reads_body: if True, the body of the requests is decoded and handed to
+        the handler as its request spec, along with the path parameters.
+        Otherwise the request spec only holds the path parameters.
+    """
+
+
+class _RouteNode(object):
+    """A node of the route trie, representing one path segment."""
+
+    __slots__ = ['literal_children', 'param_name', 'param_child', 'routes']
+
+    def __init__(self):
+        # mapping of literal segment -> _RouteNode
+        self.literal_children = {}
+        # name and node of the parameterized segment under this node
+        self.param_name = None
+        self.param_child = None
+        # mapping of method -> Route, for paths ending at this node
+        self.routes = {}
+
+
+def split_path(path):
+    """Split a request path into its segments.
+
+    Leading and trailing slashes are ignored.
+
+    :param str path: path relative to the CSE api extension endpoint.
+
+    :return: list of path segments
+
+    :rtype: list
+    """
+    path = path.strip('/')
+    if not path:
+        return []
+    return path.split('/')
+
+
+class Router(object):
+    """Dispatch table mapping request method and path to a route.
+
+    Routes are compiled into a trie of path segments once, at construction.
+    Resolving a request walks one trie node per path segment and does a dict
+    lookup per node, regardless of the number of routes. Literal segments
+    take precedence over parameterized segments, i.e. with routes 'system'
+    and '{cluster_name}', path 'system' resolves to the former.
+    """
+
+    def __init__(self, routes):
+        """Compile the given routes.
+
+        :param list routes: list of Route objects.
+
+        :raises ValueError: if two routes share the same method and path, or
+            if parameters at the same position of two routes have different
+            names.
+        """
+        self._root = _RouteNode()
+        self.routes = tuple(routes)
+        for route in self.routes:
+            self._add(route)
+
+    def _add(self, route):
+        node = self._root
+        for segment in split_path(route.path):
+            if segment.startswith('{') and segment.endswith('}'):
+                param_name = segment[1:-1]
+                if node.param_child is None:
+                    node.param_name = param_name
+                    node.param_child = _RouteNode()
+                elif node.param_name != param_name:
+                    raise ValueError(f"Conflicting path parameters "
+                                     f"'{node.param_name}' and "
+                                     f"'{param_name}' in route {route}")
+                node = node.param_child
+            else:
+                node = node.literal_children.setdefault(segment, _RouteNode())
+        if route.method in node.routes:
+            raise ValueError(f"Duplicate route {route}")
+        node.routes[route.method] = route
+
+    def resolve(self, method, path_segments):
+        """Find the route serving a request.
+
+        :param str method: HTTP method of the request.
+        :param list path_segments: segments of the request path relative to
+            the CSE api extension endpoint, as returned by split_path().
+
+        :return: a tuple of the matching route and a dict of the captured
+            path parameters.
+
+        :rtype: tuple
+
+        :raises RouteNotFoundError: if no route matches the request path.
+        :raises MethodNotAllowedError: if routes match the request path, but
+            none of them serves the request method.
+        """
+        node = self._root
+        path_params = {}
+        for segment in path_segments:
+            child = node.literal_children.get(segment)
+            if child is None:
+                child = node.param_child
+                if child is None:
+                    raise RouteNotFoundError(
+                        f"Resource '/{'/'.join(path_segments)}' not found.")
+                path_params[node.param_name] = segment
+            node = child
+
+        route = node.routes.get(method)
+        if route is None:
+            if not node.routes:
+                raise RouteNotFoundError(
+                    f"Resource '/{'/'.join(path_segments)}' not found.")
+            raise MethodNotAllowedError(
+                f"Method {method} not allowed on resource "
+                f"'/{'/'.join(path_segments)}'. Allowed methods: "
+                f"{', '.join(sorted(node.routes))}.")
+        return route, path_params
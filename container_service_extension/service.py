@@ -2,6 +2,7 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+from concurrent.futures import ThreadPoolExecutor
 import platform
 import signal
 import sys
@@ -16,6 +17,8 @@ from pyvcloud.vcd.client import BasicLoginCredentials
 from pyvcloud.vcd.client import Client
 import requests
 
+from container_service_extension.admission import OperationAdmission
+from container_service_extension.broker_manager import READ_SINGLE_FLIGHT
 from container_service_extension.configure_cse import check_cse_installation
 from container_service_extension.configure_cse import get_validated_config
 from container_service_extension.consumer import MessageConsumer
@@ -24,8 +27,23 @@ from container_service_extension.logger import SERVER_DEBUG_LOG_FILEPATH
 from container_service_extension.logger import SERVER_DEBUG_WIRELOG_FILEPATH
 from container_service_extension.logger import SERVER_INFO_LOG_FILEPATH
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import backend_call
+from container_service_extension.metrics import BACKEND_VCD
+from container_service_extension.metrics import METRICS
+from container_service_extension.metrics_exporter import \
+    format_metric_families
+from container_service_extension.metrics_exporter import \
+    get_cache_metric_families
+from container_service_extension.metrics_exporter import \
+    get_latency_metric_families
+from container_service_extension.metrics_exporter import MetricFamily
+from container_service_extension.metrics_exporter import MetricsServer
 from container_service_extension.pks_cache import PksCache
+from container_service_extension.processor import load_spec
+from container_service_extension.router import Lane
+from container_service_extension.session_pool import SysAdminSessionPool
 from container_service_extension.utils import connect_vcd_user_via_token
+from container_service_extension.utils import instrument_vcd_client
 from container_service_extension.utils import SYSTEM_ORG_NAME
 
 
@@ -62,8 +80,14 @@ class Service(object, metaclass=Singleton):
         self.is_enabled = False
         self.consumers = []
         self.threads = []
+        # mapping of router.Lane -> pool of threads processing its requests
+        self.processor_pools = {}
         self.should_stop = False
         self.pks_cache = None
+        self.operation_admission = OperationAdmission()
+        self.metrics_server = None
+        self.sys_admin_session_pool = SysAdminSessionPool(
+            self._login_sys_admin)
 
     def get_service_config(self):
         return self.config
@@ -71,7 +95,29 @@ class Service(object, metaclass=Singleton):
     def get_pks_cache(self):
         return self.pks_cache
 
+    def get_operation_admission(self):
+        return self.operation_admission
+
     def get_sys_admin_client(self):
+        """Check out a system administrator client of the session pool.
+
+        :return: the client, to be released with release_sys_admin_client()
+            rather than logged out, or None if the service is not configured.
+
+        :rtype: pyvcloud.vcd.client.Client
+        """
+        if self.config is not None:
+            return self.sys_admin_session_pool.checkout()
+        return None
+
+    def release_sys_admin_client(self, client):
+        """Check a client of get_sys_admin_client() back in the pool.
+
+        :param pyvcloud.vcd.client.Client client: the client.
+        """
+        self.sys_admin_session_pool.checkin(client)
+
+    def _login_sys_admin(self):
         if self.config is not None:
             if not self.config['vcd']['verify']:
                 LOGGER.warning("InsecureRequestWarning: Unverified HTTPS "
@@ -89,18 +135,73 @@ class Service(object, metaclass=Singleton):
             credentials = BasicLoginCredentials(self.config['vcd']['username'],
                                                 SYSTEM_ORG_NAME,
                                                 self.config['vcd']['password'])
-            client.set_credentials(credentials)
+            with backend_call(BACKEND_VCD):
+                client.set_credentials(credentials)
+            instrument_vcd_client(client)
             return client
         return None
 
     def active_requests_count(self):
-        n = 0
         # TODO(request_count) Add support for PksBroker - VCDA-938
-        for t in threading.enumerate():
-            from container_service_extension.vcdbroker import VcdBroker
-            if type(t) == VcdBroker:
-                n += 1
-        return n
+        return self.operation_admission.get_metrics()['in_progress']
+
+    def collect_metrics(self):
+        """Collect the metrics of CSE server for Prometheus.
+
+        :return: metrics in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+        families = get_latency_metric_families(METRICS.snapshot())
+        consumer_states = [c.get_state() for c in self.consumers]
+        families.append(MetricFamily(
+            'cse_amqp_listener_connected', 'gauge',
+            'Whether the AMQP connection of a listener is open.',
+            [('', {'listener': str(n)}, state['connected'])
+             for n, state in enumerate(consumer_states)]))
+        families.append(MetricFamily(
+            'cse_amqp_listener_consuming_channels', 'gauge',
+            'Number of channels of a listener consuming requests.',
+            [('', {'listener': str(n)}, state['consuming_channels'])
+             for n, state in enumerate(consumer_states)]))
+        families.append(MetricFamily(
+            'cse_dropped_stale_requests_total', 'counter',
+            'Requests dropped for being older than max_request_age.',
+            [('', {}, sum(c.stale_request_count for c in self.consumers))]))
+        operations = self.operation_admission.get_metrics()
+        families.append(MetricFamily(
+            'cse_long_running_operations_in_progress', 'gauge',
+            'Cluster and node creations and deletions in progress.',
+            [('', {}, operations['in_progress'])]))
+        families.append(MetricFamily(
+            'cse_long_running_operations_refused_total', 'counter',
+            'Cluster and node creations and deletions refused.',
+            [('', {}, operations['refused'])]))
+        sys_admin_sessions = self.sys_admin_session_pool.get_metrics()
+        families.append(MetricFamily(
+            'cse_sys_admin_sessions', 'gauge',
+            'Pooled system administrator sessions of vCD.',
+            [('', {'state': 'idle'}, sys_admin_sessions['idle']),
+             ('', {'state': 'checked_out'},
+              sys_admin_sessions['checked_out'])]))
+        families.append(MetricFamily(
+            'cse_sys_admin_logins_total', 'counter',
+            'Logins of system administrator sessions to vCD.',
+            [('', {}, sys_admin_sessions['logins'])]))
+        read_requests = READ_SINGLE_FLIGHT.get_metrics()
+        families.append(MetricFamily(
+            'cse_read_requests_executed_total', 'counter',
+            'List requests that queried vCD and PKS.',
+            [('', {}, read_requests['executed'])]))
+        families.append(MetricFamily(
+            'cse_read_requests_coalesced_total', 'counter',
+            'List requests that shared the result of an identical request.',
+            [('', {}, read_requests['coalesced'])]))
+        families.extend(get_cache_metric_families(METRICS.cache_snapshot()))
+        families.append(MetricFamily(
+            'cse_service_enabled', 'gauge', 'Whether CSE server is enabled.',
+            [('', {}, self.is_enabled)]))
+        return format_metric_families(families)
 
     def get_status(self):
         if self.is_enabled:
@@ -119,8 +220,23 @@ class Service(object, metaclass=Singleton):
         result = Service.version()
         if tenant_client.is_sysadmin():
             result['consumer_threads'] = len(self.threads)
+            result['consumer_channels'] = \
+                sum(c.num_channels for c in self.consumers)
+            result['processor_threads'] = {
+                lane.value: self.config['service'][f"{lane.value}_processors"]
+                for lane in Lane
+            }
             result['all_threads'] = threading.activeCount()
             result['requests_in_progress'] = self.active_requests_count()
+            result['coalesced_read_requests'] = \
+                READ_SINGLE_FLIGHT.get_metrics()
+            result['long_running_operations'] = \
+                self.operation_admission.get_metrics()
+            result['sys_admin_sessions'] = \
+                self.sys_admin_session_pool.get_metrics()
+            result['dropped_stale_requests'] = \
+                sum(c.stale_request_count for c in self.consumers)
+            result['metrics'] = METRICS.snapshot()
             result['config_file'] = self.config_file
             result['status'] = self.get_status()
         else:
@@ -199,6 +315,12 @@ class Service(object, metaclass=Singleton):
         click.secho(message)
         LOGGER.info(message)
 
+        # keep about a session per processor thread, which is the most
+        # requests can use at once
+        self.sys_admin_session_pool.max_idle_sessions = sum(
+            self.config['service'][f"{lane.value}_processors"]
+            for lane in Lane)
+
         if self.config.get('pks_config'):
             self.pks_cache = PksCache(
                 pks_servers=self.config.get('pks_config').get('pks_servers'),
@@ -207,14 +329,60 @@ class Service(object, metaclass=Singleton):
                 orgs=self.config.get('pks_config').get('orgs'),
                 nsxt_servers=self.config.get('pks_config').get('nsxt_servers'))
 
+        try:
+            load_spec()
+        except Exception:
+            LOGGER.error(f"Unable to load swagger spec: "
+                         f"{traceback.format_exc()}")
+
+        self.operation_admission = OperationAdmission(
+            max_operations=self.config['service']['max_operations'],
+            max_operations_per_org=self.config['service'][
+                'max_operations_per_org'],
+            retry_after=self.config['service']['operation_retry_after'])
+
+        metrics_port = self.config['service']['metrics_port']
+        if metrics_port > 0:
+            try:
+                self.metrics_server = MetricsServer(
+                    self.config['service']['metrics_address'], metrics_port,
+                    self.collect_metrics)
+                self.metrics_server.start()
+            except OSError:
+                LOGGER.error(f"Unable to start metrics server: "
+                             f"{traceback.format_exc()}")
+
         amqp = self.config['amqp']
         num_consumers = self.config['service']['listeners']
-        for n in range(num_consumers):
+        channels_per_connection = \
+            self.config['service']['channels_per_connection']
+        # every lane has its own pool, so that e.g. a wave of cluster
+        # creations doesn't hold up cluster listings
+        for lane in Lane:
+            num_processors = self.config['service'][f"{lane.value}_processors"]
+            self.processor_pools[lane] = ThreadPoolExecutor(
+                max_workers=num_processors,
+                thread_name_prefix=f"ServiceProcessor-{lane.value}")
+            LOGGER.info(f"Request processor pool size of {lane.value} lane: "
+                        f"{num_processors}")
+        # listeners are spread over as few AMQP connections as possible,
+        # each connection carrying up to channels_per_connection consumers
+        num_connections = -(-num_consumers // channels_per_connection)
+        for n in range(num_connections):
+            num_channels = min(channels_per_connection,
+                               num_consumers - n * channels_per_connection)
             try:
                 c = MessageConsumer(
                     amqp['host'], amqp['port'], amqp['ssl'], amqp['vhost'],
                     amqp['username'], amqp['password'], amqp['exchange'],
-                    amqp['routing_key'])
+                    amqp['routing_key'], processor_pools=self.processor_pools,
+                    prefetch_count=self.config['service']['prefetch_count'],
+                    ack_after_reply=self.config['service']['ack_after_reply'],
+                    num_channels=num_channels,
+                    compression_threshold=self.config['service'][
+                        'reply_compression_threshold'],
+                    max_request_age=self.config['service'][
+                        'max_request_age'])
                 name = 'MessageConsumer-%s' % n
                 t = Thread(name=name, target=consumer_thread, args=(c, ))
                 t.daemon = True
@@ -222,7 +390,6 @@ class Service(object, metaclass=Singleton):
                 LOGGER.info("Started thread {t.ident}")
                 self.threads.append(t)
                 self.consumers.append(c)
-                time.sleep(0.25)
             except KeyboardInterrupt:
                 break
             except Exception:
@@ -232,11 +399,16 @@ class Service(object, metaclass=Singleton):
 
         self.is_enabled = True
 
+        last_keep_alive = time.monotonic()
         while True:
             try:
                 time.sleep(1)
                 if self.should_stop and self.active_requests_count() == 0:
                     break
+                if time.monotonic() - last_keep_alive > \
+                        self.sys_admin_session_pool.validate_after:
+                    self.sys_admin_session_pool.keep_alive()
+                    last_keep_alive = time.monotonic()
             except KeyboardInterrupt:
                 break
             except Exception:
@@ -244,10 +416,17 @@ class Service(object, metaclass=Singleton):
                 sys.exit(1)
 
         LOGGER.info("Stop detected")
+        LOGGER.info("Waiting for requests in the processor pools to "
+                    "finish...")
+        for processor_pool in self.processor_pools.values():
+            processor_pool.shutdown(wait=True)
         LOGGER.info("Closing connections...")
         for c in self.consumers:
             try:
                 c.stop()
             except Exception:
                 pass
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.sys_admin_session_pool.close()
         LOGGER.info("Done")
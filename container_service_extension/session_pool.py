@@ -0,0 +1,184 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import collections
+import threading
+import time
+
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+
+# seconds a session may stay idle before it is checked for expiry
+DEFAULT_VALIDATE_AFTER = 60
+# seconds after which a session is logged out for good, well before vCD
+# expires it, whatever its activity
+DEFAULT_MAX_SESSION_AGE = 8 * 60 * 60
+
+
+class _IdleSession(collections.namedtuple('_IdleSession',
+                                          'client, login_time, idle_since')):
+    """A logged in client waiting in the pool."""
+
+
+class SysAdminSessionPool(object):
+    """Pool of logged in system administrator sessions of vCD.
+
+    Logging in to vCD takes a few round trips, while most uses of the system
+    administrator client only make a call or two. Clients are hence checked
+    out of the pool and checked back in after use, rather than logged in and
+    out. Sessions idle for long are checked for expiry on checkout and kept
+    alive by keep_alive(), and expired sessions are replaced by new ones
+    transparently.
+    """
+
+    def __init__(self, login, max_idle_sessions=8,
+                 validate_after=DEFAULT_VALIDATE_AFTER,
+                 max_session_age=DEFAULT_MAX_SESSION_AGE):
+        """Initialize the pool, without logging in yet.
+
+        :param callable login: returns a new logged in
+            pyvcloud.vcd.client.Client.
+        :param int max_idle_sessions: maximum number of sessions kept in the
+            pool, the others are logged out on checkin.
+        :param float validate_after: seconds a session may stay idle before
+            it is checked for expiry.
+        :param float max_session_age: seconds after which a session is
+            logged out instead of reused.
+        """
+        self.login = login
+        self.max_idle_sessions = max_idle_sessions
+        self.validate_after = validate_after
+        self.max_session_age = max_session_age
+        self._lock = threading.Lock()
+        # most recently checked in last, hence reused first
+        self._idle_sessions = collections.deque()
+        # mapping of checked out client -> its login time
+        self._login_times = {}
+        self._closed = False
+        self._login_count = 0
+        self._expired_count = 0
+
+    def checkout(self):
+        """Get a logged in client for the exclusive use of the caller.
+
+        :return: the client, to be checked back in with checkin().
+
+        :rtype: pyvcloud.vcd.client.Client
+        """
+        while True:
+            with self._lock:
+                if not self._idle_sessions:
+                    break
+                session = self._idle_sessions.pop()
+            now = time.monotonic()
+            if now - session.login_time > self.max_session_age:
+                self._logout(session.client)
+                continue
+            if now - session.idle_since > self.validate_after and \
+                    not self._is_alive(session.client):
+                continue
+            with self._lock:
+                self._login_times[session.client] = session.login_time
+            return session.client
+
+        client = self.login()
+        with self._lock:
+            self._login_count += 1
+            self._login_times[client] = time.monotonic()
+        return client
+
+    def checkin(self, client):
+        """Put back a client obtained with checkout().
+
+        :param pyvcloud.vcd.client.Client client: the client, which must not
+            be used by the caller afterwards.
+        """
+        with self._lock:
+            login_time = self._login_times.pop(client, None)
+            if login_time is not None and not self._closed and \
+                    len(self._idle_sessions) < self.max_idle_sessions:
+                self._idle_sessions.append(
+                    _IdleSession(client, login_time, time.monotonic()))
+                return
+        self._logout(client)
+
+    def discard(self, client):
+        """Log out a client obtained with checkout(), e.g. after it failed.
+
+        :param pyvcloud.vcd.client.Client client: the client.
+        """
+        with self._lock:
+            self._login_times.pop(client, None)
+        self._logout(client)
+
+    def keep_alive(self):
+        """Refresh the sessions idle for long, dropping the expired ones.
+
+        Meant to be called periodically, more often than the idle timeout of
+        vCD sessions.
+        """
+        now = time.monotonic()
+        with self._lock:
+            stale_sessions = [
+                session for session in self._idle_sessions
+                if now - session.idle_since > self.validate_after]
+            for session in stale_sessions:
+                self._idle_sessions.remove(session)
+        for session in stale_sessions:
+            if now - session.login_time > self.max_session_age:
+                self._logout(session.client)
+            elif self._is_alive(session.client):
+                self._put_back(session)
+
+    def close(self):
+        """Log out the idle sessions, and those checked in from now on."""
+        with self._lock:
+            self._closed = True
+            idle_sessions = list(self._idle_sessions)
+            self._idle_sessions.clear()
+        for session in idle_sessions:
+            self._logout(session.client)
+
+    def get_metrics(self):
+        """Get counters of sessions.
+
+        :return: dict with keys 'idle' (sessions in the pool), 'checked_out'
+            (sessions in use), 'logins' (logins so far) and 'expired'
+            (sessions found expired so far).
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'idle': len(self._idle_sessions),
+                'checked_out': len(self._login_times),
+                'logins': self._login_count,
+                'expired': self._expired_count
+            }
+
+    def _is_alive(self, client):
+        try:
+            client.get_resource(f"{client.get_api_uri()}/session")
+            return True
+        except Exception as err:
+            LOGGER.debug(f"System administrator session expired: {err}")
+            with self._lock:
+                self._expired_count += 1
+            self._logout(client)
+            return False
+
+    def _put_back(self, session):
+        with self._lock:
+            if not self._closed and \
+                    len(self._idle_sessions) < self.max_idle_sessions:
+                self._idle_sessions.appendleft(
+                    session._replace(idle_since=time.monotonic()))
+                return
+        self._logout(session.client)
+
+    @staticmethod
+    def _logout(client):
+        try:
+            client.logout()
+        except Exception as err:
+            LOGGER.debug(f"Failed to log out of vCD: {err}")
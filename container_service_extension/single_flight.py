@@ -0,0 +1,90 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import threading
+
+
+class _Call(object):
+    """An execution of a function, shared by all callers of the same key."""
+
+    __slots__ = ['done', 'result', 'error']
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key into a single execution.
+
+    The first caller of a key executes the function. Callers of the same key
+    arriving while it runs wait for it and get its result, or its exception.
+    Nothing is cached: once the execution finishes, the next call of the key
+    executes the function again.
+
+    Results are shared by all coalesced callers, and must not be modified by
+    them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # mapping of key -> _Call in progress
+        self._calls = {}
+        self._executed_count = 0
+        self._coalesced_count = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs), unless a call of key is in progress.
+
+        :param key: hashable key identifying calls that yield the same
+            result.
+        :param callable func: function to execute.
+
+        :return: result of the execution of func.
+
+        :raises Exception: the exception raised by the execution of func.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self._executed_count += 1
+                is_leader = True
+            else:
+                self._coalesced_count += 1
+                is_leader = False
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def get_metrics(self):
+        """Get counters of calls made so far.
+
+        :return: dict with keys 'executed' (calls that executed the
+            function), 'coalesced' (calls that shared the result of another
+            call) and 'in_progress' (executions currently running).
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'executed': self._executed_count,
+                'coalesced': self._coalesced_count,
+                'in_progress': len(self._calls)
+            }
@@ -0,0 +1,230 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Microbenchmarks of the CSE server request processing path.
+
+These benchmarks run in-process and need neither vCD nor AMQP.
+
+Module usage example:
+```
+$ python -m container_service_extension.system_test_framework.benchmark
+```
+"""
+import base64
+import gzip
+import json
+import timeit
+
+from container_service_extension.codec import decode_request
+from container_service_extension.codec import encode_reply
+from container_service_extension.codec import encode_reply_body
+from container_service_extension.codec import get_json_backend
+from container_service_extension.codec import JSON_BACKENDS
+from container_service_extension.codec import Request
+from container_service_extension.codec import set_json_backend
+from container_service_extension.processor import resolve_route
+
+# (method, requestUri) of requests as sent by vCD, one per kind of route
+SAMPLE_REQUESTS = [
+    ('GET', '/api/cse'),
+    ('GET', '/api/cse/swagger.json'),
+    ('GET', '/api/cse/system'),
+    ('GET', '/api/cse/ovdc/f3272127-9b7f-4f90-8849-0ee70a28be56/info'),
+    ('GET', '/api/cse/mycluster/info'),
+    ('POST', '/api/cse/mycluster/node'),
+    ('GET', '/api/cse/mycluster/node-abcd/info'),
+]
+
+# request headers relevant to encoding a reply, as sent by vCD
+SAMPLE_REQUEST = Request({
+    'id': 'e6b9d0b1-35fa-4c3b-a0c8-8a2aa9f2a0f1',
+    'headers': {
+        'Accept': 'application/*+json;version=31.0',
+        'Accept-Encoding': 'gzip, deflate'
+    }
+})
+
+# AMQP message body of a create cluster request, as sent by vCD
+SAMPLE_CREATE_CLUSTER_MESSAGE = json.dumps([{
+    'id': 'e6b9d0b1-35fa-4c3b-a0c8-8a2aa9f2a0f1',
+    'method': 'POST',
+    'requestUri': '/api/cse/cluster',
+    'queryString': 'org=org1',
+    'body': base64.b64encode(json.dumps({
+        'cluster_name': 'mycluster',
+        'vdc': 'ovdc1',
+        'node_count': 2,
+        'storage_profile': '*',
+        'network': 'mynetwork',
+        'template': 'photon-v2',
+        'enable_nfs': False,
+        'rollback': True
+    }).encode()).decode(),
+    'headers': {
+        'Accept': 'application/*+json;version=31.0',
+        'Accept-Encoding': 'gzip, deflate',
+        'Content-Type': 'application/json',
+        'Host': 'vcd.vmware.com',
+        'User-Agent': 'python-requests/2.21.0',
+        'x-vcloud-authorization': '3f7b9b7e0b1b4c5c9a5b2f6b2e6c1d0a',
+        'X-VMWARE-VCLOUD-REQUEST-ID': 'c0f1f4e6-4d1e-4a6f-9e5a-1f7f0c2d3b4a',
+        'X-VMWARE-VCLOUD-TENANT-CONTEXT':
+            'a93c9db9-7471-3192-8d09-a8f7eeda85f9'
+    }
+}]).encode()
+
+# reply compression threshold used by the compressed reply benchmarks
+BENCHMARK_COMPRESSION_THRESHOLD = 8 * 1024
+
+
+def get_sample_cluster_list(size):
+    """Get a cluster list as returned to a system administrator.
+
+    :param int size: number of clusters in the list.
+
+    :return: list of cluster dicts
+
+    :rtype: list
+    """
+    return [{
+        'name': f"cluster-{n}",
+        'vdc': f"ovdc-{n % 20}",
+        'status': 'POWERED_ON' if n % 3 else 'succeeded',
+        'container_provider': 'vcd' if n % 3 else 'pks'
+    } for n in range(size)]
+
+
+def decode_reply(reply_msg):
+    """Decode the body of a reply message, the way vCD does.
+
+    :param str reply_msg: reply message as published by CSE server.
+
+    :return: reply body
+
+    :rtype: bytes
+    """
+    reply = json.loads(reply_msg)
+    body = base64.b64decode(reply['body'])
+    if reply['headers'].get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return body
+
+
+def benchmark_reply_encoding(list_sizes=(100, 1000, 10000), number=20,
+                             repeat=5):
+    """Measure size and cost of reply messages of large cluster lists.
+
+    Covers the work from the reply body to the AMQP message on CSE server,
+    i.e. serializing the body, compressing it if enabled, base64 and
+    envelope encoding, plus decoding the message back to the reply body on
+    the receiving end. Time spent on the wire is not included, it grows
+    with the message size.
+
+    :param tuple list_sizes: numbers of clusters in the lists.
+    :param int number: number of encode/decode round trips per timing run.
+    :param int repeat: number of timing runs, the fastest one is reported.
+
+    :return: mapping of (list size, compression threshold) -> tuple of
+        message size in bytes and round trip cost in milliseconds.
+
+    :rtype: dict
+    """
+    results = {}
+    for size in list_sizes:
+        cluster_list = get_sample_cluster_list(size)
+        for threshold in (0, BENCHMARK_COMPRESSION_THRESHOLD):
+            def round_trip():
+                reply_msg = encode_reply(SAMPLE_REQUEST, 200, {},
+                                         json.dumps(cluster_list), threshold)
+                decode_reply(reply_msg)
+                return reply_msg
+
+            message_size = len(round_trip())
+            timings = timeit.repeat(round_trip, number=number, repeat=repeat)
+            results[(size, threshold)] = \
+                (message_size, min(timings) / number * 1e3)
+    return results
+
+
+def benchmark_codec(list_size=50, number=10000, repeat=5):
+    """Measure the per-message codec cost of each available JSON backend.
+
+    Covers decoding a request message, its query string and its body, plus
+    encoding a cluster list reply into a reply message.
+
+    :param int list_size: number of clusters in the reply.
+    :param int number: number of messages per timing run.
+    :param int repeat: number of timing runs, the fastest one is reported.
+
+    :return: mapping of JSON backend name -> codec cost per message in
+        microseconds.
+
+    :rtype: dict
+    """
+    cluster_list = get_sample_cluster_list(list_size)
+
+    def codec_round_trip():
+        request = decode_request(SAMPLE_CREATE_CLUSTER_MESSAGE)
+        request.query_params
+        request.spec
+        encode_reply(request, 200, {}, encode_reply_body(cluster_list))
+
+    results = {}
+    default_backend = get_json_backend()
+    try:
+        for name in JSON_BACKENDS:
+            set_json_backend(name)
+            timings = timeit.repeat(codec_round_trip, number=number,
+                                    repeat=repeat)
+            results[name] = min(timings) / number * 1e6
+    finally:
+        set_json_backend(default_backend.name)
+    return results
+
+
+def benchmark_route_dispatch(number=100000, repeat=5):
+    """Measure the cost of resolving a request to its route.
+
+    Covers the work ServiceProcessor.process_request does to find the
+    handler of a request: splitting requestUri and walking the route table.
+
+    :param int number: number of dispatches per timing run.
+    :param int repeat: number of timing runs, the fastest one is reported.
+
+    :return: mapping of 'method requestUri' -> dispatch cost in nanoseconds.
+
+    :rtype: dict
+    """
+    results = {}
+    for method, request_uri in SAMPLE_REQUESTS:
+        timings = timeit.repeat(lambda: resolve_route(method, request_uri),
+                                number=number, repeat=repeat)
+        results[f"{method} {request_uri}"] = min(timings) / number * 1e9
+    return results
+
+
+def main():
+    print("Route dispatch cost per message (ns)")
+    for request, cost in benchmark_route_dispatch().items():
+        print(f"{cost:10.1f}  {request}")
+
+    print()
+    print("Codec cost per message (us)")
+    for name, cost in benchmark_codec().items():
+        print(f"{cost:10.1f}  {name}")
+
+    print()
+    print("Reply message size and encode/decode cost of cluster lists")
+    print(f"{'clusters':>10}  {'compression':>11}  {'bytes':>10}  "
+          f"{'ms':>8}")
+    for (size, threshold), (message_size, cost) in \
+            benchmark_reply_encoding().items():
+        compression = f">= {threshold}" if threshold else 'off'
+        print(f"{size:10d}  {compression:>11}  {message_size:10d}  "
+              f"{cost:8.3f}")
+
+
+if __name__ == '__main__':
+    main()
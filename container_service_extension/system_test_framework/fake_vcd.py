@@ -0,0 +1,958 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+In-process stand-in of the vCD REST API, for tests and benchmarks.
+
+FakeVcdServer serves the subset of the vCD API that CSE server calls on its
+request path: login and session rehydration, orgs and org vdcs, typed
+queries of vApps, admin vApps, admin org vdcs and provider vdcs, vApps and
+their VMs, metadata, and tasks. The orgs, ovdcs and clusters it serves are
+seeded in memory, and every call can be made to take a configurable latency,
+so that the calls VcdBroker, OvdcCache and BrokerManager make can be measured
+and regression tested without a vCD instance.
+
+Module usage example:
+```
+with FakeVcdServer(latency=0.02) as vcd:
+    vcd.seed(num_orgs=5, vdcs_per_org=4, clusters_per_vdc=10)
+    with stand_in_service(vcd):
+        broker_manager = BrokerManager(vcd.get_request_headers('org-0'),
+                                       {}, {})
+        result = broker_manager.invoke(Operation.LIST_CLUSTERS)
+    print(vcd.call_counts)
+```
+"""
+import base64
+import collections
+import contextlib
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import ipaddress
+import re
+from socketserver import ThreadingMixIn
+import threading
+import time
+from unittest.mock import patch
+from urllib.parse import parse_qsl
+from urllib.parse import unquote
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+import uuid
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+from lxml import etree
+from pyvcloud.vcd.client import EntityType
+from pyvcloud.vcd.client import NSMAP
+from pyvcloud.vcd.client import QueryResultFormat
+from pyvcloud.vcd.client import RelationType
+from pyvcloud.vcd.client import ResourceType
+
+from container_service_extension.admission import OperationAdmission
+from container_service_extension.cluster import TYPE_MASTER
+from container_service_extension.cluster import TYPE_NODE
+from container_service_extension.cluster_index import CLUSTER_INDEX
+from container_service_extension.configure_cse import SAMPLE_SERVICE_CONFIG
+from container_service_extension.ovdc_cache import CONTAINER_PROVIDER_KEY
+from container_service_extension.ovdc_cache import CtrProvType
+from container_service_extension.ovdc_cache import OVDC_METADATA_CACHE
+from container_service_extension.pks_cache import PksCache
+from container_service_extension.service import Service
+from container_service_extension.session_pool import SysAdminSessionPool
+from container_service_extension.system_test_framework.fake_pks import \
+    get_pks_config
+from container_service_extension.utils import SYSTEM_ORG_NAME
+
+API_VERSION = '31.0'
+SYS_ADMIN_USERNAME = 'administrator'
+PASSWORD = 'password'
+
+# page size of typed queries, if the request doesn't specify one
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 128
+
+# kinds of calls, per which latencies are configured and calls are counted
+CALL_SESSION = 'session'
+CALL_ORG = 'org'
+CALL_ADMIN = 'admin'
+CALL_VDC = 'vdc'
+CALL_QUERY = 'query'
+CALL_VAPP = 'vapp'
+CALL_METADATA = 'metadata'
+CALL_TASK = 'task'
+
+DOMAIN_GENERAL = 'GENERAL'
+DOMAIN_SYSTEM = 'SYSTEM'
+
+VCLOUD_NS = NSMAP['vcloud']
+XML_CONTENT_TYPE = f'application/*+xml;version={API_VERSION}'
+SESSION_MEDIA_TYPE = 'application/vnd.vmware.vcloud.session+xml'
+
+# status of powered on vApps and VMs, as a number in resources and as a
+# string in query records
+POWERED_ON = (4, 'POWERED_ON')
+
+QUERY_TYPES = (ResourceType.VAPP.value, ResourceType.ADMIN_VAPP.value,
+               ResourceType.PROVIDER_VDC.value,
+               ResourceType.ADMIN_ORG_VDC.value)
+QUERY_FORMATS = (QueryResultFormat.RECORDS, QueryResultFormat.ID_RECORDS,
+                 QueryResultFormat.REFERENCES)
+
+
+class FakeVcdError(Exception):
+    """Error replied with the given HTTP status code."""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class FakeOrg(object):
+    def __init__(self, name):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.vdcs = []
+        self.user_id = str(uuid.uuid4())
+
+
+class FakeProviderVdc(object):
+    def __init__(self, name, vc_name):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.vc_name = vc_name
+
+
+class FakeVdc(object):
+    def __init__(self, name, org, provider_vdc, is_enabled=True):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.org = org
+        self.provider_vdc = provider_vdc
+        # disabled vdcs are only visible to system administrators
+        self.is_enabled = is_enabled
+        # mapping of metadata key -> (domain, value)
+        self.metadata = {}
+
+
+class FakeCluster(object):
+    """A cluster, i.e. a vApp tagged with CSE metadata, and its VMs."""
+
+    def __init__(self, name, vdc, vms, template):
+        self.id = str(uuid.uuid4())
+        self.cluster_id = str(uuid.uuid4())
+        self.name = name
+        self.vdc = vdc
+        # list of (name, ip address) tuples
+        self.vms = vms
+        self.metadata = {
+            'cse.cluster.id': (DOMAIN_GENERAL, self.cluster_id),
+            'cse.version': (DOMAIN_GENERAL, '2.0.0'),
+            'cse.template': (DOMAIN_GENERAL, template),
+            'cse.master.ip': (DOMAIN_GENERAL, vms[0][1] if vms else '')
+        }
+
+
+def _attributes(**attributes):
+    return ''.join(f' {name}={quoteattr(str(value))}'
+                   for name, value in attributes.items() if value is not None)
+
+
+def _link(rel, media_type, href, name=None):
+    attributes = _attributes(rel=rel, type=media_type, href=href, name=name)
+    return f'<Link{attributes}/>'
+
+
+def _metadata_entry(key, domain, value, href=None):
+    domain_element = \
+        f'<Domain visibility="PRIVATE">{domain}</Domain>' \
+        if domain != DOMAIN_GENERAL else ''
+    return f'<MetadataEntry{_attributes(href=href)}>{domain_element}' \
+           f'<Key>{escape(key)}</Key>' \
+           f'<TypedValue xsi:type="MetadataStringValue">' \
+           f'<Value>{escape(value)}</Value></TypedValue></MetadataEntry>'
+
+
+def _root(tag, content='', **attributes):
+    return f'<?xml version="1.0" encoding="UTF-8"?>\n' \
+           f'<{tag} xmlns="{VCLOUD_NS}" xmlns:vcloud="{VCLOUD_NS}" ' \
+           f'xmlns:xsi="{NSMAP["xsi"]}" xmlns:ovf="{NSMAP["ovf"]}" ' \
+           f'xmlns:rasd="{NSMAP["rasd"]}"' \
+           f'{_attributes(**attributes)}>{content}</{tag}>'
+
+
+def _parse_metadata_field(name):
+    """Parse the name of a metadata field of a query.
+
+    :param str name: 'metadata:<key>', or 'metadata@<domain>:<key>' to match
+        the given domain only.
+
+    :return: (domain, key) tuple, domain being None if not given, or None if
+        the field is not a metadata field.
+
+    :rtype: tuple
+    """
+    match = re.fullmatch(r'metadata(@(?P<domain>[A-Z]+))?:(?P<key>.+)', name)
+    if match is None:
+        return None
+    return match.group('domain'), match.group('key')
+
+
+def _get_metadata_value(metadata, domain, key):
+    metadata_domain, value = metadata.get(key, (None, None))
+    if domain is not None and metadata_domain != domain:
+        return None
+    return value
+
+
+def _matches_filter(qfilter, attributes, metadata, encoded):
+    """Evaluate a query filter against a record.
+
+    Conditions joined by ';' must all hold, alternatives joined by ',' within
+    a condition need only one to hold. Values may hold '*' wildcards.
+    Metadata is matched by 'metadata:<key>==<TYPE>:<value>' conditions.
+
+    :param str qfilter: the query filter, None for none.
+    :param dict attributes: attributes of the record.
+    :param dict metadata: metadata of the record, key -> (domain, value).
+    :param bool encoded: whether values are url-encoded.
+
+    :rtype: bool
+    """
+    if not qfilter:
+        return True
+    for condition in qfilter.split(';'):
+        for alternative in condition.split(','):
+            match = re.match(r'(?P<name>[^=!]+)(?P<op>==|!=)(?P<value>.*)',
+                             alternative)
+            if match is None:
+                raise FakeVcdError(400, f"Invalid filter: {alternative}")
+            name, value = match.group('name'), match.group('value')
+            if encoded:
+                value = unquote(value)
+            metadata_field = _parse_metadata_field(name)
+            if metadata_field is not None:
+                actual = _get_metadata_value(metadata, *metadata_field)
+                value = value.split(':', 1)[-1]
+            else:
+                actual = attributes.get(name)
+            matched = actual is not None and fnmatchcase(str(actual), value)
+            if matched == (match.group('op') == '=='):
+                break
+        else:
+            return False
+    return True
+
+
+class FakeVcdServer(object):
+    """Stand-in vCD server, serving a seeded inventory over HTTP."""
+
+    def __init__(self, latency=0.0, address='127.0.0.1', port=0):
+        """Bind the server.
+
+        :param float latency: seconds every call takes, unless overridden in
+            latencies.
+        :param str address: address to listen on.
+        :param int port: port to listen on, 0 to pick any free port.
+        """
+        self.latency = latency
+        # mapping of CALL_* kind -> seconds calls of that kind take
+        self.latencies = {}
+        # mapping of CALL_* kind -> number of calls received
+        self.call_counts = collections.Counter()
+        # seconds tasks run before they succeed and their changes take effect
+        self.task_duration = 0.0
+        self.orgs = {}
+        self.provider_vdcs = []
+        self._vdcs = {}
+        self._clusters = {}
+        # mapping of task id -> (operation name, time.monotonic() value of
+        # its completion)
+        self._tasks = {}
+        # (time.monotonic() value of completion, callable) of the changes of
+        # running tasks
+        self._pending_changes = []
+        # mapping of session token -> FakeOrg
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._next_ip_address = ipaddress.ip_address('10.0.0.2')
+        self.add_org(SYSTEM_ORG_NAME)
+        self._server = _ThreadingHTTPServer((address, port),
+                                            _FakeVcdRequestHandler)
+        self._server.fake_vcd = self
+        self._thread = None
+
+    @property
+    def uri(self):
+        """Get the URI of the server, as configured in CSE config['vcd'].
+
+        :rtype: str
+        """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_uri(self):
+        return f"{self.uri}/api"
+
+    def start(self):
+        self._thread = threading.Thread(name='FakeVcdServer',
+                                        target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_org(self, name):
+        org = FakeOrg(name)
+        self.orgs[name] = org
+        return org
+
+    def add_provider_vdc(self, name, vc_name):
+        provider_vdc = FakeProviderVdc(name, vc_name)
+        self.provider_vdcs.append(provider_vdc)
+        return provider_vdc
+
+    def add_vdc(self, org_name, name, provider_vdc=None,
+                container_provider=CtrProvType.VCD.value, is_enabled=True):
+        """Add an org vdc.
+
+        :param str org_name: name of the org of the vdc.
+        :param str name: name of the vdc.
+        :param FakeProviderVdc provider_vdc: provider vdc backing the vdc,
+            the first one if None.
+        :param str container_provider: container provider the vdc is enabled
+            for, None if the vdc has no container provider metadata.
+        :param bool is_enabled: if False, the vdc is hidden from the users of
+            its org.
+
+        :rtype: FakeVdc
+        """
+        if provider_vdc is None:
+            if not self.provider_vdcs:
+                self.add_provider_vdc('pvdc-0', 'vc-0')
+            provider_vdc = self.provider_vdcs[0]
+        org = self.orgs[org_name]
+        vdc = FakeVdc(name, org, provider_vdc, is_enabled=is_enabled)
+        if container_provider is not None:
+            vdc.metadata[CONTAINER_PROVIDER_KEY] = \
+                (DOMAIN_SYSTEM, container_provider)
+        org.vdcs.append(vdc)
+        self._vdcs[vdc.id] = vdc
+        return vdc
+
+    def add_cluster(self, org_name, vdc_name, name, num_nodes=2,
+                    template='photon-v2'):
+        """Add a cluster of one master and some worker nodes.
+
+        :rtype: FakeCluster
+        """
+        vdc = next(vdc for vdc in self.orgs[org_name].vdcs
+                   if vdc.name == vdc_name)
+        vms = [(f"{TYPE_MASTER}-{uuid.uuid4().hex[:4]}",
+                self._allocate_ip_address())]
+        for _ in range(num_nodes):
+            vms.append((f"{TYPE_NODE}-{uuid.uuid4().hex[:4]}",
+                        self._allocate_ip_address()))
+        cluster = FakeCluster(name, vdc, vms, template)
+        self._clusters[cluster.id] = cluster
+        return cluster
+
+    def seed(self, num_orgs=1, vdcs_per_org=1, clusters_per_vdc=1,
+             nodes_per_cluster=2):
+        """Add orgs 'org-<n>', their vdcs 'ovdc-<m>' and clusters.
+
+        Clusters are named 'cluster-<m>-<k>', after the vdc they are in.
+        """
+        for n in range(num_orgs):
+            org = self.add_org(f"org-{n}")
+            for m in range(vdcs_per_org):
+                vdc = self.add_vdc(org.name, f"ovdc-{m}")
+                for k in range(clusters_per_vdc):
+                    self.add_cluster(org.name, vdc.name, f"cluster-{m}-{k}",
+                                     num_nodes=nodes_per_cluster)
+
+    def get_clusters(self, org_name=None):
+        """Get the clusters seeded, in the given org or in all orgs.
+
+        :rtype: list
+        """
+        return [cluster for cluster in self._clusters.values()
+                if org_name is None or cluster.vdc.org.name == org_name]
+
+    def get_token(self, org_name=SYSTEM_ORG_NAME):
+        """Open a session of a user of an org.
+
+        :param str org_name: name of the org of the user, the System org for
+            a system administrator.
+
+        :return: the x-vcloud-authorization token of the session.
+
+        :rtype: str
+        """
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[token] = self.orgs[org_name]
+        return token
+
+    def expire_sessions(self):
+        """Expire all sessions, as vCD does after their idle timeout."""
+        with self._lock:
+            self._sessions.clear()
+
+    def get_request_headers(self, org_name=SYSTEM_ORG_NAME):
+        """Get the headers of a request to CSE, as forwarded by vCD.
+
+        :param str org_name: name of the org of the user making the request,
+            the System org for a system administrator.
+
+        :rtype: dict
+        """
+        return {
+            'Accept': f'application/*+json;version={API_VERSION}',
+            'x-vcloud-authorization': self.get_token(org_name)
+        }
+
+    def get_service_config(self):
+        """Get a CSE server config pointing to this server.
+
+        :rtype: dict
+        """
+        return {
+            'vcd': {
+                'host': self.uri,
+                'port': self._server.server_address[1],
+                'username': SYS_ADMIN_USERNAME,
+                'password': PASSWORD,
+                'api_version': API_VERSION,
+                'verify': False,
+                'log': False
+            },
+            'service': dict(SAMPLE_SERVICE_CONFIG['service'])
+        }
+
+    def handle(self, method, path, headers, body):
+        """Handle a request.
+
+        :param str method: HTTP method of the request.
+        :param str path: path and query string of the request.
+        :param headers: HTTP headers of the request.
+        :param bytes body: body of the request.
+
+        :return: (status code, headers, body) tuple of the reply.
+
+        :rtype: tuple
+        """
+        self._apply_completed_changes()
+        split_path = urlsplit(path)
+        try:
+            for route_method, pattern, kind, handler in _ROUTES:
+                match = pattern.fullmatch(split_path.path)
+                if route_method == method and match is not None:
+                    break
+            else:
+                raise FakeVcdError(404, f"No resource at {method} {path}")
+            self.call_counts[kind] += 1
+            latency = self.latencies.get(kind, self.latency)
+            if latency > 0:
+                time.sleep(latency)
+            org = None
+            if handler != '_login':
+                org = self._sessions.get(headers.get('x-vcloud-authorization'))
+                if org is None:
+                    raise FakeVcdError(401, 'Not authenticated.')
+            if match.groupdict().get('admin') and \
+                    org.name != SYSTEM_ORG_NAME:
+                raise FakeVcdError(403, 'Access is forbidden.')
+            params = dict(parse_qsl(split_path.query))
+            return getattr(self, handler)(org=org, params=params,
+                                          headers=headers, body=body,
+                                          **match.groupdict())
+        except FakeVcdError as err:
+            return err.status_code, {}, _root(
+                'Error', majorErrorCode=err.status_code, message=str(err),
+                minorErrorCode='FAKE_VCD')
+
+    def _ok(self, content, status_code=200, headers=None):
+        return status_code, headers or {}, content
+
+    def _check_org_access(self, org, owner_org):
+        if org.name != SYSTEM_ORG_NAME and org is not owner_org:
+            raise FakeVcdError(403, 'Access is forbidden.')
+
+    def _allocate_ip_address(self):
+        ip_address = self._next_ip_address
+        self._next_ip_address += 1
+        return str(ip_address)
+
+    def _login(self, headers, **kwargs):
+        authorization = headers.get('Authorization', '')
+        try:
+            user, password = base64.b64decode(
+                authorization.split(' ', 1)[1]).decode().split(':', 1)
+            user_name, org_name = user.rsplit('@', 1)
+        except (IndexError, ValueError):
+            raise FakeVcdError(401, 'Invalid credentials.')
+        org = next((org for org in self.orgs.values()
+                    if org.name.lower() == org_name.lower()), None)
+        if org is None or password != PASSWORD:
+            raise FakeVcdError(401, 'Invalid credentials.')
+        token = self.get_token(org.name)
+        return self._ok(self._session(org, user_name),
+                        headers={'x-vcloud-authorization': token})
+
+    def _get_session(self, org, **kwargs):
+        return self._ok(self._session(org, f"user-{org.name}"))
+
+    def _delete_session(self, org, headers, **kwargs):
+        with self._lock:
+            self._sessions.pop(headers.get('x-vcloud-authorization'), None)
+        return self._ok('', status_code=204)
+
+    def _session(self, org, user_name):
+        api = self.api_uri
+        links = [
+            _link(RelationType.DOWN.value, EntityType.ORG_LIST.value,
+                  f"{api}/org/"),
+            _link(RelationType.DOWN.value, EntityType.ORG.value,
+                  f"{api}/org/{org.id}", org.name),
+            _link(RelationType.DOWN.value, EntityType.QUERY_LIST.value,
+                  f"{api}/query")
+        ]
+        if org.name == SYSTEM_ORG_NAME:
+            links.append(_link(RelationType.DOWN.value, EntityType.ADMIN.value,
+                               f"{api}/admin/"))
+        return _root('Session', ''.join(links), org=org.name, user=user_name,
+                     userId=f"urn:vcloud:user:{org.user_id}",
+                     href=f"{api}/session/", type=SESSION_MEDIA_TYPE)
+
+    def _get_org_list(self, org, **kwargs):
+        orgs = [o for o in self.orgs.values()
+                if org.name == SYSTEM_ORG_NAME or o is org]
+        content = ''.join(
+            '<Org{}/>'.format(_attributes(href=f"{self.api_uri}/org/{o.id}",
+                                          name=o.name,
+                                          type=EntityType.ORG.value))
+            for o in orgs)
+        return self._ok(_root('OrgList', content,
+                              href=f"{self.api_uri}/org/",
+                              type=EntityType.ORG_LIST.value))
+
+    def _get_org(self, org, org_id, **kwargs):
+        target = next((o for o in self.orgs.values() if o.id == org_id), None)
+        if target is None:
+            raise FakeVcdError(404, f"Org {org_id} not found.")
+        self._check_org_access(org, target)
+        content = ''.join(
+            _link(RelationType.DOWN.value, EntityType.VDC.value,
+                  f"{self.api_uri}/vdc/{vdc.id}", vdc.name)
+            for vdc in target.vdcs
+            if vdc.is_enabled or org.name == SYSTEM_ORG_NAME)
+        return self._ok(_root('Org', content, name=target.name,
+                              id=f"urn:vcloud:org:{target.id}",
+                              href=f"{self.api_uri}/org/{target.id}",
+                              type=EntityType.ORG.value))
+
+    def _get_admin(self, org, **kwargs):
+        return self._ok(_root('VCloud', name='vCloud',
+                              href=f"{self.api_uri}/admin/",
+                              type=EntityType.ADMIN.value))
+
+    def _get_vdc(self, org, vdc_id, admin=None, **kwargs):
+        vdc = self._vdcs.get(vdc_id)
+        if vdc is None:
+            raise FakeVcdError(404, f"Vdc {vdc_id} not found.")
+        self._check_org_access(org, vdc.org)
+        href = f"{self.api_uri}/{admin or ''}vdc/{vdc.id}"
+        content = [
+            _link(RelationType.UP.value, EntityType.ORG.value,
+                  f"{self.api_uri}/org/{vdc.org.id}"),
+            _link(RelationType.DOWN.value, EntityType.METADATA.value,
+                  f"{href}/metadata")
+        ]
+        if admin:
+            pvdc = vdc.provider_vdc
+            pvdc_attributes = _attributes(
+                href=f"{self.api_uri}/admin/providervdc/{pvdc.id}",
+                id=f"urn:vcloud:providervdc:{pvdc.id}", name=pvdc.name,
+                type=EntityType.PROVIDER_VDC.value)
+            content.append(f'<ProviderVdcReference{pvdc_attributes}/>')
+        return self._ok(_root('AdminVdc' if admin else 'Vdc',
+                              ''.join(content), name=vdc.name,
+                              id=f"urn:vcloud:vdc:{vdc.id}", href=href,
+                              type=EntityType.VDC_ADMIN.value if admin
+                              else EntityType.VDC.value))
+
+    def _get_vapp(self, org, vapp_id, **kwargs):
+        cluster = self._get_cluster(org, vapp_id)
+        href = f"{self.api_uri}/vApp/vapp-{cluster.id}"
+        vms = []
+        for name, ip_address in cluster.vms:
+            connection = \
+                f'<rasd:Connection vcloud:ipAddress="{ip_address}" ' \
+                f'vcloud:primaryNetworkConnection="true" ' \
+                f'vcloud:ipAddressingMode="POOL">network</rasd:Connection>'
+            vm_attributes = _attributes(name=name, status=POWERED_ON[0],
+                                        type=EntityType.VM.value)
+            vms.append(
+                f'<Vm{vm_attributes}>'
+                f'<ovf:VirtualHardwareSection><ovf:Item>{connection}'
+                f'</ovf:Item></ovf:VirtualHardwareSection></Vm>')
+        content = \
+            _link(RelationType.DOWN.value, EntityType.METADATA.value,
+                  f"{href}/metadata") + \
+            f'<Children>{"".join(vms)}</Children>'
+        return self._ok(_root('VApp', content, name=cluster.name,
+                              id=f"urn:vcloud:vapp:{cluster.id}", href=href,
+                              status=POWERED_ON[0],
+                              type=EntityType.VAPP.value))
+
+    def _get_cluster(self, org, vapp_id):
+        cluster = self._clusters.get(vapp_id)
+        if cluster is None:
+            raise FakeVcdError(404, f"vApp {vapp_id} not found.")
+        self._check_org_access(org, cluster.vdc.org)
+        return cluster
+
+    def _get_metadata_owner(self, org, entity, entity_id):
+        if entity == 'vdc/':
+            vdc = self._vdcs.get(entity_id)
+            if vdc is None:
+                raise FakeVcdError(404, f"Vdc {entity_id} not found.")
+            self._check_org_access(org, vdc.org)
+            return vdc
+        return self._get_cluster(org, entity_id)
+
+    def _get_metadata(self, org, entity, entity_id, admin=None, **kwargs):
+        owner = self._get_metadata_owner(org, entity, entity_id)
+        href = f"{self.api_uri}/{admin or ''}{entity}{entity_id}/metadata"
+        content = _link(RelationType.ADD.value, EntityType.METADATA.value,
+                        href) + ''.join(
+            _metadata_entry(key, domain, value, f"{href}/{domain}/{key}")
+            for key, (domain, value) in owner.metadata.items())
+        return self._ok(_root('Metadata', content, href=href,
+                              type=EntityType.METADATA.value))
+
+    def _get_metadata_value(self, org, entity, entity_id, domain, key,
+                            admin=None, **kwargs):
+        owner = self._get_metadata_owner(org, entity, entity_id)
+        if owner.metadata.get(key, (None,))[0] != domain:
+            raise FakeVcdError(403, f"No metadata entry {domain}/{key}.")
+        href = f"{self.api_uri}/{admin or ''}{entity}{entity_id}/metadata/" \
+               f"{domain}/{key}"
+        content = \
+            _link(RelationType.REMOVE.value, None, href) + \
+            f'<TypedValue xsi:type="MetadataStringValue">' \
+            f'<Value>{escape(owner.metadata[key][1])}</Value></TypedValue>'
+        return self._ok(_root('MetadataValue', content, href=href,
+                              type=EntityType.METADATA_VALUE.value))
+
+    def _post_metadata(self, org, entity, entity_id, body, **kwargs):
+        owner = self._get_metadata_owner(org, entity, entity_id)
+        ns = f"{{{VCLOUD_NS}}}"
+        entries = {
+            entry.findtext(f"{ns}Key"):
+                (entry.findtext(f"{ns}Domain") or DOMAIN_GENERAL,
+                 entry.findtext(f"{ns}TypedValue/{ns}Value"))
+            for entry in etree.fromstring(body).iter(f"{ns}MetadataEntry")
+        }
+        return self._task('metadataUpdate',
+                          lambda: owner.metadata.update(entries))
+
+    def _delete_metadata_value(self, org, entity, entity_id, domain, key,
+                               **kwargs):
+        owner = self._get_metadata_owner(org, entity, entity_id)
+        with self._lock:
+            if owner.metadata.get(key, (None,))[0] != domain:
+                raise FakeVcdError(403, f"No metadata entry {domain}/{key}.")
+        return self._task('metadataDelete',
+                          lambda: owner.metadata.pop(key, None))
+
+    def _task(self, operation_name, change):
+        """Start a task, which makes a change once it completes.
+
+        :param str operation_name: operation name of the task.
+        :param callable change: function making the change, called with
+            self._lock held.
+        """
+        task_id = str(uuid.uuid4())
+        completed_at = time.monotonic() + self.task_duration
+        with self._lock:
+            self._tasks[task_id] = (operation_name, completed_at)
+            if self.task_duration > 0:
+                self._pending_changes.append((completed_at, change))
+            else:
+                change()
+        return self._ok(self._task_resource(task_id), status_code=202)
+
+    def _apply_completed_changes(self):
+        with self._lock:
+            now = time.monotonic()
+            for completed_at, change in list(self._pending_changes):
+                if completed_at <= now:
+                    change()
+                    self._pending_changes.remove((completed_at, change))
+
+    def _task_resource(self, task_id):
+        operation_name, completed_at = self._tasks[task_id]
+        status = 'success' if completed_at <= time.monotonic() \
+            else 'running'
+        return _root('Task', href=f"{self.api_uri}/task/{task_id}",
+                     id=f"urn:vcloud:task:{task_id}", status=status,
+                     operationName=operation_name, operation=operation_name,
+                     type=EntityType.TASK.value)
+
+    def _get_task(self, org, task_id, **kwargs):
+        if task_id not in self._tasks:
+            raise FakeVcdError(404, f"Task {task_id} not found.")
+        return self._ok(self._task_resource(task_id))
+
+    def _query(self, org, params, **kwargs):
+        if 'type' not in params:
+            return self._get_query_list()
+        query_type = params['type']
+        query_format = next((f for f in QUERY_FORMATS
+                             if f.value[1] == params.get('format')), None)
+        if query_type not in QUERY_TYPES or query_format is None:
+            raise FakeVcdError(400, f"Unsupported query {params}.")
+        if query_type != ResourceType.VAPP.value and \
+                org.name != SYSTEM_ORG_NAME:
+            raise FakeVcdError(403, 'Access is forbidden.')
+
+        # only the metadata asked for in fields is returned
+        metadata_fields = [
+            metadata_field
+            for metadata_field in map(_parse_metadata_field,
+                                      params.get('fields', '').split(','))
+            if metadata_field is not None]
+        records = []
+        for tag, attributes, metadata in self._get_query_records(
+                org, query_type, query_format):
+            if _matches_filter(params.get('filter'), attributes, metadata,
+                               params.get('filterEncoded') == 'true'):
+                if query_format == QueryResultFormat.REFERENCES:
+                    tag = f"{tag[:-len('Record')]}Reference"
+                    attributes = {k: attributes[k] for k in ('href', 'name')}
+                metadata_entries = ''.join(
+                    _metadata_entry(key, *metadata[key])
+                    for domain, key in metadata_fields
+                    if _get_metadata_value(metadata, domain, key) is not None)
+                content = f'<Metadata>{metadata_entries}</Metadata>' \
+                    if metadata_entries else ''
+                records.append(
+                    f'<{tag}{_attributes(**attributes)}>{content}</{tag}>')
+
+        page = int(params.get('page', 1))
+        page_size = min(int(params.get('pageSize', DEFAULT_PAGE_SIZE)),
+                        MAX_PAGE_SIZE)
+        start = (page - 1) * page_size
+        content = ''.join(records[start:start + page_size])
+        if start + page_size < len(records):
+            next_page = urlencode({**params, 'page': page + 1})
+            content = _link(RelationType.NEXT_PAGE.value,
+                            query_format.value[0],
+                            f"{self.api_uri}/query?{next_page}") + content
+        root_tag = 'QueryResultReferences' \
+            if query_format == QueryResultFormat.REFERENCES \
+            else 'QueryResultRecords'
+        return self._ok(_root(root_tag, content, total=len(records),
+                              page=page, pageSize=page_size,
+                              name=query_type, type=query_format.value[0]))
+
+    def _get_query_list(self):
+        links = [_link(RelationType.DOWN.value, query_format.value[0],
+                       f"{self.api_uri}/query?type={query_type}&"
+                       f"format={query_format.value[1]}", query_type)
+                 for query_type in QUERY_TYPES
+                 for query_format in QUERY_FORMATS]
+        return self._ok(_root('QueryList', ''.join(links),
+                              href=f"{self.api_uri}/query",
+                              type=EntityType.QUERY_LIST.value))
+
+    def _get_query_records(self, org, query_type, query_format):
+        """Get the records of a typed query, before filtering.
+
+        :return: (tag, attributes, metadata) tuples, one per record.
+
+        :rtype: generator
+        """
+        use_ids = query_format == QueryResultFormat.ID_RECORDS
+        if query_type == ResourceType.PROVIDER_VDC.value:
+            for pvdc in self.provider_vdcs:
+                href = f"{self.api_uri}/admin/providervdc/{pvdc.id}"
+                yield 'VMWProviderVdcRecord', {
+                    'href': href,
+                    'id': f"urn:vcloud:providervdc:{pvdc.id}"
+                    if use_ids else None,
+                    'name': pvdc.name,
+                    'vcName': pvdc.vc_name,
+                    'isEnabled': 'true'
+                }, {}
+            return
+        if query_type == ResourceType.ADMIN_ORG_VDC.value:
+            for org in self.orgs.values():
+                for vdc in org.vdcs:
+                    yield 'AdminVdcRecord', {
+                        'href': f"{self.api_uri}/admin/vdc/{vdc.id}",
+                        'id': f"urn:vcloud:vdc:{vdc.id}" if use_ids else None,
+                        'name': vdc.name,
+                        'org': f"urn:vcloud:org:{org.id}" if use_ids
+                        else f"{self.api_uri}/admin/org/{org.id}",
+                        'orgName': org.name,
+                        'providerVdcName': vdc.provider_vdc.name,
+                        'isEnabled': str(vdc.is_enabled).lower()
+                    }, vdc.metadata
+            return
+        is_admin = query_type == ResourceType.ADMIN_VAPP.value
+        for cluster in list(self._clusters.values()):
+            vdc = cluster.vdc
+            if not is_admin and vdc.org is not org:
+                continue
+            yield 'AdminVAppRecord' if is_admin else 'VAppRecord', {
+                'href': f"{self.api_uri}/vApp/vapp-{cluster.id}",
+                'id': f"urn:vcloud:vapp:{cluster.id}" if use_ids else None,
+                'name': cluster.name,
+                'vdc': f"urn:vcloud:vdc:{vdc.id}" if use_ids
+                else f"{self.api_uri}/vdc/{vdc.id}",
+                'vdcName': vdc.name,
+                'org': f"urn:vcloud:org:{vdc.org.id}" if use_ids
+                else f"{self.api_uri}/org/{vdc.org.id}",
+                'numberOfVMs': len(cluster.vms),
+                'status': POWERED_ON[1]
+            }, cluster.metadata
+
+
+_ENTITY = r'(?P<entity>vdc/|vApp/vapp-)(?P<entity_id>[^/]+)'
+
+# (method, path pattern, CALL_* kind, FakeVcdServer handler method name);
+# an 'admin' group in the pattern restricts the route to system
+# administrators
+_ROUTES = [(method, re.compile(pattern), kind, handler)
+           for method, pattern, kind, handler in [
+    ('POST', r'/api/sessions', CALL_SESSION, '_login'),
+    ('GET', r'/api/session/?', CALL_SESSION, '_get_session'),
+    ('DELETE', r'/api/session/?', CALL_SESSION, '_delete_session'),
+    ('GET', r'/api/org/?', CALL_ORG, '_get_org_list'),
+    ('GET', r'/api/org/(?P<org_id>[^/]+)', CALL_ORG, '_get_org'),
+    ('GET', r'/api/(?P<admin>admin/)', CALL_ADMIN, '_get_admin'),
+    ('GET', r'/api/(?P<admin>admin/)?vdc/(?P<vdc_id>[^/]+)', CALL_VDC,
+     '_get_vdc'),
+    ('GET', r'/api/vApp/vapp-(?P<vapp_id>[^/]+)', CALL_VAPP, '_get_vapp'),
+    ('GET', rf'/api/(?P<admin>admin/)?{_ENTITY}/metadata/?', CALL_METADATA,
+     '_get_metadata'),
+    ('POST', rf'/api/(?P<admin>admin/)?{_ENTITY}/metadata/?', CALL_METADATA,
+     '_post_metadata'),
+    ('GET', rf'/api/(?P<admin>admin/)?{_ENTITY}/metadata/'
+     rf'(?P<domain>GENERAL|SYSTEM)/(?P<key>[^/]+)', CALL_METADATA,
+     '_get_metadata_value'),
+    ('DELETE', rf'/api/(?P<admin>admin/)?{_ENTITY}/metadata/'
+     rf'(?P<domain>GENERAL|SYSTEM)/(?P<key>[^/]+)', CALL_METADATA,
+     '_delete_metadata_value'),
+    ('GET', r'/api/query', CALL_QUERY, '_query'),
+    ('GET', r'/api/task/(?P<task_id>[^/]+)', CALL_TASK, '_get_task'),
+]]
+
+
+class _FakeVcdRequestHandler(BaseHTTPRequestHandler):
+    # keep connections alive, as the requests sessions of pyvcloud do
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status_code, headers, reply = self.server.fake_vcd.handle(
+            self.command, self.path, self.headers, body)
+        reply_bytes = reply.encode()
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if reply_bytes:
+            self.send_header('Content-Type', XML_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(reply_bytes)))
+        self.end_headers()
+        self.wfile.write(reply_bytes)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _FakeVcdService(object):
+    """Stand-in of CSE Service, connected to a FakeVcdServer."""
+
+    is_enabled = True
+
+    def __init__(self, config, operation_admission):
+        self.config = config
+        self.operation_admission = operation_admission
+        self.pks_cache = None
+        self.sys_admin_session_pool = SysAdminSessionPool(
+            self._login_sys_admin)
+
+    # system administrator sessions are pooled as CSE server pools them
+    get_sys_admin_client = Service.get_sys_admin_client
+    release_sys_admin_client = Service.release_sys_admin_client
+    _login_sys_admin = Service._login_sys_admin
+
+    def get_service_config(self):
+        return self.config
+
+    def get_pks_cache(self):
+        return self.pks_cache
+
+    def get_operation_admission(self):
+        return self.operation_admission
+
+
+@contextlib.contextmanager
+def stand_in_service(fake_vcd, operation_admission=None, pks_servers=None):
+    """Replace CSE Service with a stand-in connected to a FakeVcdServer.
+
+    :param FakeVcdServer fake_vcd: the server to connect to.
+    :param OperationAdmission operation_admission: admission control of the
+        long running operations, without limits if None.
+    :param list pks_servers: started FakePksServer objects, which back the
+        provider vdcs of the same vCenter. PKS is not configured if None.
+    """
+    service = _FakeVcdService(fake_vcd.get_service_config(),
+                              operation_admission or OperationAdmission())
+    # cached metadata and indexed clusters belong to the vCD of previous
+    # stand-ins
+    OVDC_METADATA_CACHE.clear()
+    CLUSTER_INDEX.clear()
+    with patch('container_service_extension.service.Service',
+               lambda: service):
+        try:
+            if pks_servers:
+                pks_config = get_pks_config(pks_servers, fake_vcd)
+                service.config['pks_config'] = pks_config
+                service.pks_cache = PksCache(**pks_config)
+            yield service
+        finally:
+            # tasks setting ovdc metadata are waited for with sessions of
+            # the stand-in
+            while OVDC_METADATA_CACHE.is_updating():
+                time.sleep(0.01)
+            service.sys_admin_session_pool.close()
@@ -0,0 +1,518 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Load generator replaying vCD request envelopes against CSE server core.
+
+Requests are built the way vCD publishes them to AMQP, and delivered at a
+target rate to MessageConsumer.on_message, on a loopback stand-in of the
+pika ioloop. They then take the production path through the processor
+pools, ServiceProcessor.process_request and the reply encoding, up to the
+reply being published. Either the broker layer is replaced with a stand-in
+that answers after a configurable latency, or the real broker layer runs
+against in-process fake vCD and PKS servers, so that no vCD, PKS or AMQP
+broker is needed.
+
+Requests are sent open loop: the send schedule doesn't wait for replies,
+hence a server that can't keep up shows growing latencies rather than a
+lower request rate.
+
+Module usage example:
+```
+$ python -m container_service_extension.system_test_framework.load_generator \
+    --rate 200 --duration 10 --listeners 5 --backend-latency 0.05
+$ python -m container_service_extension.system_test_framework.load_generator \
+    --backends fake --rate 50 --duration 10 --backend-latency 0.005
+```
+"""
+import base64
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import json
+import queue
+import random
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+import uuid
+
+import click
+import pika
+
+from container_service_extension.broker_manager import Operation
+from container_service_extension.consumer import MessageConsumer
+from container_service_extension.exceptions import MethodNotAllowedError
+from container_service_extension.exceptions import RouteNotFoundError
+from container_service_extension.processor import resolve_route
+from container_service_extension.router import Lane
+from container_service_extension.system_test_framework.fake_pks import \
+    FakePksServer
+from container_service_extension.system_test_framework.fake_vcd import \
+    FakeVcdServer
+from container_service_extension.system_test_framework.fake_vcd import \
+    stand_in_service
+
+# percentiles of the latencies reported per route
+PERCENTILES = (0.5, 0.95, 0.99)
+
+# exchange and routing key vCD expects replies on
+REPLY_EXCHANGE = 'vcdext'
+REPLY_ROUTING_KEY = 'vcd'
+
+
+class WorkloadRequest(namedtuple('WorkloadRequest',
+                                 'weight, method, request_uri, query_string, '
+                                 'body')):
+    """A kind of request of a workload.
+
+    weight: relative frequency of the request in the workload.
+    method: HTTP method of the request.
+    request_uri: requestUri of the request, e.g. '/api/cse/mycluster/info'.
+    query_string: query string of the request, without the leading '?'.
+    body: request body as a dict, or None if the request has none.
+    """
+
+
+# mix of requests of vCD UI and vcd-cli users, dominated by listings
+DEFAULT_WORKLOAD = [
+    WorkloadRequest(40, 'GET', '/api/cse', '', None),
+    WorkloadRequest(20, 'GET', '/api/cse/cluster-1/info', '', None),
+    WorkloadRequest(10, 'GET', '/api/cse/cluster-1/config', '', None),
+    WorkloadRequest(15, 'GET', '/api/cse/ovdc', '', None),
+    WorkloadRequest(5, 'GET', '/api/cse/swagger.json', '', None),
+    WorkloadRequest(5, 'POST', '/api/cse', '', {
+        'name': 'cluster-new',
+        'vdc': 'ovdc1',
+        'node_count': 2,
+        'storage_profile': '*',
+        'network': 'mynetwork',
+        'template': 'photon-v2',
+        'enable_nfs': False,
+        'rollback': True
+    }),
+    WorkloadRequest(5, 'DELETE', '/api/cse/cluster-2', 'org=org1', None),
+]
+
+# read requests of a system administrator, on the clusters and ovdcs seeded
+# by fake_backends()
+FAKE_BACKENDS_WORKLOAD = [
+    WorkloadRequest(40, 'GET', '/api/cse', '', None),
+    WorkloadRequest(15, 'GET', '/api/cse/cluster-0-0/info', '', None),
+    WorkloadRequest(10, 'GET', '/api/cse/pks-cluster-0/info', '', None),
+    WorkloadRequest(15, 'GET', '/api/cse/ovdc', '', None),
+    WorkloadRequest(5, 'GET', '/api/cse/swagger.json', '', None),
+]
+
+
+def build_request_message(method, request_uri, query_string='', body=None,
+                          request_id=None, request_headers=None):
+    """Build the body of an AMQP message carrying a request, as vCD does.
+
+    :param str method: HTTP method of the request.
+    :param str request_uri: requestUri of the request.
+    :param str query_string: query string of the request.
+    :param dict body: request body, None if the request has none.
+    :param str request_id: id of the request, random if not given.
+    :param dict request_headers: headers overriding the default ones, e.g.
+        the x-vcloud-authorization token of a session.
+
+    :return: AMQP message body
+
+    :rtype: bytes
+    """
+    encoded_body = ''
+    headers = {
+        'Accept': 'application/*+json;version=31.0',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+        'Host': 'vcd.vmware.com',
+        'User-Agent': 'python-requests/2.21.0',
+        'x-vcloud-authorization': '3f7b9b7e0b1b4c5c9a5b2f6b2e6c1d0a',
+        'X-VMWARE-VCLOUD-REQUEST-ID': str(uuid.uuid4()),
+        'X-VMWARE-VCLOUD-TENANT-CONTEXT':
+            'a93c9db9-7471-3192-8d09-a8f7eeda85f9',
+        **(request_headers or {})
+    }
+    if body is not None:
+        raw_body = json.dumps(body).encode()
+        encoded_body = base64.b64encode(raw_body).decode()
+        headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = str(len(raw_body))
+    return json.dumps([{
+        'id': request_id or str(uuid.uuid4()),
+        'method': method,
+        'requestUri': request_uri,
+        'queryString': query_string,
+        'body': encoded_body,
+        'headers': headers
+    }, {}]).encode()
+
+
+def get_route_name(method, request_uri):
+    """Get the name a request is reported under, as in CSE server metrics.
+
+    :rtype: str
+    """
+    try:
+        route, _ = resolve_route(method, request_uri)
+    except (RouteNotFoundError, MethodNotAllowedError):
+        return f"{method} (unrouted)"
+    return f"{route.method} /{route.path}"
+
+
+class StandInBrokerManager(object):
+    """BrokerManager answering with canned results after a fixed latency.
+
+    Configured through the class attributes, see stand_in_backends().
+    """
+
+    latency = 0.0
+    cluster_count = 50
+
+    def __init__(self, request_headers, request_query_params, request_spec):
+        self.req_spec = request_spec
+
+    def invoke(self, op):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if op == Operation.LIST_CLUSTERS:
+            body = [{
+                'name': f"cluster-{n}",
+                'vdc': f"ovdc-{n % 20}",
+                'status': 'POWERED_ON',
+                'container_provider': 'vcd'
+            } for n in range(self.cluster_count)]
+        elif op == Operation.LIST_OVDCS:
+            body = [{
+                'name': f"ovdc-{n}",
+                'org': 'org1',
+                'k8s provider': 'native'
+            } for n in range(20)]
+        elif op in (Operation.CREATE_CLUSTER, Operation.DELETE_CLUSTER,
+                    Operation.RESIZE_CLUSTER):
+            return {
+                'status_code': 202,
+                'body': {
+                    'name': self.req_spec.get('cluster_name'),
+                    'task_href': f"https://vcd.vmware.com/api/task/"
+                                 f"{uuid.uuid4()}"
+                }
+            }
+        else:
+            body = {
+                'name': self.req_spec.get('cluster_name'),
+                'status': 'POWERED_ON',
+                'nodes': [{'name': f"node-{n}"} for n in range(3)]
+            }
+        return {'status_code': 200, 'body': body}
+
+
+class _StandInService(object):
+    is_enabled = True
+
+
+@contextlib.contextmanager
+def stand_in_backends(latency=0.0, cluster_count=50):
+    """Replace the broker layer and CSE Service with stand-ins.
+
+    :param float latency: seconds every broker operation takes.
+    :param int cluster_count: number of clusters in cluster lists.
+    """
+    StandInBrokerManager.latency = latency
+    StandInBrokerManager.cluster_count = cluster_count
+    with patch('container_service_extension.service.Service',
+               _StandInService), \
+            patch('container_service_extension.processor.BrokerManager',
+                  StandInBrokerManager):
+        yield
+
+
+@contextlib.contextmanager
+def fake_backends(latency=0.0, vdcs=2, clusters_per_vdc=25,
+                  pks_clusters=25):
+    """Run the broker layer against in-process fake vCD and PKS servers.
+
+    The fake vCD has an org 'org-0' with vdcs 'ovdc-<m>', holding clusters
+    'cluster-<m>-<k>'. The fake PKS server backs the vdcs, and has clusters
+    'pks-cluster-<n>'.
+
+    :param float latency: seconds every call to vCD or PKS takes.
+    :param int vdcs: number of vdcs in the org.
+    :param int clusters_per_vdc: number of vCD clusters in each vdc.
+    :param int pks_clusters: number of PKS clusters.
+
+    :return: (yields) headers of the requests of a system administrator of
+        the fake vCD, to be passed to run_load().
+    """
+    with FakeVcdServer(latency=latency) as vcd, \
+            FakePksServer(latency=latency) as pks:
+        vcd.seed(num_orgs=1, vdcs_per_org=vdcs,
+                 clusters_per_vdc=clusters_per_vdc)
+        pks.seed(num_clusters=pks_clusters)
+        with stand_in_service(vcd, pks_servers=[pks]):
+            yield vcd.get_request_headers()
+
+
+class _LoopbackIOLoop(object):
+    """Stand-in of the pika ioloop, running callbacks on its own thread."""
+
+    def __init__(self, name):
+        self._callbacks = queue.Queue()
+        self._thread = threading.Thread(name=name, target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            callback = self._callbacks.get()
+            if callback is None:
+                return
+            callback()
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.put(callback)
+
+    def stop(self):
+        self._callbacks.put(None)
+        self._thread.join()
+
+
+class _LoopbackChannel(object):
+    """Stand-in of a pika channel, handing published replies over."""
+
+    is_open = True
+
+    def __init__(self, on_reply):
+        self._on_reply = on_reply
+
+    def basic_ack(self, delivery_tag):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self._on_reply(properties.correlation_id, body)
+
+
+class LoadReport(object):
+    """Latencies and errors of the replies, per route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # mapping of route name -> list of reply latencies in seconds
+        self.latencies = {}
+        # mapping of route name -> number of requests sent
+        self.sent = {}
+        # mapping of route name -> number of replies with a server error
+        self.errors = {}
+        self.elapsed = 0.0
+
+    def record_sent(self, route_name):
+        with self._lock:
+            self.sent[route_name] = self.sent.get(route_name, 0) + 1
+
+    def record_reply(self, route_name, latency, error):
+        with self._lock:
+            self.latencies.setdefault(route_name, []).append(latency)
+            if error:
+                self.errors[route_name] = self.errors.get(route_name, 0) + 1
+
+    def get_summary(self):
+        """Summarize the replies per route.
+
+        Requests left without a reply count as errors.
+
+        :return: mapping of route name -> dict with keys 'requests',
+            'replies', 'errors', 'error_rate', 'throughput' (replies per
+            second) and 'p50', 'p95', 'p99' (latencies in seconds).
+
+        :rtype: dict
+        """
+        summary = {}
+        with self._lock:
+            for route_name, sent in sorted(self.sent.items()):
+                latencies = sorted(self.latencies.get(route_name, []))
+                errors = self.errors.get(route_name, 0) + \
+                    sent - len(latencies)
+                route_summary = {
+                    'requests': sent,
+                    'replies': len(latencies),
+                    'errors': errors,
+                    'error_rate': errors / sent,
+                    'throughput':
+                        len(latencies) / self.elapsed if self.elapsed else 0.0
+                }
+                for percentile in PERCENTILES:
+                    route_summary[f"p{percentile * 100:g}"] = \
+                        latencies[int(percentile * (len(latencies) - 1))] \
+                        if latencies else 0.0
+                summary[route_name] = route_summary
+        return summary
+
+
+def run_load(rate, duration, workload=None, listeners=1,
+             processors=None, reply_timeout=30, seed=None,
+             request_headers=None):
+    """Send requests to MessageConsumers at a target rate.
+
+    The backends must be replaced beforehand, with stand_in_backends() or
+    fake_backends(), unless real backends are configured.
+
+    :param float rate: requests per second.
+    :param float duration: seconds to send requests for.
+    :param list workload: WorkloadRequests to pick requests from, by
+        weight. Defaults to DEFAULT_WORKLOAD.
+    :param int listeners: number of MessageConsumers, each with an ioloop
+        of its own, as 'listeners' in the service config.
+    :param dict processors: mapping of router.Lane -> number of processor
+        threads, as '*_processors' in the service config. Lanes left out
+        get the default of the service config.
+    :param float reply_timeout: seconds to wait for outstanding replies
+        once all requests are sent.
+    :param int seed: seed of the random choice of requests.
+    :param dict request_headers: headers overriding the default headers of
+        the requests, e.g. those yielded by fake_backends().
+
+    :rtype: LoadReport
+    """
+    from container_service_extension.configure_cse import \
+        SAMPLE_SERVICE_CONFIG
+
+    workload = workload or DEFAULT_WORKLOAD
+    rng = random.Random(seed)
+    weights = [request.weight for request in workload]
+    messages = [
+        (request, get_route_name(request.method, request.request_uri))
+        for request in workload
+    ]
+
+    report = LoadReport()
+    outstanding = {}
+    all_replied = threading.Event()
+    outstanding_lock = threading.Lock()
+    sending_done = threading.Event()
+
+    def on_reply(correlation_id, reply_msg):
+        replied_at = time.perf_counter()
+        with outstanding_lock:
+            route_name, sent_at = outstanding.pop(correlation_id)
+            if sending_done.is_set() and not outstanding:
+                all_replied.set()
+        status_code = json.loads(reply_msg)['statusCode']
+        report.record_reply(route_name, replied_at - sent_at,
+                            status_code >= 500)
+
+    processor_pools = {}
+    for lane in Lane:
+        num_processors = (processors or {}).get(lane) or \
+            SAMPLE_SERVICE_CONFIG['service'][f"{lane.value}_processors"]
+        processor_pools[lane] = ThreadPoolExecutor(
+            max_workers=num_processors,
+            thread_name_prefix=f"ServiceProcessor-{lane.value}")
+    consumers = []
+    for n in range(listeners):
+        consumer = MessageConsumer('localhost', 5672, False, '/', 'guest',
+                                   'guest', REPLY_EXCHANGE, 'cse',
+                                   processor_pools=processor_pools)
+        consumer._connection = SimpleNamespace(
+            ioloop=_LoopbackIOLoop(f"MessageConsumer-{n}"), is_open=True)
+        consumers.append((consumer, _LoopbackChannel(on_reply)))
+
+    total = int(rate * duration)
+    start = time.perf_counter()
+    try:
+        for n in range(total):
+            delay = start + n / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            request, route_name = rng.choices(messages, weights)[0]
+            correlation_id = str(n)
+            body = build_request_message(
+                request.method, request.request_uri, request.query_string,
+                request.body, request_headers=request_headers)
+            deliver = SimpleNamespace(delivery_tag=n + 1, redelivered=False)
+            properties = pika.BasicProperties(
+                app_id='vcd', correlation_id=correlation_id,
+                reply_to=REPLY_ROUTING_KEY,
+                headers={'replyToExchange': REPLY_EXCHANGE},
+                timestamp=int(time.time()))
+            consumer, channel = consumers[n % listeners]
+            report.record_sent(route_name)
+            with outstanding_lock:
+                outstanding[correlation_id] = \
+                    (route_name, time.perf_counter())
+            consumer._connection.ioloop.add_callback_threadsafe(
+                functools.partial(consumer.on_message, channel, deliver,
+                                  properties, body))
+        with outstanding_lock:
+            sending_done.set()
+            if not outstanding:
+                all_replied.set()
+        all_replied.wait(reply_timeout)
+        report.elapsed = time.perf_counter() - start
+    finally:
+        for processor_pool in processor_pools.values():
+            processor_pool.shutdown(wait=True)
+        for consumer, _ in consumers:
+            consumer._connection.ioloop.stop()
+    return report
+
+
+@click.command()
+@click.option('--rate', default=100.0, show_default=True,
+              help='Requests per second')
+@click.option('--duration', default=10.0, show_default=True,
+              help='Seconds to send requests for')
+@click.option('--listeners', default=5, show_default=True,
+              help="Number of listeners, as 'listeners' in the service "
+                   "config")
+@click.option('--read-processors', default=0,
+              help="Threads of the read lane, 0 for the config default")
+@click.option('--mutate-processors', default=0,
+              help="Threads of the mutate lane, 0 for the config default")
+@click.option('--admin-processors', default=0,
+              help="Threads of the admin lane, 0 for the config default")
+@click.option('--backends', type=click.Choice(['stand-in', 'fake']),
+              default='stand-in', show_default=True,
+              help="'stand-in' replaces the broker layer with canned "
+                   "results, 'fake' runs it against in-process fake vCD "
+                   "and PKS servers")
+@click.option('--backend-latency', default=0.05, show_default=True,
+              help='Seconds every stand-in broker operation, or every call '
+                   'to a fake server, takes')
+@click.option('--clusters', default=50, show_default=True,
+              help='Number of clusters in cluster lists')
+def main(rate, duration, listeners, read_processors, mutate_processors,
+         admin_processors, backends, backend_latency, clusters):
+    processors = {
+        Lane.READ: read_processors,
+        Lane.MUTATE: mutate_processors,
+        Lane.ADMIN: admin_processors
+    }
+    if backends == 'fake':
+        # half of the clusters on vCD, spread over two vdcs, half on PKS
+        with fake_backends(backend_latency, vdcs=2,
+                           clusters_per_vdc=max(clusters // 4, 1),
+                           pks_clusters=max(clusters // 2, 1)) as headers:
+            report = run_load(rate, duration,
+                              workload=FAKE_BACKENDS_WORKLOAD,
+                              listeners=listeners, processors=processors,
+                              request_headers=headers)
+    else:
+        with stand_in_backends(backend_latency, clusters):
+            report = run_load(rate, duration, listeners=listeners,
+                              processors=processors)
+
+    print(f"{'route':<28}  {'requests':>8}  {'errors':>7}  {'req/s':>8}  "
+          f"{'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}")
+    for route_name, summary in report.get_summary().items():
+        print(f"{route_name:<28}  {summary['requests']:8d}  "
+              f"{summary['error_rate']:7.2%}  {summary['throughput']:8.1f}  "
+              f"{summary['p50'] * 1e3:8.1f}  {summary['p95'] * 1e3:8.1f}  "
+              f"{summary['p99'] * 1e3:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
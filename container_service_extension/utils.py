@@ -9,14 +9,15 @@ import os
 import pathlib
 import stat
 import sys
+import threading
 import traceback
 from urllib.parse import urlparse
 
 from cachetools import LRUCache
+from cachetools import TTLCache
 import click
 from lxml import objectify
 from pyvcloud.vcd.api_extension import APIExtension
-from pyvcloud.vcd.client import BasicLoginCredentials
 from pyvcloud.vcd.client import Client
 from pyvcloud.vcd.client import QueryResultFormat
 from pyvcloud.vcd.client import ResourceType
@@ -30,13 +31,29 @@ from pyvcloud.vcd.vm import VM
 import requests
 from vsphere_guest_run.vsphere import VSphere
 
+from container_service_extension.exceptions import TooManyOperationsError
 from container_service_extension.exceptions import VcdResponseError
 from container_service_extension.logger import SERVER_DEBUG_WIRELOG_FILEPATH
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import backend_call
+from container_service_extension.metrics import BACKEND_VCD
+from container_service_extension.metrics import METRICS
+from container_service_extension.metrics import observe_backend_call
 from container_service_extension.server_constants import CSE_SERVICE_NAME
 from container_service_extension.server_constants import CSE_SERVICE_NAMESPACE
 
 cache = LRUCache(maxsize=1024)
+vsphere_cache_stats = METRICS.get_cache_stats('vsphere')
+# mapping of tenant session key -> (session, session endpoints, query list)
+# tuple of the rehydrated sessions of users, shared by the requests of a user
+# within the TTL. pyvcloud clients are not thread-safe, hence each call gets
+# its own.
+TENANT_SESSION_CACHE_SIZE = 1024
+TENANT_SESSION_CACHE_TTL = 120
+tenant_session_cache = TTLCache(maxsize=TENANT_SESSION_CACHE_SIZE,
+                                ttl=TENANT_SESSION_CACHE_TTL)
+tenant_session_cache_lock = threading.Lock()
+tenant_session_cache_stats = METRICS.get_cache_stats('tenant_session')
 SYSTEM_ORG_NAME = "System"
 CSE_SCRIPTS_DIR = 'container_service_extension_scripts'
 ERROR_REASON = "reason"
@@ -54,6 +71,9 @@ BUF_SIZE = 65536
 # chunk size for downloading files
 SIZE_1MB = 1024 * 1024
 
+# Header of cluster lists missing the clusters of failed or slow backends.
+BACKEND_STATUS_HEADER = 'X-CSE-Backend-Status'
+
 _type_to_string = {
     str: 'string',
     int: 'number',
@@ -65,20 +85,41 @@ _type_to_string = {
 OK = 200
 CREATED = 201
 ACCEPTED = 202
+NOT_MODIFIED = 304
 UNAUTHORIZED = 401
 INTERNAL_SERVER_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 GATEWAY_TIMEOUT = 504
 
 
 def connect_vcd_user_via_token(vcd_uri, headers, verify_ssl_certs=True):
+    """Connect to vCD as the user making a request.
+
+    Sessions are rehydrated once, and shared by the calls made with the same
+    token and API version for TENANT_SESSION_CACHE_TTL seconds, or until vCD
+    replies 401 to one of their calls. Each call gets a client of its own,
+    built from the cached session without calling vCD.
+
+    :param str vcd_uri: URI of vCD.
+    :param headers: headers of the request, with its x-vcloud-authorization
+        token and Accept header.
+    :param bool verify_ssl_certs: whether to verify the certificate of vCD.
+
+    :return: (client, session) tuple. The client must not be logged out,
+        which would end the session of the user, nor shared with other
+        threads.
+
+    :rtype: tuple
+    """
+    token = headers.get('x-vcloud-authorization')
+    accept_header = headers.get('Accept')
+    version = accept_header.split('version=')[1]
+    key = _get_tenant_session_key(vcd_uri, token, version, verify_ssl_certs)
     if not verify_ssl_certs:
         LOGGER.warning("InsecureRequestWarning: Unverified HTTPS request is "
                        "being made. Adding certificate verification is "
                        "strongly advised.")
         requests.packages.urllib3.disable_warnings()
-    token = headers.get('x-vcloud-authorization')
-    accept_header = headers.get('Accept')
-    version = accept_header.split('version=')[1]
     client_tenant = Client(
         uri=vcd_uri,
         api_version=version,
@@ -87,13 +128,176 @@ def connect_vcd_user_via_token(vcd_uri, headers, verify_ssl_certs=True):
         log_requests=True,
         log_headers=True,
         log_bodies=True)
-    session = client_tenant.rehydrate_from_token(token)
+    with tenant_session_cache_lock:
+        cached = tenant_session_cache.get(key)
+    if cached is not None:
+        tenant_session_cache_stats.hit()
+        session = cached[0]
+        _attach_tenant_session(client_tenant, token, *cached)
+    else:
+        tenant_session_cache_stats.miss()
+        with backend_call(BACKEND_VCD):
+            session = client_tenant.rehydrate_from_token(token)
+            query_list_map = client_tenant._get_query_list_map()
+        with tenant_session_cache_lock:
+            tenant_session_cache[key] = (
+                session,
+                client_tenant._session_endpoints,
+                query_list_map,
+            )
+    instrument_vcd_client(client_tenant)
+    client_tenant._session.hooks['response'].append(
+        functools.partial(_evict_tenant_session, key))
     return (
         client_tenant,
         session,
     )
 
 
+def _attach_tenant_session(client, token, session, session_endpoints,
+                           query_list_map):
+    # what rehydrate_from_token() and the first query set up, minus the calls
+    # to vCD
+    client._session = requests.Session()
+    client._session.headers[client._HEADER_X_VCLOUD_AUTH_NAME] = token
+    client._vcloud_auth_token = token
+    client._vcloud_session = session
+    client._update_is_sysadmin()
+    client._session_endpoints = session_endpoints
+    client._query_list_map = query_list_map
+
+
+def _get_tenant_session_key(vcd_uri, token, version, verify_ssl_certs):
+    # a digest, so that tokens don't show up in keys, e.g. in debug output
+    return hashlib.sha256(
+        f"{vcd_uri}\n{version}\n{verify_ssl_certs}\n{token}".encode()) \
+        .hexdigest()
+
+
+def _evict_tenant_session(key, response, *args, **kwargs):
+    if response.status_code == UNAUTHORIZED:
+        with tenant_session_cache_lock:
+            tenant_session_cache.pop(key, None)
+
+
+def _observe_vcd_response(response, *args, **kwargs):
+    observe_backend_call(BACKEND_VCD, response.elapsed.total_seconds(),
+                         error=response.status_code >= INTERNAL_SERVER_ERROR)
+
+
+def instrument_vcd_client(client):
+    """Record the calls of a logged in vCD client in the backend metrics.
+
+    :param pyvcloud.vcd.client.Client client: the client, whose session is
+        replaced on login, hence it must be instrumented after login.
+    """
+    client._session.hooks['response'].append(_observe_vcd_response)
+
+
+class SerializedBody(str):
+    """Reply body that is already serialized to JSON.
+
+    MessageConsumer sends such a body as is, instead of serializing it.
+    """
+
+
+def get_header(headers, name):
+    """Get the value of a request header, matching its name case-insensitively.
+
+    :param dict headers: request headers.
+    :param str name: name of the header.
+
+    :return: value of the header, or None if the header is not present.
+
+    :rtype: str
+    """
+    value = headers.get(name)
+    if value is None:
+        name = name.lower()
+        for key in headers:
+            if key.lower() == name:
+                return headers[key]
+    return value
+
+
+def is_encoding_accepted(accept_encoding, coding):
+    """Check whether an Accept-Encoding request header allows a coding.
+
+    :param str accept_encoding: value of the Accept-Encoding header, can be
+        None.
+    :param str coding: name of the content coding, e.g. 'gzip'.
+
+    :return: True if @coding is listed, or matched by '*', with a non-zero
+        quality value.
+
+    :rtype: bool
+    """
+    if not accept_encoding:
+        return False
+    wildcard_quality = 0.0
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        name = name.strip().lower()
+        if name == coding:
+            return quality > 0
+        if name == '*':
+            wildcard_quality = quality
+    return wildcard_quality > 0
+
+
+def compute_etag(*parts):
+    """Compute a strong entity tag out of the given parts.
+
+    :param parts: str or bytes objects that together identify the version of
+        a resource representation.
+
+    :return: quoted entity tag, e.g. '"0a1b..."'
+
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        digest.update(part)
+        digest.update(b'\0')
+    return f'"{digest.hexdigest()}"'
+
+
+def is_etag_matched(if_none_match, etag):
+    """Check whether an If-None-Match request header matches an entity tag.
+
+    Follows the weak comparison that RFC 7232 mandates for If-None-Match.
+
+    :param str if_none_match: value of the If-None-Match header, can be None.
+    :param str etag: quoted entity tag of the current representation.
+
+    :return: True if the client's copy of the representation is current.
+
+    :rtype: bool
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag[2:] if etag.startswith('W/') else etag
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == opaque_tag:
+            return True
+    return False
+
+
 def get_server_runtime_config():
     from container_service_extension.service import Service
     return Service().get_service_config()
@@ -104,11 +308,21 @@ def get_vcd_sys_admin_client():
     return Service().get_sys_admin_client()
 
 
+def release_vcd_sys_admin_client(client):
+    from container_service_extension.service import Service
+    Service().release_sys_admin_client(client)
+
+
 def get_pks_cache():
     from container_service_extension.service import Service
     return Service().get_pks_cache()
 
 
+def get_operation_admission():
+    from container_service_extension.service import Service
+    return Service().get_operation_admission()
+
+
 def error_to_json(error):
     """Convert the given python exception object to a dictionary.
 
@@ -572,16 +786,19 @@ def get_pvdc_id_by_name(name, vc_name_in_vcd):
     :rtype: str
     """
     client = get_vcd_sys_admin_client()
-    query = client.get_typed_query(ResourceType.PROVIDER_VDC.value,
-                                   query_result_format=QueryResultFormat
-                                   .RECORDS,
-                                   qfilter=f'vcName=={vc_name_in_vcd}',
-                                   equality_filter=('name', name))
-    for pvdc_record in list(query.execute()):
-        href = pvdc_record.get('href')
-        pvdc_id = href.split("/")[-1]
-        return pvdc_id
-    return None
+    try:
+        query = client.get_typed_query(ResourceType.PROVIDER_VDC.value,
+                                       query_result_format=QueryResultFormat
+                                       .RECORDS,
+                                       qfilter=f'vcName=={vc_name_in_vcd}',
+                                       equality_filter=('name', name))
+        for pvdc_record in list(query.execute()):
+            href = pvdc_record.get('href')
+            pvdc_id = href.split("/")[-1]
+            return pvdc_id
+        return None
+    finally:
+        release_vcd_sys_admin_client(client)
 
 
 def get_data_file(filename, logger=None):
@@ -688,24 +905,21 @@ def get_vsphere(config, vapp, vm_name, logger=None):
 
     # get vm id from vm resource
     vm_id = vapp.get_vm(vm_name).get('id')
-    if vm_id not in cache:
-        client = Client(uri=config['vcd']['host'],
-                        api_version=config['vcd']['api_version'],
-                        verify_ssl_certs=config['vcd']['verify'],
-                        log_headers=True,
-                        log_bodies=True)
-        credentials = BasicLoginCredentials(config['vcd']['username'],
-                                            SYSTEM_ORG_NAME,
-                                            config['vcd']['password'])
-        client.set_credentials(credentials)
-
-        # must recreate vapp, or cluster creation fails
-        vapp = VApp(client, href=vapp.href)
-        vm_resource = vapp.get_vm(vm_name)
-        vm_sys = VM(client, resource=vm_resource)
-        vcenter_name = vm_sys.get_vc()
-        platform = Platform(client)
-        vcenter = platform.get_vcenter(vcenter_name)
+    if vm_id in cache:
+        vsphere_cache_stats.hit()
+    else:
+        vsphere_cache_stats.miss()
+        client = get_vcd_sys_admin_client()
+        try:
+            # must recreate vapp, or cluster creation fails
+            vapp = VApp(client, href=vapp.href)
+            vm_resource = vapp.get_vm(vm_name)
+            vm_sys = VM(client, resource=vm_resource)
+            vcenter_name = vm_sys.get_vc()
+            platform = Platform(client)
+            vcenter = platform.get_vcenter(vcenter_name)
+        finally:
+            release_vcd_sys_admin_client(client)
         vcenter_url = urlparse(vcenter.Url.text)
         cache_item = {
             'hostname': vcenter_url.hostname,
@@ -794,6 +1008,11 @@ def exception_handler(func):
         result = {}
         try:
             result = func(*args, **kwargs)
+        except TooManyOperationsError as err:
+            result['status_code'] = SERVICE_UNAVAILABLE
+            result['body'] = error_to_json(err)
+            result['headers'] = {'Retry-After': str(err.retry_after)}
+            LOGGER.warning(str(err))
         except Exception as err:
             result['status_code'] = INTERNAL_SERVER_ERROR
             result['body'] = error_to_json(err)
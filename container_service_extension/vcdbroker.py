@@ -44,11 +44,13 @@ from container_service_extension.logger import SERVER_LOGGER as LOGGER
 from container_service_extension.server_constants import \
     CSE_NATIVE_DEPLOY_RIGHT_NAME
 from container_service_extension.utils import ACCEPTED
+from container_service_extension.utils import compute_etag
 from container_service_extension.utils import ERROR_DESCRIPTION
 from container_service_extension.utils import ERROR_MESSAGE
 from container_service_extension.utils import ERROR_STACKTRACE
 from container_service_extension.utils import error_to_json
 from container_service_extension.utils import exception_handler
+from container_service_extension.utils import get_operation_admission
 from container_service_extension.utils import get_server_runtime_config
 from container_service_extension.utils import OK
 
@@ -64,6 +66,12 @@ OP_MESSAGE = {
     OP_DELETE_NODES: 'delete nodes from cluster',
 }
 
+# cluster properties loaded from vCD metadata, which identify the version of
+# the cluster state
+CLUSTER_VERSION_PROPERTIES = ('cluster_id', 'vapp_id', 'status',
+                              'number_of_vms', 'leader_endpoint', 'template',
+                              'cse_version')
+
 MAX_HOST_NAME_LENGTH = 25
 ROLLBACK_FLAG = 'disable_rollback'
 
@@ -209,19 +217,56 @@ class VcdBroker(AbstractBroker, threading.Thread):
 
     def run(self):
         LOGGER.debug(f"Thread started for operation={self.op}")
-        if self.op == OP_CREATE_CLUSTER:
-            self.create_cluster_thread()
-        elif self.op == OP_DELETE_CLUSTER:
-            self.delete_cluster_thread()
-        elif self.op == OP_CREATE_NODES:
-            self.create_nodes_thread()
-        elif self.op == OP_DELETE_NODES:
-            self.delete_nodes_thread()
-
-    def list_clusters(self):
+        try:
+            if self.op == OP_CREATE_CLUSTER:
+                self.create_cluster_thread()
+            elif self.op == OP_DELETE_CLUSTER:
+                self.delete_cluster_thread()
+            elif self.op == OP_CREATE_NODES:
+                self.create_nodes_thread()
+            elif self.op == OP_DELETE_NODES:
+                self.delete_nodes_thread()
+        finally:
+            get_operation_admission().release(self.tenant_info['org_name'])
+
+    def _start_operation(self, message):
+        """Start the thread running the long-running operation self.op.
+
+        The operation is admitted before its vCD task is created, so that a
+        refused operation leaves no task behind. The sys admin session is
+        checked out of the pool only once the operation is admitted, and is
+        returned by the thread, or here if the thread doesn't start.
+
+        :param str message: message of the vCD task of the operation.
+
+        :raises TooManyOperationsError: if the operation is refused by the
+            admission control.
+        """
+        org_name = self.tenant_info['org_name']
+        get_operation_admission().acquire(org_name)
+        try:
+            self._connect_sys_admin()
+            self.update_task(TaskStatus.RUNNING, message=message)
+            self.daemon = True
+            self.start()
+        except Exception:
+            self._disconnect_sys_admin()
+            get_operation_admission().release(org_name)
+            raise
+
+    def list_clusters(self, include_metadata=True):
+        """List the clusters visible to the user.
+
+        :param include_metadata: (bool): If False, 'IP master' and
+            'template' of the clusters are left empty, which spares the
+            query fetching the metadata of the vApps.
+
+        :return: (list): dicts describing the clusters.
+        """
         self._connect_tenant()
         clusters = []
-        for c in load_from_metadata(self.tenant_client):
+        for c in load_from_metadata(self.tenant_client,
+                                    include_metadata=include_metadata):
             clusters.append({
                 'name': c['name'],
                 'IP master': c['leader_endpoint'],
@@ -232,10 +277,13 @@ class VcdBroker(AbstractBroker, threading.Thread):
             })
         return clusters
 
-    def get_cluster_info(self, cluster_name):
+    def get_cluster_info(self, cluster_name, include_nodes=True):
         """Get the info of the cluster.
 
         :param cluster_name: (str): Name of the cluster
+        :param include_nodes: (bool): If False, the node lists of the info
+            are left empty, which costs a single query on vApps instead of
+            enumerating the VMs of the cluster and their IP addresses.
 
         :return: (dict): Info of the cluster.
         """
@@ -244,7 +292,18 @@ class VcdBroker(AbstractBroker, threading.Thread):
         if len(clusters) == 0:
             raise CseServerError(f"Cluster '{cluster_name}' not found.")
         cluster = clusters[0]
-        vapp = VApp(self.tenant_client, href=clusters[0]['vapp_href'])
+        if include_nodes:
+            self.load_cluster_nodes(cluster)
+        return cluster
+
+    def load_cluster_nodes(self, cluster):
+        """Fill in the node lists of the info of a cluster.
+
+        :param cluster: (dict): Info of the cluster, as returned by
+            get_cluster_info() with include_nodes False.
+        """
+        self._connect_tenant()
+        vapp = VApp(self.tenant_client, href=cluster['vapp_href'])
         vms = vapp.get_all_vms()
         for vm in vms:
             node_info = {
@@ -263,7 +322,26 @@ class VcdBroker(AbstractBroker, threading.Thread):
                 cluster.get('nodes').append(node_info)
             elif vm.get('name').startswith(TYPE_NFS):
                 cluster.get('nfs_nodes').append(node_info)
-        return cluster
+
+    def get_cluster_version_tag(self, cluster_name, cluster_info=None):
+        """Get the entity tag of the current state of the cluster.
+
+        Unless cluster_info is given, costs a single query on vApps, instead
+        of enumerating the VMs of the cluster and their IP addresses.
+
+        :param str cluster_name: Name of the cluster.
+        :param dict cluster_info: information of the cluster, as returned by
+            get_cluster_info().
+
+        :return: quoted entity tag
+
+        :rtype: str
+        """
+        if cluster_info is None:
+            cluster_info = self.get_cluster_info(cluster_name,
+                                                 include_nodes=False)
+        return compute_etag(*[str(cluster_info.get(k))
+                              for k in CLUSTER_VERSION_PROPERTIES])
 
     @exception_handler
     def get_node_info(self, cluster_name, node_name):
@@ -366,15 +444,11 @@ class VcdBroker(AbstractBroker, threading.Thread):
         if not self.is_valid_name(cluster_name):
             raise CseServerError(f"Invalid cluster name '{cluster_name}'")
         self._connect_tenant()
-        self._connect_sys_admin()
         self.cluster_name = cluster_name
         self.cluster_id = str(uuid.uuid4())
         self.op = OP_CREATE_CLUSTER
-        self.update_task(
-            TaskStatus.RUNNING,
-            message=f"Creating cluster {cluster_name}({self.cluster_id})")
-        self.daemon = True
-        self.start()
+        self._start_operation(
+            f"Creating cluster {cluster_name}({self.cluster_id})")
         result = {}
         result['name'] = self.cluster_name
         result['cluster_id'] = self.cluster_id
@@ -508,7 +582,6 @@ class VcdBroker(AbstractBroker, threading.Thread):
 
         self.cluster_name = cluster_name
         self._connect_tenant()
-        self._connect_sys_admin()
         self.op = OP_DELETE_CLUSTER
         clusters = load_from_metadata(
             self.tenant_client, name=self.cluster_name)
@@ -516,12 +589,8 @@ class VcdBroker(AbstractBroker, threading.Thread):
             raise CseServerError(f"Cluster {self.cluster_name} not found.")
         self.cluster = clusters[0]
         self.cluster_id = self.cluster['cluster_id']
-        self.update_task(
-            TaskStatus.RUNNING,
-            message=f"Deleting cluster {self.cluster_name}"
-                    f"({self.cluster_id})")
-        self.daemon = True
-        self.start()
+        self._start_operation(
+            f"Deleting cluster {self.cluster_name}({self.cluster_id})")
         result = {}
         result['cluster_name'] = self.cluster_name
         result['task_href'] = self.task_resource.get('href')
@@ -574,7 +643,6 @@ class VcdBroker(AbstractBroker, threading.Thread):
             raise CseServerError(f'Network name is missing from the request.')
 
         self._connect_tenant()
-        self._connect_sys_admin()
         clusters = load_from_metadata(
             self.tenant_client, name=self.cluster_name)
         if len(clusters) != 1:
@@ -582,12 +650,9 @@ class VcdBroker(AbstractBroker, threading.Thread):
         self.cluster = clusters[0]
         self.op = OP_CREATE_NODES
         self.cluster_id = self.cluster['cluster_id']
-        self.update_task(
-            TaskStatus.RUNNING,
-            message=f"Adding {self.req_spec['node_count']} node(s) to cluster "
-                    "{self.cluster_name}({self.cluster_id})")
-        self.daemon = True
-        self.start()
+        self._start_operation(
+            f"Adding {self.req_spec['node_count']} node(s) to cluster "
+            "{self.cluster_name}({self.cluster_id})")
         response_body = {}
         response_body['cluster_name'] = self.cluster_name
         response_body['task_href'] = self.task_resource.get('href')
@@ -668,7 +733,6 @@ class VcdBroker(AbstractBroker, threading.Thread):
             if node.startswith(TYPE_MASTER):
                 raise CseServerError(f"Can't delete a master node: '{node}'.")
         self._connect_tenant()
-        self._connect_sys_admin()
         clusters = load_from_metadata(
             self.tenant_client, name=self.cluster_name)
         if len(clusters) != 1:
@@ -676,12 +740,9 @@ class VcdBroker(AbstractBroker, threading.Thread):
         self.cluster = clusters[0]
         self.op = OP_DELETE_NODES
         self.cluster_id = self.cluster['cluster_id']
-        self.update_task(
-            TaskStatus.RUNNING,
-            message=f"Deleting {len(self.req_spec['nodes'])} node(s) from "
+        self._start_operation(
+            f"Deleting {len(self.req_spec['nodes'])} node(s) from "
             f"cluster {self.cluster_name}({self.cluster_id})")
-        self.daemon = True
-        self.start()
         response_body = {}
         response_body['cluster_name'] = self.cluster_name
         response_body['task_href'] = self.task_resource.get('href')
@@ -0,0 +1,95 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+conftest.py is used by pytest to automatically find shared fixtures.
+
+Fixtures defined here can be used without importing. They run CSE against
+in-process fake vCD and PKS servers, and need no vCD, PKS or AMQP.
+"""
+import logging
+
+import pytest
+
+from container_service_extension.logger import SERVER_LOGGER
+from container_service_extension.system_test_framework.fake_pks import \
+    FakePksServer
+from container_service_extension.system_test_framework.fake_vcd import \
+    FakeVcdServer
+from container_service_extension.system_test_framework.fake_vcd import \
+    stand_in_service
+
+# orgs, vdcs and clusters the fake vCD server is seeded with, unless the test
+# is marked with 'vcd_seed'
+DEFAULT_VCD_SEED = {'num_orgs': 1, 'vdcs_per_org': 1, 'clusters_per_vdc': 2}
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'vcd_seed(**kwargs): arguments of FakeVcdServer.seed() '
+                   'for the vcd fixture')
+
+
+@pytest.fixture(autouse=True)
+def quiet_server_logger():
+    """Fixture to disable debug logs of the CSE server during the test."""
+    log_level = SERVER_LOGGER.level
+    SERVER_LOGGER.setLevel(logging.INFO)
+    yield
+    SERVER_LOGGER.setLevel(log_level)
+
+
+@pytest.fixture
+def vcd(request):
+    """Fixture to provide a started and seeded FakeVcdServer.
+
+    Usage: mark the test with @pytest.mark.vcd_seed(...) to pass other
+        arguments to FakeVcdServer.seed() than DEFAULT_VCD_SEED.
+    """
+    marker = request.node.get_closest_marker('vcd_seed')
+    with FakeVcdServer() as vcd:
+        vcd.seed(**(marker.kwargs if marker else DEFAULT_VCD_SEED))
+        yield vcd
+
+
+@pytest.fixture
+def pks_0():
+    """Fixture to provide a FakePksServer backing vCenter 'vc-0'."""
+    with FakePksServer() as pks:
+        yield pks
+
+
+@pytest.fixture
+def pks_1(vcd):
+    """Fixture to provide a FakePksServer backing vCenter 'vc-1'.
+
+    Tasks:
+    - add provider vdc 'pvdc-1' of vCenter 'vc-1' to the fake vCD server
+    """
+    vcd.add_provider_vdc('pvdc-1', 'vc-1')
+    with FakePksServer(name='pks-1', vc_name='vc-1') as pks:
+        yield pks
+
+
+@pytest.fixture
+def service(vcd):
+    """Fixture to replace CSE Service with a stand-in using the vcd fixture.
+
+    yields the stand-in service
+    """
+    with stand_in_service(vcd) as service:
+        yield service
+
+
+@pytest.fixture
+def pks_service(vcd, pks_0, pks_1):
+    """Fixture to replace CSE Service with a stand-in using vCD and PKS.
+
+    The provider vdcs of the vcd fixture are backed by the pks_0 and pks_1
+    fixtures.
+
+    yields the stand-in service
+    """
+    with stand_in_service(vcd, pks_servers=[pks_0, pks_1]) as service:
+        yield service
@@ -0,0 +1,175 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+CSE server tests of listing and finding clusters across vCD and PKS.
+
+These tests run the broker layer against the in-process fake vCD and PKS
+servers. They need neither vCD, PKS nor AMQP.
+"""
+
+import json
+import time
+from unittest.mock import patch
+
+from container_service_extension.broker_manager import BrokerManager
+from container_service_extension.broker_manager import Operation
+from container_service_extension.cluster import load_from_metadata
+from container_service_extension.cluster_index import CLUSTER_INDEX
+from container_service_extension.cluster_index import ClusterLocation
+from container_service_extension.metrics import get_request_backend_time
+from container_service_extension.metrics import start_request
+from container_service_extension.system_test_framework.fake_pks import \
+    CALL_LIST_CLUSTERS
+from container_service_extension.system_test_framework.fake_vcd import \
+    CALL_QUERY
+from container_service_extension.system_test_framework.fake_vcd import \
+    CALL_VAPP
+from container_service_extension.utils import BACKEND_STATUS_HEADER
+
+
+def test_0010_list_clusters_fan_out(vcd, pks_0, pks_1, pks_service):
+    """Test that clusters are listed on all backends at once, with timeout."""
+    pks_0.seed(num_clusters=3)
+    pks_1.seed(num_clusters=4)
+    pks_0.latencies[CALL_LIST_CLUSTERS] = 0.5
+    pks_1.latencies[CALL_LIST_CLUSTERS] = 0.5
+    start = time.monotonic()
+    result = BrokerManager(vcd.get_request_headers(), {}, {}) \
+        .invoke(Operation.LIST_CLUSTERS)
+    assert time.monotonic() - start < 1
+    assert len(json.loads(result['body'])) == 9
+    assert BACKEND_STATUS_HEADER not in result['headers']
+
+    pks_service.config['service']['backend_timeout'] = 1
+    pks_1.latencies[CALL_LIST_CLUSTERS] = 3
+    start = time.monotonic()
+    result = BrokerManager(vcd.get_request_headers(), {}, {}) \
+        .invoke(Operation.LIST_CLUSTERS)
+    assert time.monotonic() - start < 2
+    assert result['status_code'] == 200
+    assert [cluster['container_provider'] for cluster in
+            json.loads(result['body'])] == ['vcd'] * 2 + ['pks'] * 3
+    backend_status = json.loads(
+        result['headers'][BACKEND_STATUS_HEADER])
+    assert [status['backend'] for status in backend_status] == \
+        ['vcd', 'pks:pks-0-admin', 'pks:pks-1-admin']
+    assert 'within 1 seconds' in backend_status[2]['error']
+
+
+def test_0020_find_cluster_race(vcd, pks_0, pks_1, pks_service):
+    """Test that clusters are looked for on all backends at once."""
+    pks_1.seed(num_clusters=2)
+    pks_0.latencies[CALL_LIST_CLUSTERS] = 3
+    headers = vcd.get_request_headers()
+    start = time.monotonic()
+    result = BrokerManager(headers, {},
+                           {'cluster_name': 'cluster-0-0'}) \
+        .invoke(Operation.GET_CLUSTER)
+    assert len(result['body']['nodes']) == 2
+    result = BrokerManager(headers, {},
+                           {'cluster_name': 'pks-cluster-1'}) \
+        .invoke(Operation.GET_CLUSTER)
+    assert result['body']['name'] == 'pks-cluster-1'
+    assert time.monotonic() - start < 2
+
+    # the version tag doesn't need the VMs of the cluster
+    vapp_call_count = vcd.call_counts[CALL_VAPP]
+    result = BrokerManager(headers, {},
+                           {'cluster_name': 'cluster-0-0'}) \
+        .invoke(Operation.GET_CLUSTER)
+    etag = result['headers']['ETag']
+    assert vcd.call_counts[CALL_VAPP] > vapp_call_count
+    vapp_call_count = vcd.call_counts[CALL_VAPP]
+    result = BrokerManager({**headers, 'If-None-Match': etag}, {},
+                           {'cluster_name': 'cluster-0-0'}) \
+        .invoke(Operation.GET_CLUSTER)
+    assert result['status_code'] == 304
+    assert vcd.call_counts[CALL_VAPP] == vapp_call_count
+
+    # a stale tag costs a single lookup of the cluster
+    query_count = vcd.call_counts[CALL_QUERY]
+    result = BrokerManager({**headers, 'If-None-Match': '"stale"'}, {},
+                           {'cluster_name': 'cluster-0-0'}) \
+        .invoke(Operation.GET_CLUSTER)
+    assert result['status_code'] == 200
+    assert result['headers']['ETag'] == etag
+    assert len(result['body']['nodes']) == 2
+    assert vcd.call_counts[CALL_QUERY] == query_count + 1
+
+    # a slow backend could hold the cluster, it's not reported missing
+    pks_service.config['service']['backend_timeout'] = 1
+    start = time.monotonic()
+    result = BrokerManager(headers, {}, {'cluster_name': 'missing'}) \
+        .invoke(Operation.GET_CLUSTER)
+    assert time.monotonic() - start < 2
+    assert result['status_code'] == 500
+    assert result['body']['message']['reason'] == \
+        'pks:pks-0-admin did not reply within 1 seconds'
+
+
+def test_0030_cluster_index(vcd, pks_0, pks_1, pks_service):
+    """Test that indexed clusters are looked up on their backend only."""
+    pks_1.seed(num_clusters=2)
+    headers = vcd.get_request_headers()
+    BrokerManager(headers, {}, {}).invoke(Operation.LIST_CLUSTERS)
+    assert CLUSTER_INDEX.get('System', 'cluster-0-0') == \
+        ClusterLocation('vcd', None)
+    assert CLUSTER_INDEX.get('System', 'pks-cluster-1') == \
+        ClusterLocation('pks', 'pks-1-admin')
+
+    pks_0_call_counts = pks_0.call_counts.copy()
+    query_count = vcd.call_counts[CALL_QUERY]
+    result = BrokerManager(headers, {},
+                           {'cluster_name': 'pks-cluster-1'}) \
+        .invoke(Operation.GET_CLUSTER)
+    assert result['body']['name'] == 'pks-cluster-1'
+    assert pks_0.call_counts == pks_0_call_counts
+    assert vcd.call_counts[CALL_QUERY] == query_count
+
+    # wrong entries fall back to a full search, which fixes them
+    CLUSTER_INDEX.put('System', 'cluster-0-1',
+                      ClusterLocation('pks', 'pks-0-admin'))
+    result = BrokerManager(headers, {},
+                           {'cluster_name': 'cluster-0-1'}) \
+        .invoke(Operation.GET_CLUSTER)
+    assert result['body']['name'] == 'cluster-0-1'
+    assert CLUSTER_INDEX.get('System', 'cluster-0-1').provider == \
+        'vcd'
+
+
+def test_0040_list_clusters_conditional_get_cost(vcd, service):
+    """Test that cluster lists are tagged without querying vApp metadata."""
+    with patch('container_service_extension.vcdbroker.load_from_metadata',
+               wraps=load_from_metadata) as load:
+        headers = vcd.get_request_headers()
+        result = BrokerManager(headers, {}, {}) \
+            .invoke(Operation.LIST_CLUSTERS)
+        assert result['status_code'] == 200
+        etag = result['headers']['ETag']
+
+        query_count = vcd.call_counts[CALL_QUERY]
+        result = BrokerManager({**headers, 'If-None-Match': etag}, {},
+                               {}).invoke(Operation.LIST_CLUSTERS)
+        assert result['status_code'] == 304
+        assert vcd.call_counts[CALL_QUERY] == query_count + 1
+        assert all(not call[1]['include_metadata']
+                   for call in load.call_args_list)
+
+
+def test_0050_fan_out_backend_time(vcd, pks_0, pks_1, pks_service):
+    """Test that backend calls made at once count towards the request.
+
+    They count for the time waited for them, not for the sum of their times.
+    """
+    pks_0.seed(num_clusters=2)
+    pks_0.latencies[CALL_LIST_CLUSTERS] = 0.3
+    pks_1.latencies[CALL_LIST_CLUSTERS] = 0.3
+    headers = vcd.get_request_headers()
+    for spec in ({}, {'cluster_name': 'pks-cluster-1'}):
+        start = start_request()
+        op = Operation.GET_CLUSTER if spec else Operation.LIST_CLUSTERS
+        BrokerManager(headers, {}, spec).invoke(op)
+        assert 0.3 <= get_request_backend_time() <= \
+            time.perf_counter() - start
@@ -0,0 +1,151 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+CSE server tests of the fake vCD and PKS servers and the load generator.
+
+These tests run the broker layer against the in-process fake vCD and PKS
+servers. They need neither vCD, PKS nor AMQP.
+"""
+
+import json
+
+import pytest
+
+from container_service_extension.broker_manager import BrokerManager
+from container_service_extension.broker_manager import Operation
+from container_service_extension.ovdc_cache import OvdcCache
+from container_service_extension.system_test_framework.fake_pks import \
+    CALL_LIST_CLUSTERS
+from container_service_extension.system_test_framework.fake_pks import \
+    CALL_TOKEN
+from container_service_extension.system_test_framework.fake_vcd import \
+    CALL_QUERY
+from container_service_extension.system_test_framework.load_generator import \
+    fake_backends
+from container_service_extension.system_test_framework.load_generator import \
+    FAKE_BACKENDS_WORKLOAD
+from container_service_extension.system_test_framework.load_generator import \
+    run_load
+from container_service_extension.system_test_framework.load_generator import \
+    stand_in_backends
+from container_service_extension.utils import BACKEND_STATUS_HEADER
+from container_service_extension.utils import get_vcd_sys_admin_client
+
+
+def test_0010_load_generator():
+    """Test that generated load is replied to, and reported per route."""
+    with stand_in_backends(latency=0.001, cluster_count=5):
+        report = run_load(rate=200, duration=0.5, listeners=2, seed=1)
+    summary = report.get_summary()
+    assert sum(route['requests'] for route in summary.values()) == 100
+    for route_name, route in summary.items():
+        assert route['replies'] == route['requests']
+        assert route['errors'] == 0
+        assert 0 < route['p50'] <= route['p95'] <= route['p99']
+    assert 'GET /' in summary
+    assert 'DELETE /{cluster_name}' in summary
+
+
+@pytest.mark.vcd_seed(num_orgs=2, vdcs_per_org=2, clusters_per_vdc=15)
+def test_0020_fake_vcd_server(vcd, service):
+    """Test the broker layer against the fake vCD server."""
+    # 60 clusters span several pages of the vApp typed query
+    result = BrokerManager(vcd.get_request_headers(), {}, {}) \
+        .invoke(Operation.LIST_CLUSTERS)
+    assert len(json.loads(result['body'])) == 60
+
+    tenant_headers = vcd.get_request_headers('org-1')
+    result = BrokerManager(tenant_headers, {}, {}) \
+        .invoke(Operation.LIST_CLUSTERS)
+    assert sorted(cluster['name'] for cluster in
+                  json.loads(result['body'])) == \
+        sorted(cluster.name for cluster in vcd.get_clusters('org-1'))
+
+    cluster = vcd.get_clusters('org-1')[0]
+    result = BrokerManager(tenant_headers, {},
+                           {'cluster_name': cluster.name}) \
+        .invoke(Operation.GET_CLUSTER)
+    assert result['body']['cluster_id'] == cluster.cluster_id
+    nodes = result['body']['master_nodes'] + result['body']['nodes']
+    assert [node['ipAddress'] for node in nodes] == \
+        [ip_address for _, ip_address in cluster.vms]
+
+    result = BrokerManager(tenant_headers, {}, {}) \
+        .invoke(Operation.LIST_OVDCS)
+    assert [(ovdc['name'], ovdc['container_provider'])
+            for ovdc in json.loads(result['body'])] == \
+        [('ovdc-0', 'vcd'), ('ovdc-1', 'vcd')]
+
+    ovdc_cache = OvdcCache(get_vcd_sys_admin_client())
+    ovdc = ovdc_cache.get_ovdc('ovdc-0', org_name='org-0')
+    task = ovdc_cache.set_ovdc_container_provider_metadata(ovdc)
+    assert task.get('status') == 'success'
+    assert ovdc_cache.get_ovdc_container_provider_metadata(
+        ovdc_name='ovdc-0', org_name='org-0') == \
+        {'container_provider': 'none'}
+    assert vcd.call_counts[CALL_QUERY] > 0
+
+
+def test_0030_fake_pks_server(vcd, pks_0, pks_1, pks_service):
+    """Test the broker layer against fake vCD and PKS servers."""
+    vdc = vcd.orgs['org-0'].vdcs[0]
+    pks_0.seed(num_clusters=3, owner_ids=[vcd.orgs['org-0'].user_id],
+               vdcs=[(vdc.id, vdc.name)])
+    pks_1.seed(num_clusters=4)
+    result = BrokerManager(vcd.get_request_headers(), {}, {}) \
+        .invoke(Operation.LIST_CLUSTERS)
+    clusters = json.loads(result['body'])
+    assert [cluster['container_provider'] for cluster in clusters] \
+        == ['vcd'] * 2 + ['pks'] * 7
+
+    result = BrokerManager(vcd.get_request_headers(), {}, {
+        'ovdc_id': vdc.id,
+        'org_name': 'org-0',
+        'ovdc_name': vdc.name,
+        'container_provider': 'pks',
+        'pks_plans': 'small'
+    }).invoke(Operation.ENABLE_OVDC)
+    assert result['status_code'] == 202
+    assert len(pks_0.compute_profiles) == 1
+
+    tenant_headers = vcd.get_request_headers('org-0')
+    result = BrokerManager(tenant_headers, {},
+                           {'cluster_name': 'pks-cluster-1'}) \
+        .invoke(Operation.GET_CLUSTER)
+    assert result['body']['name'] == 'pks-cluster-1'
+    assert result['body']['compute_profile_name'] == \
+        f"cp--{vdc.id}--{vdc.name}"
+
+    # clusters of failed PKS accounts are left out of the list
+    pks_0.inject_errors(CALL_LIST_CLUSTERS)
+    result = BrokerManager(tenant_headers, {}, {}) \
+        .invoke(Operation.LIST_CLUSTERS)
+    assert result['status_code'] == 200
+    assert [cluster['container_provider'] for cluster in
+            json.loads(result['body'])] == ['vcd'] * 2
+    backend_status = json.loads(
+        result['headers'][BACKEND_STATUS_HEADER])
+    assert [status['backend'] for status in backend_status] == \
+        ['vcd', 'pks:pks-0-admin']
+    assert backend_status[0]['error'] is None
+    assert backend_status[1]['error'] is not None
+    assert pks_0.call_counts[CALL_TOKEN] >= 3
+    assert pks_1.call_counts[CALL_LIST_CLUSTERS] == 1
+
+
+def test_0040_load_generator_fake_backends():
+    """Test that generated load runs through the broker layer, on fakes."""
+    with fake_backends(vdcs=1, clusters_per_vdc=2, pks_clusters=2) \
+            as headers:
+        report = run_load(rate=50, duration=0.5, listeners=2, seed=1,
+                          workload=FAKE_BACKENDS_WORKLOAD,
+                          request_headers=headers)
+    summary = report.get_summary()
+    assert sum(route['requests'] for route in summary.values()) == 25
+    for route_name, route in summary.items():
+        assert route['replies'] == route['requests']
+        assert route['errors'] == 0
+    assert 'GET /' in summary
+    assert 'GET /{cluster_name}/info' in summary
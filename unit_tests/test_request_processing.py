@@ -0,0 +1,520 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+CSE server tests of the request processing path.
+
+These tests run ServiceProcessor, the codec and the AMQP consumer in-process,
+with the CSE service and the broker layer replaced by stand-ins returning
+canned results. They need neither a running CSE server nor AMQP, and do not
+make calls to vCD or PKS.
+"""
+
+import base64
+import gzip
+import json
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+from unittest.mock import patch
+import urllib.error
+import urllib.request
+
+import pytest
+import requests
+
+from container_service_extension.admission import OperationAdmission
+from container_service_extension.broker_manager import BrokerManager
+from container_service_extension.client.cluster import Cluster
+from container_service_extension.codec import decode_request
+from container_service_extension.codec import encode_reply
+from container_service_extension.codec import get_json_backend
+from container_service_extension.codec import JSON_BACKENDS
+from container_service_extension.codec import json_loads
+from container_service_extension.codec import Request
+from container_service_extension.codec import set_json_backend
+from container_service_extension.consumer import MessageConsumer
+from container_service_extension.exceptions import TooManyOperationsError
+from container_service_extension.metrics import GROUP_OPERATION
+from container_service_extension.metrics import GROUP_PROCESSING
+from container_service_extension.metrics import GROUP_QUEUE_WAIT
+from container_service_extension.metrics import LatencyRecorder
+from container_service_extension.metrics import METRICS
+from container_service_extension.metrics_exporter import \
+    format_metric_families
+from container_service_extension.metrics_exporter import \
+    get_cache_metric_families
+from container_service_extension.metrics_exporter import \
+    get_latency_metric_families
+from container_service_extension.metrics_exporter import MetricsServer
+from container_service_extension.processor import get_request_lane
+from container_service_extension.processor import ServiceProcessor
+from container_service_extension.router import Lane
+from container_service_extension.single_flight import SingleFlight
+from container_service_extension.utils import BACKEND_STATUS_HEADER
+from container_service_extension.utils import exception_handler
+
+# upper bound of memory allocated while processing the list clusters request
+LIST_CLUSTERS_ALLOCATION_LIMIT_BYTES = 4 * 1024
+
+LIST_CLUSTERS_ENVELOPE = json.dumps([{
+    'id': 'e6b9d0b1-35fa-4c3b-a0c8-8a2aa9f2a0f1',
+    'method': 'GET',
+    'requestUri': '/api/cse',
+    'queryString': '',
+    'body': '',
+    'headers': {
+        'Accept': 'application/*+json;version=31.0',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+        'Content-Length': '0',
+        'Host': 'vcd.vmware.com',
+        'User-Agent': 'python-requests/2.21.0',
+        'x-vcloud-authorization': '3f7b9b7e0b1b4c5c9a5b2f6b2e6c1d0a',
+        'X-VMWARE-VCLOUD-REQUEST-ID': 'c0f1f4e6-4d1e-4a6f-9e5a-1f7f0c2d3b4a',
+        'X-VMWARE-VCLOUD-TENANT-CONTEXT':
+            'a93c9db9-7471-3192-8d09-a8f7eeda85f9'
+    }
+}])
+
+CLUSTER_LIST = [{
+    'name': f"cluster-{n}",
+    'vdc': 'ovdc1',
+    'status': 'POWERED_ON',
+    'container_provider': 'vcd'
+} for n in range(50)]
+
+
+class _EnabledService(object):
+    is_enabled = True
+
+
+class _CannedBrokerManager(object):
+    def __init__(self, request_headers, request_query_params, request_spec):
+        pass
+
+    def invoke(self, op):
+        return {'status_code': 200, 'body': CLUSTER_LIST}
+
+
+class _SysAdminClient(object):
+    def is_sysadmin(self):
+        return True
+
+
+class _CannedListBrokerManager(BrokerManager):
+    """BrokerManager with list clusters results, detached from vCD and PKS."""
+
+    def __init__(self, request_headers, request_query_params, request_spec):
+        self.req_headers = request_headers
+        self.req_qparams = request_query_params
+        self.req_spec = request_spec
+        self.vcd_client = _SysAdminClient()
+        self.session = {'org': 'System', 'user': 'administrator'}
+        self.ovdc_cache = SimpleNamespace(client=None)
+
+    def _list_clusters(self):
+        return CLUSTER_LIST, None
+
+
+@pytest.fixture
+def processor():
+    """Fixture to provide a ServiceProcessor detached from vCD and PKS.
+
+    Tasks:
+    - replace CSE Service and BrokerManager with stand-ins
+    """
+    with patch('container_service_extension.service.Service',
+               _EnabledService), \
+            patch('container_service_extension.processor.BrokerManager',
+                  _CannedBrokerManager):
+        yield ServiceProcessor()
+
+
+def test_0010_list_clusters_reply(processor):
+    """Test that list clusters request is routed to the broker layer."""
+    reply = processor.process_request(
+        Request(json.loads(LIST_CLUSTERS_ENVELOPE)[0]))
+    assert reply['status_code'] == 200
+    assert reply['body'] == CLUSTER_LIST
+
+
+def test_0020_unknown_route_reply(processor):
+    """Test that requests matching no route get 404 or 405 replies."""
+    envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+    envelope['requestUri'] = '/api/cse/mycluster/node-1/unknown'
+    assert processor.process_request(Request(envelope))['status_code'] == 404
+
+    envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+    envelope['method'] = 'PATCH'
+    assert processor.process_request(Request(envelope))['status_code'] == 405
+
+
+def test_0030_list_clusters_allocations(processor):
+    """Test memory allocated while processing a list clusters request.
+
+    Measures the peak of memory allocated by ServiceProcessor.process_request
+    beyond the request envelope itself, which covers copies of the envelope
+    and serialization done for debug logs.
+    """
+    body = base64.b64encode(json.dumps({'vdc': 'ovdc1'}).encode()).decode()
+    for request_body in ['', body]:
+        # warm up, so that one-time allocations (e.g. imports) don't count
+        envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+        envelope['body'] = request_body
+        processor.process_request(Request(envelope))
+
+        envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+        envelope['body'] = request_body
+        tracemalloc.start()
+        try:
+            processor.process_request(Request(envelope))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert peak < LIST_CLUSTERS_ALLOCATION_LIMIT_BYTES, \
+            f"Processing list clusters request allocated {peak} bytes"
+
+
+def test_0040_swagger_conditional_get(processor):
+    """Test that swagger spec is served with ETag and honors If-None-Match."""
+    envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+    envelope['requestUri'] = '/api/cse/swagger.json'
+    reply = processor.process_request(Request(envelope))
+    assert reply['status_code'] == 200
+    etag = reply['headers']['ETag']
+
+    envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+    envelope['requestUri'] = '/api/cse/swagger.json'
+    envelope['headers']['If-None-Match'] = etag
+    reply = processor.process_request(Request(envelope))
+    assert reply['status_code'] == 304
+    assert reply['body'] == ''
+
+
+def test_0050_list_clusters_conditional_get(processor):
+    """Test that cluster list is served with ETag and honors If-None-Match."""
+    with patch('container_service_extension.processor.BrokerManager',
+               _CannedListBrokerManager):
+        envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+        reply = processor.process_request(Request(envelope))
+        assert reply['status_code'] == 200
+        assert json.loads(reply['body']) == CLUSTER_LIST
+        etag = reply['headers']['ETag']
+
+        envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+        envelope['headers']['if-none-match'] = f"W/{etag}"
+        reply = processor.process_request(Request(envelope))
+        assert reply['status_code'] == 304
+        assert reply['body'] == ''
+        assert reply['headers']['ETag'] == etag
+
+        envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+        envelope['headers']['If-None-Match'] = '"stale"'
+        reply = processor.process_request(Request(envelope))
+        assert reply['status_code'] == 200
+
+
+def test_0060_reply_compression():
+    """Test that large replies are gzip compressed if the request allows."""
+    request = Request(json.loads(LIST_CLUSTERS_ENVELOPE)[0])
+    reply_body = json.dumps(CLUSTER_LIST)
+
+    reply = json.loads(encode_reply(request, 200, {}, reply_body, 1024))
+    assert reply['headers']['Content-Encoding'] == 'gzip'
+    compressed_body = base64.b64decode(reply['body'])
+    assert reply['headers']['Content-Length'] == len(compressed_body)
+    assert gzip.decompress(compressed_body).decode() == reply_body
+
+    for threshold in [0, len(reply_body) + 1]:
+        reply = json.loads(encode_reply(request, 200, {}, reply_body,
+                                        threshold))
+        assert 'Content-Encoding' not in reply['headers']
+        assert base64.b64decode(reply['body']).decode() == reply_body
+
+    request.headers['Accept-Encoding'] = 'deflate, gzip;q=0'
+    reply = json.loads(encode_reply(request, 200, {}, reply_body, 1024))
+    assert 'Content-Encoding' not in reply['headers']
+
+
+def test_0070_codec_backends():
+    """Test that all JSON backends decode requests and encode replies."""
+    envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+    envelope['queryString'] = 'vdc=ovdc1&org=org1'
+    envelope['body'] = base64.b64encode(
+        json.dumps({'cluster_name': 'mycluster'}).encode()).decode()
+    message = json.dumps([envelope]).encode()
+
+    default_backend = get_json_backend()
+    try:
+        for name in JSON_BACKENDS:
+            set_json_backend(name)
+            request = decode_request(message)
+            assert request.id == envelope['id']
+            assert request.query_params == {'vdc': 'ovdc1', 'org': 'org1'}
+            assert request.spec == {'cluster_name': 'mycluster'}
+
+            reply = json.loads(encode_reply(request, 200, {},
+                                            json.dumps(CLUSTER_LIST)))
+            assert reply['id'] == envelope['id']
+            assert json.loads(base64.b64decode(reply['body'])) == \
+                CLUSTER_LIST
+    finally:
+        set_json_backend(default_backend.name)
+
+
+def test_0080_single_flight_coalescing():
+    """Test that concurrent calls of the same key share one execution."""
+    single_flight = SingleFlight()
+    release = threading.Event()
+    results = []
+
+    def list_clusters():
+        release.wait(timeout=10)
+        return CLUSTER_LIST
+
+    def request():
+        results.append(single_flight.do('key', list_clusters))
+
+    threads = [threading.Thread(target=request) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while single_flight.get_metrics()['coalesced'] < len(threads) - 1:
+        release.wait(timeout=0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [CLUSTER_LIST] * len(threads)
+    assert single_flight.get_metrics() == \
+        {'executed': 1, 'coalesced': len(threads) - 1, 'in_progress': 0}
+
+    with pytest.raises(ValueError):
+        single_flight.do('key', int, 'not a number')
+    assert single_flight.get_metrics()['executed'] == 2
+
+
+@pytest.mark.parametrize('method,request_uri,lane', [
+    ('GET', '/api/cse', Lane.READ),
+    ('GET', '/api/cse/mycluster/info', Lane.READ),
+    ('GET', '/api/cse/ovdc', Lane.READ),
+    ('POST', '/api/cse', Lane.MUTATE),
+    ('PUT', '/api/cse/mycluster', Lane.MUTATE),
+    ('DELETE', '/api/cse/mycluster/node', Lane.MUTATE),
+    ('GET', '/api/cse/system', Lane.ADMIN),
+    ('PUT', '/api/cse/ovdc/f3272127-9b7f-4f90-8849-0ee70a28be56/info',
+     Lane.ADMIN),
+    ('GET', '/api/cse/mycluster/node-1/unknown', Lane.READ),
+])
+def test_0090_request_lanes(method, request_uri, lane):
+    """Test that requests are classified into lanes by their route."""
+    envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+    envelope['method'] = method
+    envelope['requestUri'] = request_uri
+    assert get_request_lane(Request(envelope)) == lane
+
+
+def test_0100_operation_admission():
+    """Test that operations beyond the caps get 503 replies."""
+    admission = OperationAdmission(max_operations=3,
+                                   max_operations_per_org=2, retry_after=30)
+
+    @exception_handler
+    def create_cluster(org_name):
+        admission.acquire(org_name)
+        return {'status_code': 202, 'body': {}}
+
+    assert create_cluster('org1')['status_code'] == 202
+    assert create_cluster('org1')['status_code'] == 202
+    reply = create_cluster('org1')
+    assert reply['status_code'] == 503
+    assert reply['headers'] == {'Retry-After': '30'}
+    assert create_cluster('org2')['status_code'] == 202
+    assert create_cluster('org3')['status_code'] == 503
+    assert admission.get_metrics() == {'in_progress': 3, 'refused': 2}
+
+    admission.release('org1')
+    assert create_cluster('org3')['status_code'] == 202
+    with pytest.raises(TooManyOperationsError):
+        admission.acquire('org1')
+
+
+def test_0110_stale_requests():
+    """Test that requests older than max_request_age are considered stale."""
+    consumer = MessageConsumer('amqp.vmware.com', 5672, False, '/', 'guest',
+                               'guest', 'vcdext', 'cse', max_request_age=60)
+    deliver = SimpleNamespace(delivery_tag=1)
+    now = int(time.time())
+
+    assert not consumer.is_stale(deliver, SimpleNamespace(timestamp=now))
+    assert not consumer.is_stale(deliver, SimpleNamespace(timestamp=None))
+    assert consumer.is_stale(deliver, SimpleNamespace(timestamp=now - 120))
+    assert consumer.stale_request_count == 1
+
+    consumer.max_request_age = 0
+    assert not consumer.is_stale(deliver,
+                                 SimpleNamespace(timestamp=now - 120))
+
+
+def test_0120_latency_metrics(processor):
+    """Test that latencies are recorded per route and per operation."""
+    recorder = LatencyRecorder(size=100)
+    for n in range(1, 201):
+        recorder.observe(n / 1000, error=n % 50 == 0)
+    snapshot = recorder.snapshot()
+    assert snapshot['count'] == 200
+    assert snapshot['errors'] == 4
+    assert snapshot['p50'] == pytest.approx(0.150)
+    assert snapshot['p99'] == pytest.approx(0.199)
+    assert snapshot['max'] == pytest.approx(0.200)
+
+    def get_count(group, name):
+        return METRICS.snapshot().get(group, {}).get(name, {}).get('count', 0)
+
+    processing_count = get_count(GROUP_PROCESSING, 'GET /')
+    queue_wait_count = get_count(GROUP_QUEUE_WAIT, 'GET /')
+    operation_count = get_count(GROUP_OPERATION, 'list clusters')
+
+    processor.process_request(Request(json.loads(LIST_CLUSTERS_ENVELOPE)[0],
+                                      time.perf_counter()))
+    assert get_count(GROUP_PROCESSING, 'GET /') == processing_count + 1
+    assert get_count(GROUP_QUEUE_WAIT, 'GET /') == queue_wait_count + 1
+    assert get_count(GROUP_OPERATION, 'list clusters') == operation_count + 1
+
+
+def test_0130_prometheus_metrics_endpoint():
+    """Test that metrics are served in the Prometheus text format."""
+    METRICS.observe(GROUP_OPERATION, 'list clusters', 0.25)
+    METRICS.get_cache_stats('test').hit()
+
+    def collect():
+        families = get_latency_metric_families(METRICS.snapshot())
+        families.extend(get_cache_metric_families(METRICS.cache_snapshot()))
+        return format_metric_families(families)
+
+    server = MetricsServer('127.0.0.1', 0, collect)
+    server.start()
+    try:
+        host, port = server.server_address
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as reply:
+            assert reply.headers['Content-Type'].startswith('text/plain')
+            text = reply.read().decode()
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen(f"http://{host}:{port}/")
+        assert excinfo.value.code == 404
+    finally:
+        server.stop()
+
+    lines = text.splitlines()
+    assert '# TYPE cse_operation_duration_seconds summary' in lines
+    assert any(line.startswith('cse_operation_duration_seconds{'
+                               'operation="list clusters",quantile="0.5"} ')
+               for line in lines)
+    assert any(line.startswith('cse_operation_duration_seconds_count{'
+                               'operation="list clusters"} ')
+               for line in lines)
+    assert 'cse_cache_hits_total{cache="test"} 1' in lines
+
+    consumer = MessageConsumer('amqp.vmware.com', 5672, False, '/', 'guest',
+                               'guest', 'vcdext', 'cse')
+    assert consumer.get_state() == {
+        'connected': False,
+        'consuming_channels': 0
+    }
+
+
+class _RecordingChannel(object):
+    """Stand-in for a pika channel, recording replies and acks."""
+
+    def __init__(self):
+        self.is_open = True
+        self.published = []
+        self.acked = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append(body)
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+def test_0140_reply_encoding_failure():
+    """Test that a message is acked even if its reply can't be encoded."""
+    consumer = MessageConsumer('amqp.vmware.com', 5672, False, '/', 'guest',
+                               'guest', 'vcdext', 'cse',
+                               ack_after_reply=True)
+    consumer.service_processor = SimpleNamespace(
+        process_request=lambda request: {'status_code': 200,
+                                         'body': CLUSTER_LIST})
+    request = decode_request(LIST_CLUSTERS_ENVELOPE.encode())
+    properties = SimpleNamespace(reply_to='reply', correlation_id='1',
+                                 headers={'replyToExchange': 'vcdext'},
+                                 timestamp=None)
+
+    # the reply is replaced by an error reply
+    encode_failures = [ValueError('bad reply')]
+
+    def encode_reply_once_failing(*args):
+        if encode_failures:
+            raise encode_failures.pop()
+        return encode_reply(*args)
+
+    channel = _RecordingChannel()
+    with patch('container_service_extension.consumer.encode_reply',
+               encode_reply_once_failing):
+        consumer.process_message(channel, SimpleNamespace(delivery_tag=1),
+                                 properties, request)
+    assert channel.acked == [1]
+    assert len(channel.published) == 1
+    assert json.loads(channel.published[0])['statusCode'] == 500
+
+    # the message is completed without a reply
+    channel = _RecordingChannel()
+    with patch('container_service_extension.consumer.encode_reply',
+               side_effect=ValueError('bad reply')):
+        consumer.process_message(channel, SimpleNamespace(delivery_tag=2),
+                                 properties, request)
+    assert channel.acked == [2]
+    assert channel.published == []
+
+
+def test_0150_client_backend_status():
+    """Test that the client reads the status of backends missing a list."""
+    backend_status = [
+        {'backend': 'vcd', 'seconds': 0.1, 'error': None},
+        {'backend': 'pks:pks-0-admin', 'seconds': 60.0,
+         'error': 'pks:pks-0-admin did not reply within 60 seconds'}
+    ]
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = json.dumps(CLUSTER_LIST).encode()
+    response.headers[BACKEND_STATUS_HEADER] = json.dumps(backend_status)
+    client = SimpleNamespace(
+        get_api_uri=lambda: 'https://vcd.vmware.com/api', _session=None,
+        _do_request_prim=lambda *args, **kwargs: response)
+
+    assert Cluster(client).get_clusters_with_backend_status() == \
+        (CLUSTER_LIST, backend_status)
+    del response.headers[BACKEND_STATUS_HEADER]
+    assert Cluster(client).get_clusters_with_backend_status() == \
+        (CLUSTER_LIST, None)
+
+
+def test_0160_lazy_request_body(processor):
+    """Test that request bodies are decoded only for routes reading them."""
+    body = base64.b64encode(json.dumps({'vdc': 'ovdc1'}).encode()).decode()
+    with patch('container_service_extension.codec.json_loads',
+               wraps=json_loads) as loads:
+        envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+        envelope['body'] = body
+        assert processor.process_request(Request(envelope))['status_code'] \
+            == 200
+        assert not loads.called
+
+        envelope = json.loads(LIST_CLUSTERS_ENVELOPE)[0]
+        envelope['method'] = 'POST'
+        envelope['body'] = body
+        processor.process_request(Request(envelope))
+        assert loads.called
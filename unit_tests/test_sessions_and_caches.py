@@ -0,0 +1,224 @@
+# container-service-extension
+# Copyright (c) 2019 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+CSE server tests of the vCD sessions and the ovdc caches of the broker layer.
+
+These tests run the broker layer against the in-process fake vCD server. They
+need neither vCD nor AMQP.
+"""
+
+import json
+import time
+
+import pytest
+
+from container_service_extension.admission import OperationAdmission
+from container_service_extension.broker_manager import BrokerManager
+from container_service_extension.broker_manager import Operation
+from container_service_extension.ovdc_cache import OVDC_METADATA_CACHE
+from container_service_extension.ovdc_cache import OvdcCache
+from container_service_extension.system_test_framework.fake_vcd import \
+    CALL_METADATA
+from container_service_extension.system_test_framework.fake_vcd import \
+    CALL_QUERY
+from container_service_extension.system_test_framework.fake_vcd import \
+    CALL_SESSION
+from container_service_extension.utils import connect_vcd_user_via_token
+from container_service_extension.utils import get_vcd_sys_admin_client
+from container_service_extension.vcdbroker import VcdBroker
+
+
+@pytest.mark.vcd_seed(num_orgs=1, vdcs_per_org=2, clusters_per_vdc=2)
+def test_0010_sys_admin_session_pool(vcd, service):
+    """Test that requests reuse system administrator sessions of vCD."""
+    pool = service.sys_admin_session_pool
+    tenant_headers = vcd.get_request_headers('org-0')
+    for op in (Operation.LIST_OVDCS, Operation.LIST_CLUSTERS,
+               Operation.INFO_OVDC):
+        result = BrokerManager(
+            tenant_headers, {},
+            {'ovdc_id': vcd.orgs['org-0'].vdcs[0].id}).invoke(op)
+        assert result['status_code'] == 200
+    assert pool.get_metrics() == \
+        {'idle': 1, 'checked_out': 0, 'logins': 1, 'expired': 0}
+
+    # expired sessions are replaced on checkout, once idle for long
+    vcd.expire_sessions()
+    tenant_headers = vcd.get_request_headers('org-0')
+    pool.validate_after = 0
+    result = BrokerManager(tenant_headers, {}, {}) \
+        .invoke(Operation.LIST_OVDCS)
+    assert result['status_code'] == 200
+    assert pool.get_metrics() == \
+        {'idle': 1, 'checked_out': 0, 'logins': 2, 'expired': 1}
+
+    pool.keep_alive()
+    assert pool.get_metrics()['idle'] == 1
+    pool.close()
+    assert pool.get_metrics()['idle'] == 0
+
+
+@pytest.mark.vcd_seed(num_orgs=1, vdcs_per_org=2, clusters_per_vdc=2)
+def test_0020_tenant_session_cache(vcd, service):
+    """Test that requests of a user share their rehydrated vCD session.
+
+    Each call gets a client of its own, since clients are not thread-safe.
+    """
+    tenant_headers = vcd.get_request_headers('org-0')
+    BrokerManager(tenant_headers, {}, {}) \
+        .invoke(Operation.LIST_CLUSTERS)
+    session_call_count = vcd.call_counts[CALL_SESSION]
+    for op in (Operation.LIST_CLUSTERS, Operation.LIST_OVDCS):
+        result = BrokerManager(tenant_headers, {}, {}).invoke(op)
+        assert result['status_code'] == 200
+    assert vcd.call_counts[CALL_SESSION] == session_call_count
+
+    vcd_uri = service.config['vcd']['host']
+    client, session = connect_vcd_user_via_token(vcd_uri, tenant_headers,
+                                                 verify_ssl_certs=False)
+    other_client, other_session = connect_vcd_user_via_token(
+        vcd_uri, tenant_headers, verify_ssl_certs=False)
+    assert other_client is not client
+    assert other_client._session is not client._session
+    assert other_session is session
+    assert other_client.get_org().get('name') == 'org-0'
+    assert vcd.call_counts[CALL_SESSION] == session_call_count
+
+    # sessions replied 401 are rehydrated again
+    vcd.expire_sessions()
+    with pytest.raises(Exception):
+        client.get_org()
+    session_call_count = vcd.call_counts[CALL_SESSION]
+    with pytest.raises(Exception):
+        connect_vcd_user_via_token(vcd_uri, tenant_headers,
+                                   verify_ssl_certs=False)
+    assert vcd.call_counts[CALL_SESSION] == session_call_count + 1
+
+
+def test_0030_refused_operation_sessions(vcd, service):
+    """Test that operations which don't start return their sessions."""
+    admission = OperationAdmission(max_operations=1)
+    service.operation_admission = admission
+    cluster = vcd.get_clusters('org-0')[0]
+    pool = service.sys_admin_session_pool
+    tenant_headers = vcd.get_request_headers('org-0')
+
+    def create_nodes(cluster_name):
+        return VcdBroker(tenant_headers, {
+            'name': cluster_name,
+            'vdc': cluster.vdc.name,
+            'network': 'network-0',
+            'node_count': 1
+        }).create_nodes()
+
+    # the cluster is not found
+    assert create_nodes('missing')['status_code'] == 500
+    assert pool.get_metrics()['checked_out'] == 0
+
+    # the vCD task of the operation can't be created
+    assert create_nodes(cluster.name)['status_code'] == 500
+    assert pool.get_metrics()['checked_out'] == 0
+    assert admission.get_metrics()['in_progress'] == 0
+
+    # the operation is refused
+    admission.acquire('org-0')
+    assert create_nodes(cluster.name)['status_code'] == 503
+    assert pool.get_metrics()['checked_out'] == 0
+
+
+@pytest.mark.vcd_seed(num_orgs=1, vdcs_per_org=2, clusters_per_vdc=1)
+def test_0040_ovdc_metadata_cache(vcd, service):
+    """Test that ovdc metadata is cached across requests until changed."""
+    vdc = vcd.orgs['org-0'].vdcs[0]
+    tenant_headers = vcd.get_request_headers('org-0')
+    request_spec = {'vdc': vdc.name}
+    hits = OVDC_METADATA_CACHE.stats.snapshot()['hits']
+    for _ in range(3):
+        broker_manager = BrokerManager(tenant_headers, {},
+                                       request_spec)
+        try:
+            broker = broker_manager.get_broker_based_on_vdc()
+        finally:
+            broker_manager.close()
+        assert type(broker).__name__ == 'VcdBroker'
+    assert vcd.call_counts[CALL_METADATA] == 1
+    assert OVDC_METADATA_CACHE.stats.snapshot()['hits'] == hits + 2
+
+    # the entry cached by name is invalidated by id too
+    result = BrokerManager(vcd.get_request_headers(), {},
+                           {'ovdc_id': vdc.id}) \
+        .invoke(Operation.INFO_OVDC)
+    assert result['body'] == {'container_provider': 'vcd'}
+    ovdc_cache = OvdcCache(get_vcd_sys_admin_client())
+    ovdc_cache.set_ovdc_container_provider_metadata(
+        ovdc_cache.get_ovdc(ovdc_id=vdc.id))
+    broker_manager = BrokerManager(tenant_headers, {}, request_spec)
+    with pytest.raises(Exception, match='not enabled'):
+        broker_manager.get_broker_based_on_vdc()
+    broker_manager.close()
+
+
+@pytest.mark.vcd_seed(num_orgs=3, vdcs_per_org=50, clusters_per_vdc=0)
+def test_0050_list_ovdcs_query(vcd, service):
+    """Test that ovdcs are listed with a paged query, not per ovdc."""
+    vcd.add_vdc('org-1', 'ovdc-pks', container_provider='pks')
+    vcd.add_vdc('org-1', 'ovdc-none', container_provider=None)
+    vcd.add_vdc('org-1', 'ovdc-disabled', is_enabled=False)
+    call_counts = vcd.call_counts.copy()
+    result = BrokerManager(vcd.get_request_headers(), {}, {}) \
+        .invoke(Operation.LIST_OVDCS)
+    ovdcs = json.loads(result['body'])
+    assert len(ovdcs) == 153
+    assert ovdcs[0] == \
+        {'org': 'org-0', 'name': 'ovdc-0', 'container_provider': 'vcd'}
+    # the query lists of the user and of the system administrator, then 2
+    # pages of 128 ovdcs at most
+    assert vcd.call_counts[CALL_QUERY] - call_counts[CALL_QUERY] == 4
+    assert vcd.call_counts[CALL_METADATA] == \
+        call_counts[CALL_METADATA]
+
+    result = BrokerManager(vcd.get_request_headers('org-1'), {}, {}) \
+        .invoke(Operation.LIST_OVDCS)
+    ovdcs = json.loads(result['body'])
+    assert {ovdc['org'] for ovdc in ovdcs} == {'org-1'}
+    # ovdcs hidden from the user are left out
+    assert [ovdc['container_provider'] for ovdc in ovdcs[-2:]] == \
+        ['pks', 'none']
+    assert 'ovdc-disabled' not in {ovdc['name'] for ovdc in ovdcs}
+
+
+@pytest.mark.vcd_seed(num_orgs=1, vdcs_per_org=1, clusters_per_vdc=0)
+def test_0060_ovdc_metadata_read_while_set(vcd, service):
+    """Test that metadata read while it is being set is not cached stale."""
+    vdc = vcd.orgs['org-0'].vdcs[0]
+    vcd.task_duration = 1
+    tenant_headers = vcd.get_request_headers('org-0')
+    request_spec = {'vdc': vdc.name}
+
+    def get_broker():
+        broker_manager = BrokerManager(tenant_headers, {},
+                                       request_spec)
+        try:
+            return broker_manager.get_broker_based_on_vdc()
+        finally:
+            broker_manager.close()
+
+    ovdc_cache = OvdcCache(get_vcd_sys_admin_client())
+    task = ovdc_cache.set_ovdc_container_provider_metadata(
+        ovdc_cache.get_ovdc(ovdc_id=vdc.id))
+    # the task is replied without waiting for it to complete
+    assert task.get('status') == 'running'
+
+    # the task is still running, the old metadata is read but not cached
+    metadata_call_count = vcd.call_counts[CALL_METADATA]
+    for _ in range(2):
+        assert type(get_broker()).__name__ == 'VcdBroker'
+    assert vcd.call_counts[CALL_METADATA] == metadata_call_count + 2
+    assert OVDC_METADATA_CACHE.is_updating(vdc.id)
+
+    while OVDC_METADATA_CACHE.is_updating(vdc.id):
+        time.sleep(0.1)
+    with pytest.raises(Exception, match='not enabled'):
+        get_broker()